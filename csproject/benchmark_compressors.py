@@ -0,0 +1,79 @@
+"""
+Measure the throughput of the (non-deep) compressors of `compress.py`
+on the sequences of a DB, e.g. one generated by `load/gen_random.py`.
+Nothing is written to the DB.
+"""
+
+
+import os
+import time
+import argparse as ap
+import sqlite3 as sql
+from compress import COMPRESSORS
+from compressors import Chain
+from seqstore import SequenceReader
+
+
+def time_best(f, repeats):
+    """The shortest time taken by `f()` over `repeats` calls."""
+    best = float('inf')
+    for _ in range(repeats):
+        before = time.perf_counter()
+        f()
+        best = min(best, time.perf_counter() - before)
+    return best
+
+
+if __name__ == "__main__":
+    parser = ap.ArgumentParser()
+    parser.add_argument("db", type=str,
+                        help="Filename of the DB to load.")
+    parser.add_argument("--compressors", type=str, nargs='+',
+                        default=['huffman', 'zlib', 'gzip', 'bzip2', 'lzma'],
+                        help="The compressors to benchmark, from: " +
+                             ", ".join(c for c in COMPRESSORS.keys() if c != 'bert'))
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="The number of times to time each compressor "
+                             "(the best time is reported).")
+    parser.add_argument("--as-numpy", action="store_true",
+                        help="Pass the sequences to the compressors as NumPy "
+                             "arrays, rather than lists.")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Run the stages of chained compressors in "
+                             "parallel (see `Chain`).")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.db):
+        print("Error: cannot find ", args.db)
+        exit(-1)
+
+    for c in args.compressors:
+        if c not in COMPRESSORS or c == 'bert':
+            print("Error:", c, "is not a valid compressor.")
+            exit(-1)
+
+    if args.repeats < 1:
+        print("Error: --repeats must be positive.")
+        exit(-1)
+
+    db = sql.connect(args.db)
+    cur = db.cursor()
+    cur.execute("SELECT MAX(tokid) + 1 FROM Alphabet")
+    alphabet_size = cur.fetchone()[0]
+    cur.execute("SELECT seqid FROM Sequences ORDER BY seqid")
+    seqs = list(SequenceReader(db, [row[0] for row in cur.fetchall()],
+                               as_numpy=args.as_numpy))
+    db.close()
+    n_toks = sum(map(len, seqs))
+    print(f"{len(seqs)} sequences, {n_toks} tokens, alphabet size {alphabet_size}")
+
+    print(f"{'compressor':<12}{'compressmany':>20}{'compressed_sizes':>20}")
+    for name in args.compressors:
+        comp = COMPRESSORS[name](None, name, 0)
+        if args.pipeline and isinstance(comp, Chain):
+            comp.pipeline = True
+        comp.train(alphabet_size, lambda: iter(seqs), lambda: iter([]))
+        t_many = time_best(lambda: sum(map(len, comp.compressmany(seqs))), args.repeats)
+        t_sizes = time_best(lambda: sum(comp.compressed_sizes(seqs)), args.repeats)
+        print(f"{name:<12}{n_toks / t_many / 1e6:>14.2f} Mtok/s"
+              f"{n_toks / t_sizes / 1e6:>14.2f} Mtok/s")
@@ -7,7 +7,7 @@ procedure.
 import numpy as np
 
 
-def cut_sort(model, seqs, mask_value, blocking=None):
+def cut_sort(model, seqs, mask_value, blocking=None, entropies=False):
     if blocking is None:
         blocking = 1
 
@@ -28,7 +28,11 @@ def cut_sort(model, seqs, mask_value, blocking=None):
 
         block_masked_seqs = np.copy(seqs)
         block_masked_seqs[:, block_idxs] = mask_value
-        ps_i = model(block_masked_seqs)[:, block_idxs]
-        hs[:, block_idxs] = np.sum((-ps_i * np.ma.log(ps_i)).filled(0.0), axis=-1)
+        if entropies:
+            # the model gives the entropies itself
+            hs[:, block_idxs] = model(block_masked_seqs)[:, block_idxs]
+        else:
+            ps_i = model(block_masked_seqs)[:, block_idxs]
+            hs[:, block_idxs] = np.sum((-ps_i * np.ma.log(ps_i)).filled(0.0), axis=-1)
 
     return np.argsort(hs, axis=-1)
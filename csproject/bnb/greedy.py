@@ -7,7 +7,7 @@ token with the highest conditional entropy.
 import numpy as np
 
 
-def greedy_order(model, seqs, mask_value, blocking=None):
+def greedy_order(model, seqs, mask_value, blocking=None, entropies=False):
     if blocking is None:
         blocking = 1
 
@@ -20,8 +20,12 @@ def greedy_order(model, seqs, mask_value, blocking=None):
 
     for i in range(0, n_steps):
         # run the model, then reveal the token with highest entropy
-        ps = model(np.where(mask_array == 0, seqs, mask_value))
-        Hs = np.sum((-ps * np.ma.log(ps)).filled(0.0), axis=-1)
+        if entropies:
+            # the model gives the entropies itself
+            Hs = model(np.where(mask_array == 0, seqs, mask_value))
+        else:
+            ps = model(np.where(mask_array == 0, seqs, mask_value))
+            Hs = np.sum((-ps * np.ma.log(ps)).filled(0.0), axis=-1)
         Hs = np.where(mask_array == 0, 0.0, Hs)
 
         for k in range(min(blocking, idxs.shape[1] - i * blocking)):
@@ -5,249 +5,311 @@ this script uses different classification methods to classify the labels.
 
 
 import os
-import copy
-import math
-import heapq
 import argparse as ap
 import sqlite3 as sql
+import numpy as np
 import progressbar as pgb
 
 
-class KNNClassificationAggregator:
-    """A structure for performing K-nearest-neighbour
-    classification.
+# The predictors below work on a (others x train) matrix of NCDs, in
+# which missing pairings are infinite, and a vector giving the index of
+# the label of each training sequence (or -1 if it doesn't have one).
+# They predict the label index of each of the others (or -1 if they
+# can't). Columns are in ascending order of training sequence ID, which
+# is the order ties are broken in. The neighbours of each row are sorted
+# once, by `sort_neighbours`, and shared by all predictors.
+
+
+def _first_min(values, first_col):
+    """For each row, find the index of the smallest value, breaking ties
+    by the smallest `first_col`.
+    """
+    is_min = values == np.min(values, axis=1, keepdims=True)
+    return np.argmin(np.where(is_min, first_col, np.iinfo(np.int64).max), axis=1)
+
+
+def _first_cols(valid, lbl_idx, n_lbls):
+    """For each row and label, find the first column of a valid NCD with
+    that label.
+    """
+    masks = [valid & (lbl_idx == lbl)[None, :] for lbl in range(n_lbls)]
+    return np.stack([np.where(np.any(m, axis=1), np.argmax(m, axis=1),
+                              np.iinfo(np.int64).max)
+                     for m in masks], axis=1)
+
+
+def sort_neighbours(ncds):
+    """Sort the training sequences of each row by distance then ID.
+
+    Returns:
+        A tuple `(order, sorted_ncds)` of (others x train) matrices.
     """
-    def __init__(self, k):
-        self.k = k
-        self.data = []  # heap, mapping distances to training sequences
-
-    def step(self, seqid_train, dist):
-        heapq.heappush(self.data, (dist, seqid_train))
-
-    def predict(self, lbl_map):
-        # extract top K elements, put them
-        # into a dict which maps each label
-        # to its frequency
-        top = {}
-        data_copy = copy.copy(self.data)
-        for _ in range(self.k):
-            # if there are fewer than k data points
-            if len(data_copy) == 0:
-                break
-
-            seqid_train = heapq.heappop(data_copy)[1]
-            lbl = lbl_map[seqid_train]
-            if lbl not in top:
-                top[lbl] = 1
-            else:
-                top[lbl] += 1
-
-        assert(len(top) > 0)
-
-        # return vote
-        max_freq = max(top.values())
-        for lbl, freq in top.items():
-            if freq == max_freq:
-                return lbl
-
-
-class AvgDistClassificationAggregator:
-    """A structure for classifying
-    points based on their average distance.
+    order = np.argsort(ncds, axis=1, kind='stable')
+    return order, np.take_along_axis(ncds, order, axis=1)
+
+
+def predict_knn(order, valid, lbl_idx, n_lbls, ks):
+    """K-nearest-neighbour classification, for several K at once.
+    The vote is won by the most frequent label, with ties going to the
+    label of the nearer neighbour.
+
+    Returns:
+        A dict mapping each K to the predictions.
+    """
+    n, n_train = order.shape
+    rows = np.arange(n)[:, None]
+    max_k = min(max(ks), n_train)
+
+    # the nearest `max_k` neighbours with labels, in order
+    sorted_valid = valid[rows, order]
+    if np.all(sorted_valid):
+        nbrs = order[:, :max_k]
+        nbr_valid = sorted_valid[:, :max_k]
+    else:
+        pos = np.argsort(~sorted_valid, axis=1, kind='stable')[:, :max_k]
+        nbrs = order[rows, pos]
+        nbr_valid = sorted_valid[rows, pos]
+    nbr_lbls = np.where(nbr_valid, lbl_idx[nbrs], 0)
+
+    # cumulative label counts, so that counts[:, k - 1] are the counts of
+    # the first k neighbours
+    counts = np.cumsum((nbr_lbls[:, :, None] == np.arange(n_lbls)) & nbr_valid[:, :, None],
+                       axis=1, dtype=np.int32)
+
+    preds = {}
+    for k in ks:
+        k_ = min(k, max_k)
+        counts_k = counts[:, k_ - 1, :]
+        is_max = nbr_valid[:, :k_] & (
+            np.take_along_axis(counts_k, nbr_lbls[:, :k_], axis=1)
+            == np.max(counts_k, axis=1, keepdims=True))
+        pred = nbr_lbls[rows[:, 0], np.argmax(is_max, axis=1)]
+        preds[k] = np.where(np.any(nbr_valid[:, :k_], axis=1), pred, -1)
+    return preds
+
+
+def predict_quantile(order, sorted_ncds, valid, lbl_idx, n_lbls, quantiles):
+    """Classification by the label whose distances have the smallest
+    given quantile, for several quantiles at once. Ties go to the label
+    occurring first.
+
+    Returns:
+        A dict mapping each quantile to the predictions.
+    """
+    n = order.shape[0]
+    rows = np.arange(n)
+    first_col = _first_cols(valid, lbl_idx, n_lbls)
+    sorted_valid = np.take_along_axis(valid, order, axis=1)
+    sorted_lbls = lbl_idx[order]
+
+    # for each label, the number of its distances up to each position
+    ranks = [np.cumsum(sorted_valid & (sorted_lbls == lbl), axis=1)
+             for lbl in range(n_lbls)]
+
+    preds = {}
+    for quantile in quantiles:
+        values = np.full((n, n_lbls), np.inf)
+        for lbl, rank in enumerate(ranks):
+            n_lbl = rank[:, -1]
+            # the position of the (quantile * n_lbl)th distance with this label
+            idx = (quantile * n_lbl).astype(np.int64)
+            pos = np.argmax(rank == (idx + 1)[:, None], axis=1)
+            values[:, lbl] = np.where(n_lbl > 0, sorted_ncds[rows, pos], np.inf)
+        pred = _first_min(values, first_col)
+        preds[quantile] = np.where(np.any(valid, axis=1), pred, -1)
+    return preds
+
+
+def predict_avg(ncds, valid, lbl_idx, n_lbls, log):
+    """Classification by the label with the smallest average (log-)
+    distance. Ties go to the label occurring first.
+    """
+    first_col = _first_cols(valid, lbl_idx, n_lbls)
+    if log:
+        ncds = np.log(np.maximum(ncds, 1.0e-9))
+    ncds = np.where(valid, ncds, 0.0)
+
+    # NOTE: cumsum sums in column order, as the original implementation
+    # did, so exactly tied averages are rounded identically
+    values = np.stack([np.cumsum(ncds * mask, axis=1)[:, -1] / np.maximum(np.sum(mask, axis=1), 1)
+                       for mask in (valid & (lbl_idx == lbl)[None, :] for lbl in range(n_lbls))],
+                      axis=1)
+    values[first_col == np.iinfo(np.int64).max] = np.inf
+
+    pred = _first_min(values, first_col)
+    return np.where(np.any(valid, axis=1), pred, -1)
+
+
+def get_groups(db):
+    cur = db.cursor()
+    cur.execute("SELECT DISTINCT compid, ncd_formula FROM TrainingPairings "
+                "ORDER BY compid, ncd_formula")
+    return cur.fetchall()
+
+
+def load_group(db, compid, ncd_formula):
+    """Load the NCDs of a given compressor and NCD formula as a dense
+    (others x train) matrix, where missing pairings are infinite.
+
+    Returns:
+        A tuple `(seqids_other, seqids_train, ncds)`, where the sequence
+        ID vectors are sorted.
     """
-    def __init__(self, log=True):
-        self.log = log
-        self.data = {}  # mapping from seqid_train to NCD distance
-
-    def step(self, seqid_train, dist):
-        if self.log:
-            dist = math.log(max(dist, 1.0e-9))
-
-        self.data[seqid_train] = dist
-
-    def predict(self, lbl_map):
-        # convert to mapping from labels to distances
-        lbl_data = {}
-        for seqid_train, dist in self.data.items():
-            lbl = lbl_map[seqid_train]
-            if lbl not in lbl_data:
-                lbl_data[lbl] = [dist]
-            else:
-                lbl_data[lbl].append(dist)
-        # convert to mapping from labels to average distances
-        lbl_data = dict([
-            (lbl, sum(vs) / len(vs)) for lbl, vs in lbl_data.items()
-        ])
-        # return lowest avg
-        min_v = min(lbl_data.values())
-        for lbl, v in lbl_data.items():
-            if v == min_v:
-                return lbl
-
-
-class QuantileClassificationAggregator:
-    """A structure for classifying
-    points based on a quantile distance between the
-    distance distributions. Lower quantile values mean
-    comparisons closer to the minimum.
+    cur = db.cursor()
+    cur.execute("""
+    SELECT seqid_other, seqid_train, ncd_value
+    FROM TrainingPairings
+    WHERE compid = ? AND ncd_formula = ?
+    """, (compid, ncd_formula))
+    rows = np.array(cur.fetchall(), dtype=np.float64).reshape(-1, 3)
+    seqids_other, i = np.unique(rows[:, 0].astype(np.int64), return_inverse=True)
+    seqids_train, j = np.unique(rows[:, 1].astype(np.int64), return_inverse=True)
+    ncds = np.full((len(seqids_other), len(seqids_train)), np.inf)
+    ncds[i, j] = rows[:, 2]
+    return seqids_other, seqids_train, ncds
+
+
+def load_labels(db):
+    """Load the labels of the training sequences.
+
+    Returns:
+        A dict mapping each label type to a tuple of sorted vectors
+        `(seqids, lbls)`.
     """
-    def __init__(self, quantile):
-        quantile = float(quantile)
-        assert(quantile >= 0.0 and quantile < 1.0)
-        self.quantile = quantile
-        self.data = {}  # mapping from seqid_train to NCD distance
-
-    def step(self, seqid_train, dist):
-        self.data[seqid_train] = dist
-
-    def predict(self, lbl_map):
-        # convert to mapping from labels to distances
-        lbl_data = {}
-        for seqid_train, dist in self.data.items():
-            lbl = lbl_map[seqid_train]
-            if lbl not in lbl_data:
-                lbl_data[lbl] = [dist]
-            else:
-                lbl_data[lbl].append(dist)
-        # convert to mapping from labels to the right quantile
-        lbl_data = dict([
-            (lbl, sorted(vs)[int(self.quantile * len(vs))]) for lbl, vs in lbl_data.items()
-        ])
-        # return class associated with the lowest quantile
-        min_v = min(lbl_data.values())
-        for lbl, v in lbl_data.items():
-            if v == min_v:
-                return lbl
-
-
-class NCDDataGetter:
-    def __init__(self, db):
-        self.cur = db.cursor()
-        # more reasons why I don't like SQLite
-        self.cur.execute(
-            "SELECT DISTINCT compid, ncd_formula, seqid_other "
-            "FROM TrainingPairings"
-        )
-        self.L = 0
-        while self.cur.fetchone() is not None:
-            self.L += 1
-
-    def __len__(self):
-        return self.L
-
-    def __iter__(self):
-        self.cur.execute("""
-        SELECT compid, ncd_formula, seqid_other, seqid_train, ncd_value
+    cur = db.cursor()
+    cur.execute("SELECT lbltype FROM LabelTypes")
+    labels = dict((lbltype, ([], [])) for (lbltype,) in cur.fetchall())
+    cur.execute("""
+    WITH RelevantTrain AS (
+        SELECT DISTINCT seqid_train AS seqid
         FROM TrainingPairings
-        ORDER BY compid, ncd_formula, seqid_other
-        """)
-        self.cur_row = self.cur.fetchone()
-        return self
-
-    def __next__(self):
-        if self.cur_row is None:
-            raise StopIteration()
-
-        idx = self.cur_row[:3]
-        data = []
-        while self.cur_row is not None and self.cur_row[:3] == idx:
-            data.append(self.cur_row[3:])
-            self.cur_row = self.cur.fetchone()
-
-        return (idx, data)
-
-
-class Executor:
-    def __init__(self, db, predictor, predictor_name):
-        self.predictor = predictor
-        self.pred_name = predictor_name
-        self.ncd_getter = NCDDataGetter(db)
-        self.cur = db.cursor()
-        self.cur.execute("""
-        WITH RelevantTrain AS (
-            SELECT DISTINCT seqid_train AS seqid
-            FROM TrainingPairings
-        )
-        SELECT lbltype, seqid, lbl
-        FROM RelevantTrain NATURAL JOIN Labels
-        """)
-        self.lblmaps = {}
-        for lbltype, seqid, lbl in self.cur.fetchall():
-            if lbltype not in self.lblmaps:
-                self.lblmaps[lbltype] = {}
-            self.lblmaps[lbltype][seqid] = lbl
-        self.cur.execute("SELECT lbltype FROM LabelTypes")
-        self.lbltypes = list(map(lambda t: t[0], self.cur.fetchall()))
-
-    def __len__(self):
-        return len(self.lbltypes) * len(self.ncd_getter)
-
-    def __iter__(self):
-        self.ncd_iter = iter(self.ncd_getter)
-        self.lbltype_index = len(self.lbltypes)
-        self.idx = None
-        return self
-
-    def __next__(self):
-        if self.lbltype_index == len(self.lbltypes):
-            self.idx, data = next(self.ncd_iter)
-
-            self.lbltype_index = 0
-            self.pred = self.predictor()
-
-            for seqid_train, dist in data:
-                self.pred.step(seqid_train, dist)
-
-        # get current label type and then advance
-        lbltype = self.lbltypes[self.lbltype_index]
-        self.lbltype_index += 1
-        # now actually return the result
-        return (self.pred_name, lbltype,) + self.idx + (self.pred.predict(self.lblmaps[lbltype]),)
+    )
+    SELECT lbltype, seqid, lbl
+    FROM RelevantTrain NATURAL JOIN Labels
+    ORDER BY lbltype, seqid
+    """)
+    for lbltype, seqid, lbl in cur.fetchall():
+        labels[lbltype][0].append(seqid)
+        labels[lbltype][1].append(lbl)
+    return dict((lbltype, (np.array(seqids, dtype=np.int64), np.array(lbls, dtype=np.int64)))
+                for lbltype, (seqids, lbls) in labels.items())
+
+
+def classify_group(seqids_train, ncds, labels, ks=(), quantiles=(), avg=False, avg_log=False):
+    """Classify all of the others of a group, for every label type and
+    every requested predictor.
+
+    Args:
+        seqids_train (np.ndarray): The (sorted) training sequence IDs.
+        ncds (np.ndarray): The (others x train) matrix of NCDs.
+        labels (dict): The output of `load_labels`.
+        ks (list of int): The K of each KNN predictor.
+        quantiles (list of float): The quantile of each quantile predictor.
+        avg (bool): Whether to use the average distance predictor.
+        avg_log (bool): Whether to use the average log-distance predictor.
+
+    Returns:
+        An iterator over `(predictor, lbltype, others, lbls)` tuples, where
+        `others` are the row indices of the predicted others and `lbls`
+        their predicted labels.
+    """
+    finite = np.isfinite(ncds)
+    if len(ks) > 0 or len(quantiles) > 0:
+        order, sorted_ncds = sort_neighbours(ncds)
+
+    for lbltype, (seqids, lbls) in labels.items():
+        uniq_lbls, lbl_idx = np.unique(lbls, return_inverse=True)
+        # index of the label of each training sequence, or -1 if it has none
+        train_lbl_idx = np.full(len(seqids_train), -1, dtype=np.int64)
+        pos = np.searchsorted(seqids, seqids_train)
+        found = pos < len(seqids)
+        found[found] = seqids[pos[found]] == seqids_train[found]
+        train_lbl_idx[found] = lbl_idx.reshape(-1)[pos[found]]
+        valid = finite & found[None, :]
+        n_lbls = len(uniq_lbls)
+
+        preds = []
+        if len(ks) > 0:
+            preds.extend((str(k) + "-NN", pred) for k, pred in predict_knn(
+                order, valid, train_lbl_idx, n_lbls, ks).items())
+        if len(quantiles) > 0:
+            preds.extend((str(q) + "-quantile", pred) for q, pred in predict_quantile(
+                order, sorted_ncds, valid, train_lbl_idx, n_lbls, quantiles).items())
+        if avg:
+            preds.append(('AVG', predict_avg(ncds, valid, train_lbl_idx, n_lbls, log=False)))
+        if avg_log:
+            preds.append(('AVG-LOG', predict_avg(ncds, valid, train_lbl_idx, n_lbls, log=True)))
+
+        for predictor, pred in preds:
+            others = np.flatnonzero(pred >= 0)
+            yield predictor, lbltype, others, uniq_lbls[pred[others]]
+
+
+def parse_ks(ks_strs):
+    """Parse a list of integers and inclusive ranges, e.g. `1-25`."""
+    ks = []
+    for k_str in ks_strs:
+        lo, _, hi = k_str.partition('-')
+        ks.extend(range(int(lo), int(hi if hi != '' else lo) + 1))
+    return sorted(set(ks))
 
 
 if __name__ == "__main__":
     parser = ap.ArgumentParser()
     parser.add_argument("db", type=str,
                         help="Filename of the DB to load.")
-    grp = parser.add_mutually_exclusive_group(required=True)
-    grp.add_argument("--knn", type=int, default=None,
-                     help="KNN classifier, with given integer K.")
-    grp.add_argument("--quantile", type=float, default=None,
-                     help="Quantile classifier, with given quantile (smaller means closer to min).")
-    grp.add_argument("--avg", action='store_true',
-                     help="Choose label based on the class with smallest average distance.")
-    grp.add_argument("--avg-log", action='store_true',
-                     help="Choose label based on the class with smallest average log-distance.")
+    parser.add_argument("--knn", type=str, nargs='+', default=[],
+                        help="KNN classifiers, with given integer Ks. Ranges "
+                             "such as 1-25 are inclusive.")
+    parser.add_argument("--quantile", type=float, nargs='+', default=[],
+                        help="Quantile classifiers, with given quantiles "
+                             "(smaller means closer to min).")
+    parser.add_argument("--avg", action='store_true',
+                        help="Choose label based on the class with smallest average distance.")
+    parser.add_argument("--avg-log", action='store_true',
+                        help="Choose label based on the class with smallest average log-distance.")
     args = parser.parse_args()
 
     if not os.path.isfile(args.db):
         print("Error: cannot find ", args.db)
         exit(-1)
 
-    db = sql.connect(args.db)
+    try:
+        ks = parse_ks(args.knn)
+    except ValueError:
+        print("Error: --knn must be a list of integers or ranges.")
+        exit(-1)
+    if any(k < 1 for k in ks):
+        print("Error: --knn values must be positive.")
+        exit(-1)
 
-    # construct the predictor
-    if args.knn is not None:
-        PREDICTOR_NAME = str(args.knn) + "-NN"
-        PREDICTOR = lambda: KNNClassificationAggregator(args.knn)
-    elif args.quantile:
-        PREDICTOR_NAME = str(args.quantile) + "-quantile"
-        PREDICTOR = lambda: QuantileClassificationAggregator(args.quantile)
-    elif args.avg:
-        PREDICTOR_NAME = 'AVG'
-        PREDICTOR = lambda: AvgDistClassificationAggregator(log=False)
-    elif args.avg_log:
-        PREDICTOR_NAME = 'AVG-LOG'
-        PREDICTOR = lambda: AvgDistClassificationAggregator(log=True)
+    quantiles = sorted(set(args.quantile))
+    if any(q < 0.0 or q >= 1.0 for q in quantiles):
+        print("Error: --quantile values must be in [0, 1).")
+        exit(-1)
 
+    if len(ks) == 0 and len(quantiles) == 0 and not args.avg and not args.avg_log:
+        print("Error: at least one of --knn, --quantile, --avg and --avg-log "
+              "must be given.")
+        exit(-1)
+
+    db = sql.connect(args.db)
     cur = db.cursor()
     cur.execute("PRAGMA FOREIGN_KEYS = ON")
-    cur.executemany("""
-    INSERT INTO Predictions(predictor, lbltype, compid, ncd_formula, seqid, lbl)
-    VALUES (?, ?, ?, ?, ?, ?)
-    """,
-    pgb.progressbar(Executor(db, PREDICTOR, PREDICTOR_NAME))
-    )
+
+    # all of the predictions are made from a single scan of the NCDs
+    labels = load_labels(db)
+    groups = get_groups(db)
+    for compid, ncd_formula in pgb.progressbar(groups, max_value=len(groups)):
+        seqids_other, seqids_train, ncds = load_group(db, compid, ncd_formula)
+        for predictor, lbltype, others, lbls in classify_group(
+                seqids_train, ncds, labels, ks, quantiles, args.avg, args.avg_log):
+            n = len(others)
+            cur.executemany("""
+            INSERT INTO Predictions(predictor, lbltype, compid, ncd_formula, seqid, lbl)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """, zip([predictor] * n, [lbltype] * n, [compid] * n, [ncd_formula] * n,
+                     seqids_other[others].tolist(), lbls.tolist()))
 
     db.commit()
     db.close()
@@ -0,0 +1,147 @@
+import math
+import shutil
+import sqlite3 as sql
+import numpy as np
+import testutil
+from classify import classify_group, get_groups, load_group, load_labels, parse_ks
+
+
+def _create_db(path):
+    # NCDs from a handful of values, so that there are many ties, with
+    # some pairings missing, and a second label type which leaves some
+    # training sequences unlabelled
+    db = testutil.create_db(path, n_seqs=80)
+    rng = np.random.default_rng(0)
+    db.execute("INSERT INTO CompressorArchitecture(compname, compd, comp_deep) "
+               "VALUES ('c', 256, 0)")
+    db.executemany("INSERT INTO Compressors(compid, compname, comprepeat, compdate) "
+                   "VALUES (?, 'c', ?, '')", [(0, 0), (1, 1)])
+    db.execute("INSERT INTO LabelTypes(lbltype, lbltype_name) VALUES (1, 'lbl3')")
+    db.executemany("INSERT INTO LabelDictionary(lbltype, lbl) VALUES (1, ?)",
+                   [(0,), (1,), (2,)])
+    db.executemany("INSERT INTO Labels(seqid, lbltype, lbl) VALUES (?, 1, ?)",
+                   [(seqid, int(rng.integers(3))) for seqid in range(80) if seqid % 5 != 0])
+    train = [row[0] for row in db.execute("SELECT seqid FROM Sequences WHERE seqpart = 0")]
+    other = [row[0] for row in db.execute("SELECT seqid FROM Sequences WHERE seqpart > 0")]
+    db.executemany("INSERT INTO TrainingPairings(compid, ncd_formula, seqid_train, "
+                   "seqid_other, ncd_value) VALUES (?, ?, ?, ?, ?)",
+                   [(compid, f, t, o, float(rng.choice([0.25, 0.5, 0.75, 1.0])))
+                    for compid in [0, 1] for f in ['a', 'b'] for t in train for o in other
+                    if rng.random() < 0.8])
+    db.commit()
+    return db
+
+
+def _predict(db, ks, quantiles):
+    labels = load_labels(db)
+    preds = {}
+    for compid, f in get_groups(db):
+        seqids_other, seqids_train, ncds = load_group(db, compid, f)
+        for predictor, lbltype, others, lbls in classify_group(
+                seqids_train, ncds, labels, ks, quantiles, True, True):
+            for seqid, lbl in zip(seqids_other[others].tolist(), lbls.tolist()):
+                preds[predictor, lbltype, compid, f, seqid] = lbl
+    return preds
+
+
+def _first_min(lbl_values):
+    # the label with the smallest value, ties going to the label
+    # occurring first
+    min_v = min(lbl_values.values())
+    return next(lbl for lbl, v in lbl_values.items() if v == min_v)
+
+
+def _reference(db, ks, quantiles):
+    # one row at a time, in the same way as the original aggregators
+    lbl_maps = {}
+    for lbltype, seqid, lbl in db.execute("SELECT lbltype, seqid, lbl FROM Labels"):
+        lbl_maps.setdefault(lbltype, {})[seqid] = lbl
+    rows = {}
+    for compid, f, o, t, v in db.execute(
+            "SELECT compid, ncd_formula, seqid_other, seqid_train, ncd_value "
+            "FROM TrainingPairings ORDER BY compid, ncd_formula, seqid_other, seqid_train"):
+        rows.setdefault((compid, f, o), []).append((t, v))
+
+    preds = {}
+    for (compid, f, o), row in rows.items():
+        for lbltype, lbl_map in lbl_maps.items():
+            row_lbl = [(t, v, lbl_map[t]) for t, v in row if t in lbl_map]
+            if len(row_lbl) == 0:
+                continue
+            key = (lbltype, compid, f, o)
+
+            nearest = sorted(row_lbl, key=lambda tvl: (tvl[1], tvl[0]))
+            for k in ks:
+                votes = {}
+                for _, _, lbl in nearest[:k]:
+                    votes[lbl] = votes.get(lbl, 0) + 1
+                max_votes = max(votes.values())
+                preds[(str(k) + "-NN",) + key] = next(
+                    lbl for lbl, n in votes.items() if n == max_votes)
+
+            lbl_dists = {}
+            for _, v, lbl in row_lbl:
+                lbl_dists.setdefault(lbl, []).append(v)
+            for q in quantiles:
+                preds[(str(q) + "-quantile",) + key] = _first_min(dict(
+                    (lbl, sorted(vs)[int(q * len(vs))]) for lbl, vs in lbl_dists.items()))
+            preds[('AVG',) + key] = _first_min(dict(
+                (lbl, sum(vs) / len(vs)) for lbl, vs in lbl_dists.items()))
+            preds[('AVG-LOG',) + key] = _first_min(dict(
+                (lbl, sum(math.log(max(v, 1.0e-9)) for v in vs) / len(vs))
+                for lbl, vs in lbl_dists.items()))
+    return preds
+
+
+def test_classify_group(tmp_path):
+    db = _create_db(str(tmp_path / "test.db"))
+    # including Ks beyond the number of training sequences
+    ks = [1, 2, 3, 4, 5, 8, 13, 19, 40, 100]
+    quantiles = [0.0, 0.1, 0.25, 0.5, 0.75, 0.9]
+    preds = _predict(db, ks, quantiles)
+    expected = _reference(db, ks, quantiles)
+    assert(len(preds) == len(expected))
+    assert(preds == expected)
+
+
+def test_parse_ks():
+    assert(parse_ks([]) == [])
+    assert(parse_ks(['3']) == [3])
+    assert(parse_ks(['1-5']) == [1, 2, 3, 4, 5])
+    # overlapping ranges, out of order
+    assert(parse_ks(['10', '2-4', '3-6', '1']) == [1, 2, 3, 4, 5, 6, 10])
+
+
+def _predictions(fname):
+    db = sql.connect(fname)
+    rows = db.execute("SELECT predictor, lbltype, compid, ncd_formula, seqid, lbl "
+                      "FROM Predictions ORDER BY predictor, lbltype, compid, "
+                      "ncd_formula, seqid").fetchall()
+    db.close()
+    return rows
+
+
+def test_classify_script(tmp_path):
+    fname = str(tmp_path / "test.db")
+    _create_db(fname).close()
+    single_fname = str(tmp_path / "single.db")
+    shutil.copy(fname, single_fname)
+
+    # all of the predictors in one run
+    testutil.run_script("classify.py", fname, "--knn", "1-3", "8",
+                        "--quantile", "0", "0.5", "--avg", "--avg-log")
+    # ...and one at a time
+    for args in [["--knn", "1"], ["--knn", "2"], ["--knn", "3"], ["--knn", "8"],
+                 ["--quantile", "0"], ["--quantile", "0.5"], ["--avg"], ["--avg-log"]]:
+        testutil.run_script("classify.py", single_fname, *args)
+
+    rows = _predictions(fname)
+    assert(set(row[0] for row in rows) ==
+           {"1-NN", "2-NN", "3-NN", "8-NN", "0.0-quantile", "0.5-quantile", "AVG", "AVG-LOG"})
+    assert(rows == _predictions(single_fname))
+
+    # invalid arguments, which write nothing
+    for args in [[], ["--knn", "a"], ["--knn", "0-2"], ["--quantile", "1"],
+                 ["--quantile", "-0.5"]]:
+        assert("Error:" in testutil.run_script("classify.py", single_fname, *args, fail=True))
+    assert(rows == _predictions(single_fname))
@@ -2,6 +2,7 @@
 A script for clearing anything added to the DB
 from the following scripts:
 - compute_ncd.py
+- pairwise_dists.py
 - classify.py
 - results.py
 This script is handy if you'd like to recompute all results from
@@ -9,7 +9,8 @@ import numpy as np
 import tensorflow as tf
 from transformers import BertTokenizer, TFBertForMaskedLM
 from compressors.bnb_compression import (compress_serialisation, serialise_greedy,
-                                         serialise_l2r, serialise_cutting_sort)
+                                         serialise_l2r, serialise_cutting_sort,
+                                         reveal_masks)
 
 
 tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
@@ -43,7 +44,7 @@ if __name__ == "__main__":
 
     results = serialise_cutting_sort(_model, seqs, mask_value, pad_value, keep_start_end=True)
     cut_codes = compress_serialisation(_model, results[0], results[1], mask_value, 2)
-    printable_results = np.where(results[1] == 1, mask_value, results[0][np.newaxis, :, :])
+    printable_results = np.where(reveal_masks(results[1]) == 1, mask_value, results[0][np.newaxis, :, :])
 
     print("CUTTING SORT REVEAL ORDER")
     for seq in printable_results[:, 0, :]:
@@ -52,7 +53,7 @@ if __name__ == "__main__":
 
     results = serialise_greedy(_model, seqs, mask_value, pad_value, keep_start_end=True)
     greedy_codes = compress_serialisation(_model, results[0], results[1], mask_value, 2)
-    printable_results = np.where(results[1] == 1, mask_value, results[0][np.newaxis, :, :])
+    printable_results = np.where(reveal_masks(results[1]) == 1, mask_value, results[0][np.newaxis, :, :])
 
     print("GREEDY REVEAL ORDER")
     for seq in printable_results[:, 0, :]:
@@ -11,11 +11,23 @@ NOTE: might want auxiliary data like the chosen BERT masking procedure
 
 import os
 import time
+import pickle
+import shutil
+import hashlib
 import datetime
+import tempfile
+import itertools
+import functools
 import argparse as ap
 import sqlite3 as sql
+import multiprocessing as mp
+import numpy as np
 import progressbar as pgb
 import compressors as comp
+from compressors import Chain
+from seqstore import (
+    SequenceReader, PackedStore, infer_pair_format, write_packed_seqs, db_fingerprint
+)
 
 
 # compressors accept two arguments in the constructor:
@@ -60,28 +72,266 @@ def parse_config(config_str):
                     yield stmt[0], stmt[1]
 
 
-class SequenceIterator:
-    """Given a sequence of IDs, generate the actual sequences.
-    The main point of using this class rather than a Python
-    generator is for length calculation.
+def reader_factory(db, store_path=None, fingerprint=None):
+    """Get a function which maps a list of sequence IDs to an
+    iterator over those sequences, reading them either from the DB
+    or, if `store_path` is not None, from a packed store (see
+    `pack_db.py`).
+
+    Args:
+        fingerprint (str, optional): The DB's fingerprint (see
+                                     `db_fingerprint`), if it has
+                                     already been computed.
+
+    Raises:
+        ValueError: If the packed store is stale (see `PackedStore.check`).
+    """
+    if store_path is None:
+        return lambda ids: SequenceReader(db, ids)
+    else:
+        store = PackedStore(store_path)
+        store.check(db, fingerprint)
+        return store.reader
+
+
+def cached_stage_count(compressor):
+    """The number of leading stages of a `Chain` that can be cached (see
+    `Compressor.cache_key`). The last stage is never cached, since only
+    the sizes of its outputs are needed.
+    """
+    if not isinstance(compressor, Chain):
+        return 0
+    n = 0
+    for c in compressor.compressors[:-1]:
+        if c.cache_key() is None:
+            break
+        n += 1
+    return n
+
+
+def stage_cache_path(cache_dir, fingerprint, stages):
+    key = "\n".join([fingerprint] + [c.cache_key() for c in stages])
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest())
+
+
+def write_stage_cache(path, head, alphabet_size, iter_train, iter_val, read_seqs, ids,
+                      fingerprint):
+    """Train the leading stages of a chain, run them on all of the given
+    sequences, and save both to a stage cache directory: the trained
+    stages and their training time to `stages.pkl`, and their outputs
+    to a packed store (see `seqstore.write_packed_seqs`) in `outputs/`.
+    The cache is built in a temporary directory first, so a partial
+    cache is never used.
+
+    Args:
+        path (str): The cache directory (see `stage_cache_path`).
+        head (Chain): The (untrained) leading stages.
+        alphabet_size (int): The input alphabet size.
+        iter_train (nullary function): See `Compressor.train`.
+        iter_val (nullary function): See `Compressor.train`.
+        read_seqs (function): Maps a list of sequence IDs to an iterator
+                              over the sequences (see `reader_factory`).
+        ids (list of int): The IDs of the sequences to run the stages on,
+                           which are all of the DB's.
+        fingerprint (str): The DB's fingerprint (see `db_fingerprint`).
+    """
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        train_time_before = time.perf_counter()
+        head_alphabet_size = head.train(alphabet_size, iter_train, iter_val)
+        train_time = time.perf_counter() - train_time_before
+        write_packed_seqs(os.path.join(tmp_path, "outputs"), ids,
+                          head.compressmany(pgb.progressbar(read_seqs(ids))),
+                          head_alphabet_size, fingerprint)
+        with open(os.path.join(tmp_path, "stages.pkl"), "wb") as f:
+            pickle.dump((head, head_alphabet_size, train_time), f)
+    except BaseException:
+        shutil.rmtree(tmp_path)
+        raise
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another run has cached the same stages in the meantime
+        shutil.rmtree(tmp_path)
+
+
+def load_stage_cache(path):
+    """Load a stage cache written by `write_stage_cache`.
+
+    Returns:
+        A tuple `(head, alphabet_size, train_time, store_path)` of the
+        trained leading stages, their output alphabet size, the time it
+        took to train them (in seconds), and the packed store of their
+        outputs.
     """
-    def __init__(self, db, ids_iterator):
-        self.cur = db.cursor()
-        self.ids = ids_iterator
-        self.cur_id = None
+    with open(os.path.join(path, "stages.pkl"), "rb") as f:
+        head, alphabet_size, train_time = pickle.load(f)
+    return head, alphabet_size, train_time, os.path.join(path, "outputs")
 
-    def __len__(self):
-        return len(self.ids)
 
-    def __iter__(self):
-        self.cur_id = iter(self.ids)
-        return self
+def get_pair_groups(db):
+    """Get the paired sequences, grouped by their left sequence.
 
-    def __next__(self):
-        seqid = next(self.cur_id)
-        self.cur.execute("SELECT tokid FROM SequenceValues WHERE seqid = ? "
-                         "ORDER BY svidx ASC", (seqid,))
-        return list(map(lambda t: t[0], self.cur.fetchall()))
+    Returns:
+        A list of `(seqid_left, [(seqid_out, seqid_right), ...])` tuples.
+    """
+    cur = db.cursor()
+    cur.execute("SELECT seqid_left, seqid_out, seqid_right FROM SequencePairings "
+                "ORDER BY seqid_left, seqid_out")
+    return [(left, [row[1:] for row in rows])
+            for left, rows in itertools.groupby(cur.fetchall(), key=lambda t: t[0])]
+
+
+def compress_pair_group(seqs, compressor, left, pairs):
+    """Compress all of the pairs with the same left sequence, as a
+    common prefix (the left sequence and the comma) followed by each of
+    the right sequences, so that the compressor can reuse its work on
+    the prefix (see `Compressor.compressed_sizes_prefixed`).
+
+    Args:
+        seqs (dict): Maps the sequence IDs of the left sequence, the right
+                     sequences and the first pair to the sequences.
+        compressor (Compressor): The compressor.
+        left (int): The ID of the left sequence.
+        pairs (list): (seqid_out, seqid_right) tuples.
+
+    Returns:
+        A list of (seqid, compsz) tuples.
+    """
+    outs = [out for out, _ in pairs]
+    right_seqs = [seqs[right] for _, right in pairs]
+    # `pair_up.py` constructs all of the pairs of a DB in the same way, so
+    # this can be inferred from any one of them
+    pair_format = infer_pair_format(np.asarray(seqs[outs[0]]), np.asarray(seqs[left]),
+                                    np.asarray(right_seqs[0]))
+    if pair_format is None:
+        raise ValueError(f"Pair {outs[0]} is not a concatenation of its left "
+                         "and right sequences.")
+
+    comma_id, squash_start_end = pair_format
+    if squash_start_end:
+        prefix = seqs[left][:-1] + [comma_id]
+        suffixes = [right_seq[1:] for right_seq in right_seqs]
+    else:
+        prefix = seqs[left] + [comma_id]
+        suffixes = right_seqs
+    return list(zip(outs, compressor.compressed_sizes_prefixed(prefix, suffixes)))
+
+
+def compress_conditional_group(seqs, compressor, left, pairs):
+    """Compress each of the right sequences of the pairs with the same
+    left sequence, given the left sequence as context (see
+    `Compressor.compressed_sizes_conditional`). The pairs themselves are
+    never read.
+
+    Args:
+        seqs (dict): Maps the sequence IDs of the left sequence and the
+                     right sequences to the sequences.
+        compressor (Compressor): The compressor.
+        left (int): The ID of the left sequence.
+        pairs (list): (seqid_out, seqid_right) tuples.
+
+    Returns:
+        A list of (seqid, seqid_context, compsz) tuples.
+    """
+    rights = [right for _, right in pairs]
+    sizes = compressor.compressed_sizes_conditional(
+        seqs[left], [seqs[right] for right in rights])
+    return [(right, left, compsz) for right, compsz in zip(rights, sizes)]
+
+
+def compress_shard(read_seqs, compressor, seqids, pair_groups, conditional=False):
+    """Compress the given sequences, and the pairs of the given groups
+    (see `compress_pair_group`), or if `conditional` is True, the right
+    sequences of the groups given their left sequences (see
+    `compress_conditional_group`).
+
+    Returns:
+        A tuple `(sizes, conditional_sizes)` of lists of (seqid, compsz)
+        and (seqid, seqid_context, compsz) tuples respectively.
+    """
+    sizes, conditional_sizes = [], []
+    if len(seqids) > 0:
+        sizes.extend(zip(seqids, compressor.compressed_sizes(read_seqs(seqids))))
+    if len(pair_groups) > 0:
+        # the right sequences are shared between groups, so read all of
+        # the sequences needed by the shard at once
+        ids = sorted(set(itertools.chain.from_iterable(
+            [left] + ([] if conditional else [pairs[0][0]]) + [right for _, right in pairs]
+            for left, pairs in pair_groups)))
+        seqs = dict(zip(ids, read_seqs(ids)))
+        for left, pairs in pair_groups:
+            if conditional:
+                conditional_sizes.extend(compress_conditional_group(seqs, compressor, left, pairs))
+            else:
+                sizes.extend(compress_pair_group(seqs, compressor, left, pairs))
+    return sizes, conditional_sizes
+
+
+def make_shards(seqids, pair_groups, shard_sz):
+    """Split sequences and pair groups into (seqids, pair_groups) shards
+    of around `shard_sz` sequences each. Pair groups are not split.
+    """
+    shards = [(seqids[i:i + shard_sz], []) for i in range(0, len(seqids), shard_sz)]
+    shard, n = [], 0
+    for group in pair_groups:
+        shard.append(group)
+        n += len(group[1])
+        if n >= shard_sz:
+            shards.append(([], shard))
+            shard, n = [], 0
+    if len(shard) > 0:
+        shards.append(([], shard))
+    return shards
+
+
+# each worker process of `compress_parallel` holds its own sequence
+# reader and its own copy of the trained compressor, which are set
+# up once by `_init_worker`
+_worker_reader = None
+_worker_comp = None
+
+
+def _init_worker(db_fname, store_path, fingerprint, compressor):
+    global _worker_reader, _worker_comp
+    # (`--pipeline` reads the sequences in another thread)
+    _worker_reader = reader_factory(sql.connect(db_fname, check_same_thread=False),
+                                    store_path, fingerprint)
+    _worker_comp = compressor
+
+
+def _compress_shard(shard, conditional=False):
+    return compress_shard(_worker_reader, _worker_comp, *shard, conditional)
+
+
+def compress_parallel(db_fname, store_path, compressor, shards, workers,
+                      conditional=False, fingerprint=None):
+    """Compress the given shards (see `make_shards`) using a pool of
+    worker processes. Each shard is compressed by a single worker with
+    a single call to `compress_shard`, so the compressor contract is
+    unaffected.
+
+    Args:
+        db_fname (str): The DB filename, which each worker opens itself.
+        store_path (str): The packed store to read from, or None to read
+                          from the DB.
+        compressor (Compressor): A trained, picklable compressor. This
+                                 is shipped once to each worker.
+        shards (list): The units of work.
+        workers (int): The number of worker processes.
+        conditional (bool): Passed to `compress_shard`.
+        fingerprint (str, optional): Passed to `reader_factory`.
+
+    Returns:
+        An iterator over the results of `compress_shard`, in the same
+        order as `shards`.
+    """
+    with mp.Pool(workers, initializer=_init_worker,
+                 initargs=(db_fname, store_path, fingerprint, compressor)) as pool:
+        # `imap` yields results in the order of `shards`
+        yield from pgb.progressbar(
+            pool.imap(functools.partial(_compress_shard, conditional=conditional), shards),
+            max_value=len(shards))
 
 
 if __name__ == "__main__":
@@ -97,6 +347,39 @@ if __name__ == "__main__":
                         help="Optional configurations to pass "
                              "to model constructor. Must be a comma-"
                              "separated list of key=value pairs.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes to compress with. Not "
+                             "supported by deep compressors.")
+    parser.add_argument("--shard-sz", type=int, default=1024,
+                        help="Number of sequences given to a worker at a "
+                             "time, if `--workers` is greater than 1.")
+    parser.add_argument("--packed-store", type=str, default=None,
+                        help="If set, read the sequences from this packed "
+                             "store (see `pack_db.py`) rather than the DB.")
+    parser.add_argument("--pair-aware", action="store_true",
+                        help="Compress the pairs with the same left sequence "
+                             "together, so that compressors which support it "
+                             "(e.g. zlib and gzip) only compress the left "
+                             "sequence once. The sizes are unaffected.")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Run each stage of chained compressors in its own "
+                             "thread, so that e.g. the Huffman coding overlaps "
+                             "with bzip2 or lzma. Only applies to whole "
+                             "sequences (i.e. not to --pair-aware or "
+                             "--conditional pairs). The sizes are unaffected.")
+    parser.add_argument("--stage-cache", type=str, default=None,
+                        help="Directory to cache the trained leading stages of "
+                             "chained compressors in, along with their outputs on "
+                             "this DB (e.g. the Huffman coding shared by bzip2, "
+                             "gzip, lzma and zlib). Later runs with the same "
+                             "leading stages on the same sequences reuse them, "
+                             "and only train and run the remaining stages.")
+    parser.add_argument("--conditional", action="store_true",
+                        help="Rather than compressing the pairs, compress the "
+                             "right sequence of each pair with its left sequence "
+                             "as a preset dictionary, saving the sizes to "
+                             "`ConditionalCompressionSizes`. Only supported by "
+                             "some compressors (e.g. zlib).")
     args = parser.parse_args()
 
     if not os.path.isfile(args.db):
@@ -112,6 +395,22 @@ if __name__ == "__main__":
         print("Allowed values are:", ", ".join(COMPRESSORS.keys()))
         exit(-1)
 
+    if args.packed_store is not None and not os.path.isdir(args.packed_store):
+        print("Error:", args.packed_store, "is not a directory.")
+        exit(-1)
+
+    if args.stage_cache is not None and not os.path.isdir(args.stage_cache):
+        print("Error:", args.stage_cache, "is not a directory.")
+        exit(-1)
+
+    if args.workers < 1 or args.shard_sz < 1:
+        print("Error: --workers and --shard-sz must be positive.")
+        exit(-1)
+
+    if args.workers > 1 and args.compressor == 'bert':
+        print("Error: deep compressors cannot be run with --workers.")
+        exit(-1)
+
     config = dict(parse_config(args.comp_config))
     compname = args.compressor
     if len(config) > 0:
@@ -159,6 +458,16 @@ if __name__ == "__main__":
 
     # ITERATORS
 
+    store_path = args.packed_store
+    fingerprint = None
+    if store_path is not None or args.stage_cache is not None:
+        fingerprint = db_fingerprint(db)
+    try:
+        read_seqs = reader_factory(db, store_path, fingerprint)
+    except ValueError as e:
+        print("Error:", e)
+        exit(-1)
+
     def iterate_over_all():
         # it is very important that the ordering of the returned IDs
         # is not arbitrary
@@ -166,6 +475,12 @@ if __name__ == "__main__":
         cur.execute("SELECT seqid FROM Sequences ORDER BY seqid ASC")
         return list(map(lambda t: t[0], cur.fetchall()))
 
+    def iterate_over_singletons():
+        cur = db.cursor()
+        cur.execute("SELECT seqid FROM Sequences WHERE seqid NOT IN "
+                    "(SELECT seqid_out FROM SequencePairings) ORDER BY seqid ASC")
+        return list(map(lambda t: t[0], cur.fetchall()))
+
     def iterate_over_part(part, shuffle):
         cur = db.cursor()
         s = ("ORDER BY RANDOM()" if shuffle else "ORDER BY seqid ASC")
@@ -173,13 +488,13 @@ if __name__ == "__main__":
         return list(map(lambda t: t[0], cur.fetchall()))
 
     def iter_train():
-        return SequenceIterator(db, iterate_over_part(0, True))
+        return read_seqs(iterate_over_part(0, True))
 
     def iter_val():
-        return SequenceIterator(db, iterate_over_part(1, False))
+        return read_seqs(iterate_over_part(1, False))
 
     def iter_all():
-        return SequenceIterator(db, iterate_over_all())
+        return read_seqs(iterate_over_all())
 
     # NOW CONSTRUCT COMPRESSOR
 
@@ -190,10 +505,56 @@ if __name__ == "__main__":
         mask_value=mask_value, pad_value=pad_value,
         **config)
 
+    if args.conditional:
+        # check before training, since unsupported compressors raise
+        # as soon as this is called
+        try:
+            comp.compressed_sizes_conditional([], [])
+        except NotImplementedError:
+            print("Error:", args.compressor, "does not support --conditional.")
+            exit(-1)
+        # DBs created before `--conditional` was added lack the table
+        # (see `create_db.sql`)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS ConditionalCompressionSizes(
+                seqid INTEGER NOT NULL REFERENCES Sequences(seqid) ON DELETE CASCADE,
+                seqid_context INTEGER NOT NULL REFERENCES Sequences(seqid) ON DELETE CASCADE,
+                compid INTEGER NOT NULL REFERENCES Compressors(compid) ON DELETE CASCADE,
+                compsz INTEGER NOT NULL,
+                PRIMARY KEY(compid, seqid, seqid_context)
+            )
+        """)
+
+    # the cached leading stages of the compressor (if any) are reused,
+    # and the remaining stages are trained and run on their outputs
+    head = None
+    head_train_time = 0.0
+    n_cached = cached_stage_count(comp) if args.stage_cache is not None else 0
+    if n_cached > 0:
+        cache_path = stage_cache_path(args.stage_cache, fingerprint,
+                                      comp.compressors[:n_cached])
+        if not os.path.isdir(cache_path):
+            print("Training and running the leading stages for the stage cache...")
+            write_stage_cache(cache_path, Chain(comp.compressors[:n_cached]),
+                              alphabet_size, iter_train, iter_val,
+                              read_seqs, iterate_over_all(), fingerprint)
+        else:
+            print("Reusing the cached leading stages in", cache_path)
+        head, alphabet_size, head_train_time, store_path = load_stage_cache(cache_path)
+        comp = Chain(comp.compressors[n_cached:])
+        read_seqs = reader_factory(db, store_path, fingerprint)
+
     train_time_before = time.perf_counter()
     compd = comp.train(alphabet_size, iter_train, iter_val)
     train_time_after = time.perf_counter()
 
+    if head is not None and (args.pair_aware or args.conditional):
+        # these compress the pieces of the pairs separately, so they need
+        # the whole chain, on the original sequences
+        comp = Chain([head, comp])
+        store_path = args.packed_store
+        read_seqs = reader_factory(db, store_path, fingerprint)
+
     # SAVE THE COMPRESSOR'S METADATA
 
     # insert compressor type if not exists
@@ -211,26 +572,49 @@ if __name__ == "__main__":
             "VALUES(?, ?, ?)",
             [(compname, k, v) for k, v in config.items()]
         )
-    # insert compressor instance
+    # insert compressor instance (the training time of cached stages is
+    # the time they took when they were cached, so it doesn't depend on
+    # whether the cache was hit)
     cur.execute("""
         INSERT INTO Compressors(compid, compname, comprepeat,
                                 compdate, comp_train_time)
         VALUES (?, ?, ?, ?, ?)""",
         (compid, compname, comprepeat, compdate,
-         float(train_time_after - train_time_before)))
+         float(head_train_time + train_time_after - train_time_before)))
 
     # RUN THE COMPRESSOR ON THE ENTIRE DATASET, SAVE THE RESULTING COMPRESSION SIZES
 
     print("Compressing dataset...")
 
+    if args.pipeline and isinstance(comp, Chain):
+        comp.pipeline = True
+
     compress_time_before = time.perf_counter()
-    cur.executemany(
-        "INSERT INTO CompressionSizes(compid, seqid, compsz) VALUES (?, ?, ?)",
-        map(
-            lambda data_seqid: (compid, data_seqid[1], len(data_seqid[0])),
+    if args.pair_aware or args.conditional:
+        shards = make_shards(iterate_over_singletons(), get_pair_groups(db), args.shard_sz)
+    elif args.workers > 1:
+        shards = make_shards(iterate_over_all(), [], args.shard_sz)
+    if args.workers > 1:
+        results = compress_parallel(args.db, store_path, comp, shards,
+                                    args.workers, args.conditional, fingerprint)
+    elif args.pair_aware or args.conditional:
+        results = (compress_shard(read_seqs, comp, *shard, args.conditional)
+                   for shard in pgb.progressbar(shards, max_value=len(shards)))
+    else:
+        results = [(zip(
+            iterate_over_all(),
             # progressbar is hidden in here so it can access the __len__
-            zip(comp.compressmany(pgb.progressbar(iter_all())), iterate_over_all())
-        ))
+            comp.compressed_sizes(pgb.progressbar(iter_all()))
+        ), [])]
+    for sizes, conditional_sizes in results:
+        cur.executemany(
+            "INSERT INTO CompressionSizes(compid, seqid, compsz) VALUES (?, ?, ?)",
+            map(lambda seqid_sz: (compid,) + seqid_sz, sizes))
+        if args.conditional:  # (only then is the table known to exist)
+            cur.executemany(
+                "INSERT INTO ConditionalCompressionSizes(compid, seqid, seqid_context, compsz) "
+                "VALUES (?, ?, ?, ?)",
+                map(lambda seqids_sz: (compid,) + seqids_sz, conditional_sizes))
     compress_time_after = time.perf_counter()
 
     cur.execute(
@@ -0,0 +1,108 @@
+import os
+import pickle
+import sqlite3 as sql
+import testutil
+from pair_up import add_sequences, get_reflexive_sequences
+
+
+def _create_paired_db(tmp_path, baseline=False, squash_start_end=False):
+    fname = os.path.join(tmp_path, "test.db")
+    db = testutil.create_db(fname, baseline=baseline)
+    add_sequences(db, 16, get_reflexive_sequences(db), squash_start_end)
+    db.commit()
+    db.close()
+    return fname
+
+
+def test_baseline_db(tmp_path):
+    # DBs created before `--conditional` was added lack
+    # ConditionalCompressionSizes
+    fname = _create_paired_db(tmp_path, baseline=True)
+    model_dir = str(tmp_path)
+    testutil.run_script("compress.py", fname, model_dir, "gzip")
+    testutil.run_script("compute_ncd.py", fname)
+
+    db = sql.connect(fname)
+    assert(db.execute("SELECT COUNT(*) FROM CompressionSizes").fetchone()[0] == 80)
+    assert(db.execute("SELECT COUNT(DISTINCT seqid) FROM NCDValues").fetchone()[0] == 40)
+    db.close()
+
+    # which `--conditional` creates
+    testutil.run_script("compress.py", fname, model_dir, "zlib", "--conditional")
+    testutil.run_script("compute_ncd.py", fname)
+
+    db = sql.connect(fname)
+    assert(db.execute("SELECT COUNT(*) FROM ConditionalCompressionSizes").fetchone()[0] > 0)
+    db.close()
+
+
+def test_stage_cache_baseline_db(tmp_path):
+    # DBs created before virtual pairs were added lack VirtualPairings
+    fname = _create_paired_db(tmp_path, baseline=True)
+    model_dir = str(tmp_path)
+    cache_dir = os.path.join(tmp_path, "cache")
+    os.mkdir(cache_dir)
+    testutil.run_script("compress.py", fname, model_dir, "gzip")
+    for _ in range(2):  # training the cached stages, then reusing them
+        testutil.run_script("compress.py", fname, model_dir, "gzip", "--stage-cache", cache_dir)
+
+    (cache_path,) = os.listdir(cache_dir)
+    with open(os.path.join(cache_dir, cache_path, "stages.pkl"), "rb") as f:
+        _, _, head_train_time = pickle.load(f)
+
+    db = sql.connect(fname)
+    compids = [row[0] for row in db.execute("SELECT compid FROM Compressors ORDER BY compid")]
+    assert(len(compids) == 3)
+    sizes = [db.execute("SELECT seqid, compsz FROM CompressionSizes WHERE compid = ? "
+                        "ORDER BY seqid", (compid,)).fetchall()
+             for compid in compids]
+    assert(sizes[0] == sizes[1] == sizes[2])
+    # the reused stages count with the time they took to train
+    train_time = db.execute("SELECT comp_train_time FROM Compressors WHERE compid = ?",
+                            (compids[2],)).fetchone()[0]
+    assert(train_time >= head_train_time)
+    db.close()
+
+
+def _sizes(fname):
+    # the sizes of each compressor run, in order
+    db = sql.connect(fname)
+    sizes = [db.execute("SELECT seqid, compsz FROM CompressionSizes WHERE compid = ? "
+                        "ORDER BY seqid", (compid,)).fetchall()
+             for (compid,) in db.execute("SELECT compid FROM Compressors ORDER BY compid")]
+    db.close()
+    return sizes
+
+
+def test_pair_aware(tmp_path):
+    for squash_start_end in [False, True]:
+        path = os.path.join(tmp_path, "squash" + str(int(squash_start_end)))
+        os.mkdir(path)
+        fname = _create_paired_db(path, squash_start_end=squash_start_end)
+        # pairs of different sequences too, with several pairs sharing
+        # each left sequence
+        db = sql.connect(fname)
+        train = [row[0] for row in db.execute("SELECT seqid FROM Sequences "
+                                              "WHERE seqpart = 0 AND seq_is_pair = 0")]
+        add_sequences(db, 16, [(left, right, 0) for left in train[:5] for right in train
+                               if left != right], squash_start_end)
+        db.commit()
+        db.close()
+
+        testutil.run_script("compress.py", fname, path, "zlib")
+        testutil.run_script("compress.py", fname, path, "zlib", "--pair-aware")
+        sizes = _sizes(fname)
+        assert(len(sizes) == 2 and len(sizes[0]) > 80)
+        assert(sizes[0] == sizes[1])
+
+
+def test_pipeline_workers(tmp_path):
+    fname = _create_paired_db(tmp_path)
+    model_dir = str(tmp_path)
+    testutil.run_script("compress.py", fname, model_dir, "bzip2")
+    testutil.run_script("compress.py", fname, model_dir, "bzip2",
+                        "--pipeline", "--workers", "2", "--shard-sz", "16")
+
+    sizes = _sizes(fname)
+    assert(len(sizes) == 2 and len(sizes[0]) == 80)
+    assert(sizes[0] == sizes[1])
@@ -1,9 +1,30 @@
+import importlib
 from compressors.base import Compressor
-from compressors.chain import Chain
-from compressors.block import Block
-from compressors.huffman import Huffman
-from compressors.bert import BERT
-from compressors.bzip2 import BZ2
-from compressors.gzipc import GZip
-from compressors.lzmac import LZMA
-from compressors.zlibc import ZLib
+
+
+# compressor classes are only imported on first use (PEP 562), so that
+# e.g. using a stdlib compressor doesn't import TensorFlow via `BERT`
+_LAZY_COMPRESSORS = {
+    'Chain': 'compressors.chain',
+    'Block': 'compressors.block',
+    'Huffman': 'compressors.huffman',
+    'BERT': 'compressors.bert',
+    'BZ2': 'compressors.bzip2',
+    'GZip': 'compressors.gzipc',
+    'LZMA': 'compressors.lzmac',
+    'ZLib': 'compressors.zlibc',
+}
+
+__all__ = ['Compressor'] + list(_LAZY_COMPRESSORS.keys())
+
+
+def __getattr__(name):
+    if name not in _LAZY_COMPRESSORS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    cls = getattr(importlib.import_module(_LAZY_COMPRESSORS[name]), name)
+    globals()[name] = cls  # cache, so this is only called once per name
+    return cls
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + list(_LAZY_COMPRESSORS.keys()))
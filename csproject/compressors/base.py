@@ -1,4 +1,20 @@
 import abc
+import numpy as np
+
+
+def as_bytes(seq):
+    """Get a bytes-like object of a sequence of byte-sized tokens, for
+    compressors with a byte alphabet. `bytes`, `bytearray`, `memoryview`
+    and contiguous `np.uint8` arrays are passed through without copying;
+    other NumPy arrays are cast (NOTE: `bytes` of a NumPy array gives its
+    raw buffer, so e.g. an `np.int32` array would be 4 bytes per token).
+    """
+    if isinstance(seq, (bytes, bytearray, memoryview)):
+        return seq
+    elif isinstance(seq, np.ndarray):
+        return np.ascontiguousarray(seq, dtype=np.uint8)
+    else:
+        return bytes(seq)
 
 
 class Compressor(abc.ABC):
@@ -34,12 +50,17 @@ class Compressor(abc.ABC):
         """Compress a single integer sequence of tokens.
 
         Args:
-            seq (list of int): The sequence to compress.
+            seq (list of int): The sequence to compress. This may be any
+                               sequence of ints, including a NumPy array,
+                               or for byte-sized alphabets a bytes-like
+                               object (see `as_bytes`).
         
         Returns:
             The compressed sequence, as a list of ints, but possibly with
             a different alphabet size, as dictated by the return value of
-            `train`.
+            `train`. Compressors with a byte-sized output alphabet may
+            return `bytes` instead, so that chains of them don't need to
+            construct a Python int per token.
         """
         pass
 
@@ -65,6 +86,87 @@ class Compressor(abc.ABC):
         return map(self.compress, seqs)
 
 
+    def compressed_size(self, seq):
+        """The length of `compress(seq)`. Base classes should override
+        this if they can compute it without constructing the output.
+        """
+        return len(self.compress(seq))
+
+
+    def compressed_sizes(self, seqs):
+        """The lengths of the outputs of `compressmany(seqs)`, in the
+        same order. As with `compressed_size`, base classes should
+        override this if they can avoid constructing the outputs.
+        """
+        return map(len, self.compressmany(seqs))
+
+
+    def compressmany_prefixed(self, prefix, suffixes):
+        """Compress the concatenation of a common prefix with each of a
+        collection of suffixes, e.g. all of the pairs with the same left
+        sequence. Base classes may be able to optimise this method by
+        only processing the prefix once, but the output must be the same
+        as that of `compressmany` on the concatenated sequences.
+
+        Args:
+            prefix (list of int): The prefix of every sequence.
+            suffixes (Iterator over integer sequences): The suffixes.
+
+        Returns:
+            An iterator over (the compressed) integer sequences, in the
+            same order as `suffixes`.
+        """
+        prefix = list(prefix)
+        return self.compressmany(map(lambda s: prefix + list(s), suffixes))
+
+
+    def compressmany_conditional(self, context, seqs):
+        """Compress each of a collection of sequences given a common
+        context sequence, e.g. using the context as a preset dictionary,
+        so that the size of each output approximates C(seq | context)
+        without compressing the concatenation. Not every compressor
+        supports this, in which case this raises `NotImplementedError`
+        as soon as it is called.
+
+        Args:
+            context (list of int): The context sequence.
+            seqs (Iterator over integer sequences): The sequences.
+
+        Returns:
+            An iterator over (the compressed) integer sequences, in the
+            same order as `seqs`.
+        """
+        raise NotImplementedError(
+            f"{type(self).__name__} does not support conditional compression.")
+
+
+    def compressed_sizes_prefixed(self, prefix, suffixes):
+        """The lengths of the outputs of `compressmany_prefixed`."""
+        return map(len, self.compressmany_prefixed(prefix, suffixes))
+
+
+    def compressed_sizes_conditional(self, context, seqs):
+        """The lengths of the outputs of `compressmany_conditional`."""
+        return map(len, self.compressmany_conditional(context, seqs))
+
+
+    def concatenative(self):
+        """Whether compressing the concatenation of two sequences gives
+        the concatenation of their compressions, which allows `Chain`
+        to pass prefixes through this compressor separately.
+        """
+        return False
+
+
+    def cache_key(self):
+        """A string identifying this compressor's configuration, such
+        that compressors with the same key give the same outputs when
+        trained on the same data (see `compress.py --stage-cache`), or
+        None if its trained state shouldn't be cached.
+        """
+        return None
+
+
     def fine_tuning_method(self):
         return None
 
@@ -0,0 +1,69 @@
+"""
+Scheduling of variable-length sequences into batches for a model,
+e.g. the chopped sequences compressed by `BERT`.
+"""
+
+
+import itertools
+
+
+def bucketed_batches(lengths, max_tokens):
+    """Group items of the given lengths into batches of similar lengths,
+    such that the padded size of each batch (its number of items times
+    its longest length) is at most `max_tokens`, except that an item
+    longer than that gets a batch of its own.
+
+    Args:
+        lengths (list of int): The length of each item.
+        max_tokens (int): The token budget of each batch.
+
+    Returns:
+        A list of batches, each a list of indices into `lengths`.
+    """
+    batches = []
+    batch = []
+    # in order of length, so each new item is the longest of its batch
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        if len(batch) > 0 and (len(batch) + 1) * lengths[i] > max_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def bucketed_map(f, items, max_tokens, window=256, length=len):
+    """Apply a batched function to a (potentially very long) stream of
+    items, batching together items of similar lengths, and return the
+    results in the same order as the items.
+
+    The items are read a window at a time, and each window is split into
+    batches by `bucketed_batches`. So the batches are large when the
+    items are short, little of each batch is padding, and there are no
+    dummy items to fill up the last batch.
+
+    Args:
+        f (callable): Maps a list of items to a list of their results,
+                      in the same order.
+        items (iterable): The items.
+        max_tokens (int): The token budget of each batch.
+        window (int, optional): The number of items to read ahead, and
+                                choose batches from.
+        length (callable, optional): The length of an item.
+
+    Returns:
+        An iterator over the results of each item.
+    """
+    items = iter(items)
+    while True:
+        pending = list(itertools.islice(items, window))
+        if len(pending) == 0:
+            return
+        results = [None] * len(pending)
+        for batch in bucketed_batches([length(x) for x in pending], max_tokens):
+            batch_results = list(f([pending[i] for i in batch]))
+            assert(len(batch_results) == len(batch))
+            for i, result in zip(batch, batch_results):
+                results[i] = result
+        yield from results
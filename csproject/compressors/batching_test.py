@@ -0,0 +1,26 @@
+import numpy as np
+from compressors.batching import bucketed_batches, bucketed_map
+
+
+def test_bucketed_batches():
+    lengths = np.random.default_rng(0).integers(1, 100, size=500).tolist()
+    batches = bucketed_batches(lengths, 256)
+    assert(sorted(i for batch in batches for i in batch) == list(range(500)))
+    for batch in batches:
+        assert(len(batch) * max(lengths[i] for i in batch) <= 256)
+    # items which don't fit in the budget get their own batch
+    assert(bucketed_batches([300, 5, 400, 5], 256) == [[1, 3], [0], [2]])
+    assert(bucketed_batches([], 256) == [])
+
+
+def test_bucketed_map():
+    rng = np.random.default_rng(0)
+    items = [rng.integers(0, 10, size=rng.integers(1, 50)).tolist() for _ in range(300)]
+    batches = []
+    def f(batch):
+        batches.append(batch)
+        return [sum(x) for x in batch]
+    results = bucketed_map(f, iter(items), 100, window=64)
+    assert(list(results) == [sum(x) for x in items])
+    assert(all(len(b) * max(map(len, b)) <= 100 for b in batches))
+    assert(list(bucketed_map(f, [], 100)) == [])
@@ -12,6 +12,7 @@ been tokenised in exactly the same way, or the tokeniser won't work.
 
 
 import os
+import itertools
 import numpy as np
 import tensorflow as tf
 
@@ -22,6 +23,7 @@ for gpu in gpus:
 
 from transformers import BertTokenizer, TFBertForMaskedLM, BertConfig
 from compressors.base import Compressor
+from compressors.batching import bucketed_map
 import compressors.bnb_compression as bnb_compression
 import masking
 
@@ -51,18 +53,52 @@ def _chop(s, max_len):
         yield [s[0]] + buf + [s[-1]]
 
 
-def _reverse_mask_arrays(mask_arrays):
-    # swap order
-    rev = np.copy(mask_arrays)[::-1, :, :]
-    # swap mask and keep
-    rev = 1 - rev
+def _pack(xs, pad_value, width):
+    """Pack the rows of a padded batch side by side into (fewer) rows of
+    the given width, in order, starting a new row whenever the next one
+    doesn't fit.
+
+    Args:
+        xs (np.ndarray): A batch of shape (rows, len), where each row is
+                         padded at the end with `pad_value`.
+        pad_value (int): The padding value.
+        width (int): The width of the packed rows (at least as long as
+                     any unpadded row).
+
+    Returns:
+        A 4-tuple of the packed batch (padded with `pad_value`), the
+        position of each token in its original row, the segment of each
+        token (0 for padding, else its original row plus one), and a pair
+        `(src, dst)` of index tuples, such that `packed[dst] = xs[src]`.
+    """
+    lengths = np.sum(xs != pad_value, axis=-1)
+    assert(np.all(lengths <= width))
+    rows = np.zeros(xs.shape[0], dtype=np.int64)
+    offsets = np.zeros(xs.shape[0], dtype=np.int64)
+    row, used = 0, 0
+    for i, n in enumerate(lengths.tolist()):
+        if used + n > width:
+            row, used = row + 1, 0
+        rows[i], offsets[i] = row, used
+        used += n
+
+    src = np.nonzero(np.arange(xs.shape[1]) < lengths[:, np.newaxis])
+    dst = (rows[src[0]], offsets[src[0]] + src[1])
+    packed = np.full((row + 1, width), pad_value, dtype=xs.dtype)
+    packed[dst] = xs[src]
+    positions = np.zeros(packed.shape, dtype=np.int32)
+    positions[dst] = src[1]
+    segments = np.zeros(packed.shape, dtype=np.int32)
+    segments[dst] = src[0] + 1
+    return packed, positions, segments, (src, dst)
+
+
+def _reverse_reveal_order(order):
+    # swap order: a token revealed at timestep t is now revealed at
+    # n_steps - t, so stays masked for as long as it was unmasked
     # but: initial states needs to be preserved
-    rev = np.where(mask_arrays[:1, :, :] == 0, 0, rev)
-    # some checks:
-    assert(np.all(rev[0, :, :] == mask_arrays[0, :, :]))
-    assert(np.all(rev[1:] - rev[:-1] <= 0))
-    assert(np.all(rev[-1, :, :] == 0))
-    return rev
+    steps = np.where(order.steps == 0, 0, order.n_steps - order.steps)
+    return bnb_compression.RevealOrder(steps, order.n_steps)
 
 
 class BERT(Compressor):
@@ -72,6 +108,8 @@ class BERT(Compressor):
                  batch_sz_train=32, batch_sz_comp=8,
                  max_len_train=128, max_len_comp=512,
                  blocking=16, chunking=1, num_epochs=4,
+                 max_tokens_comp=None, batch_tokens_comp=None,
+                 bucket_window_comp=256, pack_comp=False,
                  learning_rate=1.0e-3,
                  train_repeat=0, out_alphabet_sz=2,
                  reverse_order=False, masking_prop=0.5):
@@ -91,6 +129,20 @@ class BERT(Compressor):
             train_repeat (int, optional): The index of the repeat of this training experiment.
             out_alphabet_sz (int, optional): The output alphabet size. Defaults to 2.
             reverse_order (bool, optional): If true, reverse the order of the compression method.
+            max_tokens_comp (int, optional): If not None, the masked inputs of several
+                                             timesteps are stacked into each forward pass
+                                             when compressing, up to this many tokens
+                                             (see `compress_serialisation`).
+            batch_tokens_comp (int, optional): The token budget of each batch of
+                                               chopped sequences when compressing
+                                               (see `bucketed_batches`). Defaults to
+                                               `batch_sz_comp * max_len_comp`.
+            bucket_window_comp (int, optional): The number of chopped sequences to
+                                                choose batches of similar lengths from.
+            pack_comp (bool, optional): If true, when compressing, pack the (short)
+                                        sequences of each model call side by side into
+                                        rows of length `max_len_comp`, with an attention
+                                        mask which stops them attending to each other.
         """
         assert (init_state in INIT_STATE)
         assert (fine_tuning in FINE_TUNING)
@@ -119,6 +171,12 @@ class BERT(Compressor):
         self.blocking = blocking
         self.chunking = chunking
         self.num_epochs = num_epochs
+        self.max_tokens_comp = max_tokens_comp
+        if batch_tokens_comp is None:
+            batch_tokens_comp = batch_sz_comp * max_len_comp
+        self.batch_tokens_comp = batch_tokens_comp
+        self.bucket_window_comp = bucket_window_comp
+        self.pack_comp = pack_comp
         self.learning_rate = learning_rate
         self.masking_prop = masking_prop
 
@@ -144,13 +202,71 @@ class BERT(Compressor):
         )
 
 
-    def _call_model(self, xs):
+    def _logits(self, xs):
         assert (self._model_obj is not None)
-        return tf.nn.softmax(self._model_obj(
+        return self._model_obj(
             input_ids=xs,
             # don't attend to padding tokens:
             attention_mask=np.where(xs == self.pad_value, 0, 1)
-        ).logits, axis=-1).numpy()
+        ).logits
+
+
+    def _packed_logits(self, xs, positions, segments):
+        # as `_logits`, but for a batch packed by `_pack`: the main layer
+        # only takes (batch, len) attention masks, so its parts are run
+        # directly, with a block-diagonal (batch, 1, len, len) mask
+        assert (self._model_obj is not None)
+        bert = self._model_obj.bert
+        attend = np.logical_and(segments[:, np.newaxis, :, np.newaxis] == segments[:, np.newaxis, np.newaxis, :],
+                                segments[:, np.newaxis, np.newaxis, :] != 0)
+        embeddings = bert.embeddings(input_ids=xs, position_ids=positions,
+                                     token_type_ids=tf.zeros_like(xs))
+        hidden = bert.encoder(
+            hidden_states=embeddings,
+            # (as the main layer does with its masks)
+            attention_mask=tf.cast(np.where(attend, 0.0, -10000.0), embeddings.dtype),
+            head_mask=[None] * bert.config.num_hidden_layers,
+            encoder_hidden_states=None, encoder_attention_mask=None,
+            past_key_values=None, use_cache=False, output_attentions=False,
+            output_hidden_states=False, return_dict=True
+        ).last_hidden_state
+        return self._model_obj.mlm(sequence_output=hidden)
+
+
+    def _per_token(self, xs, targets, reduce):
+        # reduce the logits at each position of `xs` to a single value
+        # with `reduce(logits, targets)`, packing the batch first if
+        # `pack_comp` (in which case padding is given the value 0)
+        if not self.pack_comp:
+            return reduce(self._logits(xs), targets).numpy()
+        packed, positions, segments, (src, dst) = _pack(xs, self.pad_value, self.max_len_comp)
+        packed_targets = np.zeros_like(packed)
+        packed_targets[dst] = targets[src]
+        values = reduce(self._packed_logits(packed, positions, segments), packed_targets).numpy()
+        result = np.zeros(xs.shape, dtype=values.dtype)
+        result[src] = values[dst]
+        return result
+
+
+    def _call_model(self, xs):
+        return tf.nn.softmax(self._logits(xs), axis=-1).numpy()
+
+
+    def _call_model_log_probs(self, xs, targets):
+        # only the log-probabilities of `targets` are copied back from
+        # the device, i.e. (batch, seq_len) rather than the full
+        # (batch, seq_len, vocab) distributions
+        return self._per_token(xs, targets, lambda logits, targets: (
+            tf.gather(logits, targets, batch_dims=2) -
+            tf.reduce_logsumexp(logits, axis=-1)))
+
+
+    def _call_model_entropies(self, xs):
+        # as for `_call_model_log_probs`, but the entropy at each position
+        def entropies(logits, _):
+            log_ps = tf.nn.log_softmax(logits, axis=-1)
+            return -tf.reduce_sum(tf.math.multiply_no_nan(log_ps, tf.exp(log_ps)), axis=-1)
+        return self._per_token(xs, xs, entropies)
 
 
     def train(self, alphabet_size, iter_train, iter_val):
@@ -180,88 +296,82 @@ class BERT(Compressor):
 
 
     def compress(self, seq):
-        return self.compressmany([seq])[0]
+        return next(self.compressmany([seq]))
 
 
     def compressmany(self, seqs):
-        chopped_seqs = map(list, map(
-            lambda s: _chop(s, self.max_len_comp),
-            seqs))
-
-        csbuf = []  # chopped sequence buffer
-        cslenq = []  # FIFO queue containing integers, corresponding to number of elements to read from `csbuf`
-        codebuf = []  # buffer containing the resulting codes
-        for cs in chopped_seqs:
-            csbuf += cs
-            cslenq.append(len(cs))
-
-            # while we can run the model on new data
-            while len(csbuf) >= self.batch_sz_comp:
-                # compress available data
-                codebuf += self._compress_batch(csbuf[:self.batch_sz_comp])
-                # reduce buffer
-                csbuf = csbuf[self.batch_sz_comp:]
-
-            # while we can extract data from the output of the model
-            while len(cslenq) > 0 and len(codebuf) >= cslenq[0]:
-                # concatenate the first `cslenq[0]` codes:
-                result_code = [c for code in codebuf[:cslenq[0]] for c in code]
-                yield result_code
-                codebuf = codebuf[cslenq[0]:]
-                cslenq = cslenq[1:]
-
-        # there may still be data left over to yield
-        if len(cslenq) > 0:
-            assert(len(csbuf) > 0)
-            # arbitrarily extend `csbuf` to fit the batch size
-            csbuf += [csbuf[0]] * (self.batch_sz_comp - len(csbuf))
-            # compress it
-            codebuf += self._compress_batch(csbuf)
-            # empty it (not actually necessary)
-            csbuf = []
-
-            # yield all of the remaining results
-            while len(cslenq) > 0:
-                assert(len(codebuf) >= cslenq[0])
-                # concatenate the first `cslenq[0]` codes:
-                result_code = [c for code in codebuf[:cslenq[0]] for c in code]
-                yield result_code
-                codebuf = codebuf[cslenq[0]:]
-                cslenq = cslenq[1:]
-
-
-    def _compress_batch(self, seqs):
+        return self._compressmany(seqs, sizes_only=False)
+
+
+    def compressed_size(self, seq):
+        return next(self.compressed_sizes([seq]))
+
+
+    def compressed_sizes(self, seqs):
+        # the codes are never generated, only their lengths
+        return self._compressmany(seqs, sizes_only=True)
+
+
+    def _compressmany(self, seqs, sizes_only):
+        # the codes of the chopped pieces of each sequence are
+        # concatenated (or if `sizes_only`, their lengths are summed)
+        if sizes_only:
+            join = sum
+        else:
+            join = lambda codes: [c for code in codes for c in code]
+
+        # the chopped pieces of all of the sequences, each with the
+        # index of the sequence it came from
+        pieces = ((i, piece) for i, s in enumerate(seqs)
+                  for piece in _chop(s, self.max_len_comp))
+
+        def compress_pieces(batch):
+            codes = self._compress_batch([piece for _, piece in batch], sizes_only)
+            return [(i, code) for (i, _), code in zip(batch, codes)]
+
+        codes = bucketed_map(compress_pieces, pieces, self.batch_tokens_comp,
+                             window=self.bucket_window_comp,
+                             length=lambda p: len(p[1]))
+        for _, seq_codes in itertools.groupby(codes, key=lambda c: c[0]):
+            yield join([code for _, code in seq_codes])
+
+
+    def _compress_batch(self, seqs, sizes_only=False):
         seqs = list([np.array(xs, dtype=np.int32) for xs in seqs])
 
         # check dimensions of input
-        assert(len(seqs) == self.batch_sz_comp)
+        assert(len(seqs) > 0)
         largest_seq = max(map(len, seqs))
         assert(largest_seq <= self.max_len_comp)
 
         if self.comp == 'L2R':
-            seqs, mask_arrays = bnb_compression.serialise_l2r(
+            seqs, order = bnb_compression.serialise_l2r(
                 seqs, self.pad_value, keep_start_end=True,
                 blocking=self.blocking
             )
         elif self.comp == 'cutting-sort':
-            seqs, mask_arrays = bnb_compression.serialise_cutting_sort(
-                self._call_model, seqs, self.mask_value, self.pad_value,
+            seqs, order = bnb_compression.serialise_cutting_sort(
+                self._call_model_entropies, seqs, self.mask_value, self.pad_value,
                 keep_start_end=True,
-                blocking=self.blocking
+                blocking=self.blocking,
+                entropies=True
             )
         elif self.comp == 'greedy':
-            seqs, mask_arrays = bnb_compression.serialise_greedy(
-                self._call_model, seqs, self.mask_value, self.pad_value,
+            seqs, order = bnb_compression.serialise_greedy(
+                self._call_model_entropies, seqs, self.mask_value, self.pad_value,
                 keep_start_end=True,
-                blocking=self.blocking
+                blocking=self.blocking,
+                entropies=True
             )
 
         if self.reverse:
-            mask_arrays = _reverse_mask_arrays(mask_arrays)
+            order = _reverse_reveal_order(order)
 
         codes = bnb_compression.compress_serialisation(
-            self._call_model, seqs, mask_arrays, self.mask_value,
-            self._out_alphabet_sz, chunking=self.chunking
+            self._call_model_log_probs, seqs, order, self.mask_value,
+            self._out_alphabet_sz, chunking=self.chunking,
+            sizes_only=sizes_only, log_probs=True,
+            max_batch_tokens=self.max_tokens_comp
         )
         return codes
 
@@ -0,0 +1,78 @@
+import tempfile
+import numpy as np
+import tensorflow as tf
+from transformers import TFBertForMaskedLM, BertConfig
+from compressors.bert import BERT, _pack
+
+
+def test_pack():
+    xs = np.array([
+        [5, 6, 7, 0],
+        [8, 0, 0, 0],
+        [1, 2, 3, 4],
+        [9, 9, 0, 0]
+    ], dtype=np.int32)
+    packed, positions, segments, (src, dst) = _pack(xs, 0, 5)
+    assert(np.all(packed == np.array([
+        [5, 6, 7, 8, 0],
+        [1, 2, 3, 4, 0],
+        [9, 9, 0, 0, 0]
+    ])))
+    assert(np.all(positions == np.array([
+        [0, 1, 2, 0, 0],
+        [0, 1, 2, 3, 0],
+        [0, 1, 0, 0, 0]
+    ])))
+    assert(np.all(segments == np.array([
+        [1, 1, 1, 2, 0],
+        [3, 3, 3, 3, 0],
+        [4, 4, 0, 0, 0]
+    ])))
+    # values computed on the packed batch can be put back
+    unpacked = np.zeros_like(xs)
+    unpacked[src] = packed[dst]
+    assert(np.all(unpacked == xs))
+
+
+def _tiny_bert(pad_value=0, mask_value=1, vocab_size=20):
+    # a small randomly initialised BERT, and a padded batch of
+    # sequences of different lengths
+    tf.random.set_seed(0)
+    rng = np.random.default_rng(0)
+    bert = BERT(tempfile.gettempdir(), "tiny-bert", mask_value=mask_value,
+                pad_value=pad_value, max_len_comp=32)
+    bert._model_obj = TFBertForMaskedLM(config=BertConfig(
+        vocab_size=vocab_size, hidden_size=16, num_hidden_layers=2,
+        num_attention_heads=2, intermediate_size=32, max_position_embeddings=32))
+    lengths = [3, 12, 7, 5, 9, 2, 11]
+    xs = np.full((len(lengths), max(lengths)), pad_value, dtype=np.int32)
+    for i, n in enumerate(lengths):
+        xs[i, :n] = rng.integers(2, vocab_size, size=(n,))
+    targets = rng.integers(0, vocab_size, size=xs.shape).astype(np.int32)
+    return bert, xs, targets
+
+
+def test_packed_logits():
+    bert, xs, targets = _tiny_bert()
+    # (several sequences share each packed row)
+    assert(_pack(xs, bert.pad_value, bert.max_len_comp)[0].shape[0] < xs.shape[0])
+    results = []
+    for pack_comp in [False, True]:
+        bert.pack_comp = pack_comp
+        results.append((bert._call_model_log_probs(xs, targets),
+                        bert._call_model_entropies(xs)))
+    not_pad = xs != bert.pad_value
+    for unpacked, packed in zip(*results):
+        assert(np.allclose(unpacked[not_pad], packed[not_pad], atol=1.0e-5))
+
+
+def test_log_probs_entropies():
+    # the reductions on the device against the full distributions
+    bert, xs, targets = _tiny_bert()
+    ps = bert._call_model(xs)
+    log_probs = bert._call_model_log_probs(xs, targets)
+    assert(np.allclose(np.exp(log_probs),
+                       np.take_along_axis(ps, targets[:, :, np.newaxis], axis=-1)[:, :, 0],
+                       atol=1.0e-6))
+    assert(np.allclose(bert._call_model_entropies(xs),
+                       -np.sum(ps * np.log(ps), axis=-1), atol=1.0e-5))
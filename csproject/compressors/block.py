@@ -60,3 +60,11 @@ class Block(Compressor):
 
     def compressmany(self, seqs):
         return super(self).compressmany(seqs)
+
+
+    def compressed_size(self, seq):
+        return -(-len(seq) // self.n)  # one token per (possibly partial) block
+
+
+    def compressed_sizes(self, seqs):
+        return map(self.compressed_size, seqs)
@@ -4,29 +4,68 @@ compression based on probabilistic models, possibly
 using the B&B techniques.
 
 The methods starting with `serialise_` will return
-a `mask_arrays` numpy array, which can then be passed
-directly to `compress_serialisation` which turns it
-into a sequence of codes.
+a `RevealOrder`, which can then be passed directly to
+`compress_serialisation` which turns it into a sequence
+of codes.
 """
 
 
+import collections
 import numpy as np
 from bnb import padded_batch, cut_sort, greedy_order
 from compressors.coding import huffman_codebook
 
 
-def _block_mask_arrays(mask_arrays, blocking):
+# the order in which the tokens of a batch are revealed: `steps` is an
+# integral array of shape (batch-size, seq-len) giving the timestep at
+# which each token is revealed (0 for those which are never masked, like
+# padding), out of `n_steps` timesteps. this is equivalent to the
+# (n_steps, batch-size, seq-len) array of masks given by `reveal_masks`,
+# but only takes O(batch-size x seq-len) memory
+RevealOrder = collections.namedtuple('RevealOrder', ['steps', 'n_steps'])
+
+
+def reveal_masks(order):
+    """The masks of each timestep of a `RevealOrder`, as a binary array
+    of shape (n_steps, batch-size, seq-len), where 1 denotes masking.
+    """
+    timesteps = np.arange(order.n_steps)[:, np.newaxis, np.newaxis]
+    return (order.steps[np.newaxis, :, :] > timesteps).astype(np.int32)
+
+
+def _block_reveal_order(order, blocking):
     if blocking == 1 or blocking is None:
-        return mask_arrays
+        return order
 
-    # select masking arrays in steps of size `blocking`
-    rng = list(range(0, mask_arrays.shape[0], blocking))
+    # select timesteps in steps of size `blocking`
+    rng = list(range(0, order.n_steps, blocking))
     # but it is crucial that we sample the first and the last:
     if rng[0] != 0:
         rng = [0] + rng
-    if rng[-1] != mask_arrays.shape[0] - 1:
-        rng = rng + [mask_arrays.shape[0] - 1]
-    return mask_arrays[rng]
+    if rng[-1] != order.n_steps - 1:
+        rng = rng + [order.n_steps - 1]
+    # each token is now revealed at the first selected timestep
+    # at or after its original one
+    return RevealOrder(np.searchsorted(rng, order.steps), len(rng))
+
+
+def _ordered_reveal_order(idxs, init_keep, n_steps):
+    """The `RevealOrder` which reveals the masked tokens of each sequence
+    one at a time, in the order given by `idxs` (the positions of each
+    sequence, in order), over `n_steps` timesteps. Tokens missing from
+    `idxs` are revealed with the last of their sequence, and any tokens
+    left over at the last timestep are revealed then.
+    """
+    rows = np.broadcast_to(np.arange(idxs.shape[0])[:, np.newaxis], idxs.shape)
+    # the number of masked positions up to and including each one
+    # in the order, which is the timestep at which it is revealed
+    masked = init_keep[rows, idxs]
+    rank = np.cumsum(masked, axis=-1)
+    steps = np.where(init_keep == 1, rank[:, -1:], 0)
+    # (a position may be repeated in `idxs`, in which case it is
+    # revealed at its first occurrence)
+    np.minimum.at(steps, (rows, idxs), np.where(masked == 1, rank, steps.shape[1] + 1))
+    return RevealOrder(np.minimum(steps, n_steps - 1), n_steps)
 
 
 def _keep_start_end(seqs, init_keep):
@@ -34,7 +73,9 @@ def _keep_start_end(seqs, init_keep):
     keep set. This is important, as models are allowed to
     condition on such information for free.
     """
-    seq_lens = np.array(list(map(len, seqs)), dtype=np.int32)
+    # (`seqs` is a padded batch, and only its non-padding tokens are
+    # initially masked)
+    seq_lens = np.sum(init_keep, axis=-1)
     sep_symbol = seqs[0, seq_lens[0] - 1]
     start_symbol = seqs[0, 0]
     # condition on ALL occurrences of the special symbols!
@@ -71,33 +112,29 @@ def serialise_l2r(seqs, pad_value,
 
     Returns:
         A 2-tuple containing the padded batch of sequences to run the
-        model on, and the list of masking matrices. These parameters
-        should be passed directly to `compress_serialisation`.
+        model on, and the `RevealOrder`. These parameters should be
+        passed directly to `compress_serialisation`.
     """
     seqs, init_keep = padded_batch(seqs, pad_value, min_length=min_length)
     if keep_start_end:
         init_keep = _keep_start_end(seqs, init_keep)
 
-    mask_arrays = np.zeros((seqs.shape[1] + 1, seqs.shape[0], seqs.shape[1]), dtype=np.int32)
-    mask_arrays[0] = init_keep
-    for i in range(1, mask_arrays.shape[0]):
-        # at timestep i, copy the state from the last timestep
-        # but reveal token i-1
-        mask_arrays[i] = mask_arrays[i - 1]
-        mask_arrays[i, :, i - 1] = 0
-    return seqs, _block_mask_arrays(mask_arrays, blocking)
+    # at timestep i, reveal token i-1
+    steps = np.where(init_keep == 1, np.arange(1, seqs.shape[1] + 1), 0)
+    order = RevealOrder(steps, seqs.shape[1] + 1)
+    return seqs, _block_reveal_order(order, blocking)
 
 
 def serialise_cutting_sort(model, seqs, mask_value, pad_value,
                            keep_start_end=False, min_length=None,
-                           blocking=None):
+                           blocking=None, entropies=False):
     """Serialise a list of sequences according to the 'cutting sort order'.
 
     Args:
         model (callable): The model function, which takes as input a
                           numpy array of shape (batch-size, seq-len)
                           and outputs a probability distribution at
-                          each of those positions.
+                          each of those positions (or see `entropies`).
         seqs (list of np.ndarray): A list of 1D integral vectors of
                                    length equal to the batch size!!!
         mask_value (int): The integer representing a masked token.
@@ -120,50 +157,42 @@ def serialise_cutting_sort(model, seqs, mask_value, pad_value,
                                   compressor, but the speedup will be on the
                                   order of the blocking size. Passing None
                                   here is equivalent to passing 1.
+        entropies (bool, optional): If true, `model` instead outputs the
+                                    entropy of its distribution at each
+                                    position, as an array of shape
+                                    (batch-size, seq-len), which is all
+                                    that is needed to find the order.
 
     Returns:
         A 2-tuple containing the padded batch of sequences to run the
-        model on, and the list of masking matrices. These parameters
-        should be passed directly to `compress_serialisation`.
+        model on, and the `RevealOrder`. These parameters should be
+        passed directly to `compress_serialisation`.
     """
     seqs, init_keep = padded_batch(seqs, pad_value, min_length=min_length)
     if keep_start_end:
         init_keep = _keep_start_end(seqs, init_keep)
 
-    n_mask_arrays = seqs.shape[1] + 1
+    n_steps = seqs.shape[1] + 1
     if keep_start_end:
-        n_mask_arrays -= 2
+        n_steps -= 2
 
-    mask_arrays = np.repeat(init_keep[np.newaxis, :, :], n_mask_arrays, axis=0)
-    mask_arrays[-1, :, :] = 0  # final array must be all-zeroes
-
-    idxs = cut_sort(model, seqs, mask_value, blocking=blocking)
-
-    for i in range(seqs.shape[0]):
-        # remove start/end/padding
-        # (need to do this separately for each element in the batch,
-        # since they may be of different lengths)
-        i_idxs = idxs[i, init_keep[i, idxs[i, :]] == 1]
-        for j in range(i_idxs.shape[0]):
-            mask_arrays[j, i, i_idxs[:j]] = 0
-        # any leftover padding
-        # (aka accounting for any discrepancy between `n_mask_arrays`
-        # and len(i_idxs))
-        mask_arrays[i_idxs.shape[0]:, i, :] = 0
-
-    return seqs, _block_mask_arrays(mask_arrays, blocking)
+    idxs = cut_sort(model, seqs, mask_value, blocking=blocking, entropies=entropies)
+    # (the start/end/padding tokens in `idxs` are skipped, since
+    # they're never masked)
+    order = _ordered_reveal_order(idxs, init_keep, n_steps)
+    return seqs, _block_reveal_order(order, blocking)
 
 
 def serialise_greedy(model, seqs, mask_value, pad_value,
                      keep_start_end=False, min_length=None,
-                     blocking=None):
+                     blocking=None, entropies=False):
     """Serialise a list of sequences according to the 'greedy order'.
 
     Args:
         model (callable): The model function, which takes as input a
                           numpy array of shape (batch-size, seq-len)
                           and outputs a probability distribution at
-                          each of those positions.
+                          each of those positions (or see `entropies`).
         seqs (list of np.ndarray): A list of 1D integral vectors of
                                    length equal to the batch size!!!
         mask_value (int): The integer representing a masked token.
@@ -186,125 +215,175 @@ def serialise_greedy(model, seqs, mask_value, pad_value,
                                   compressor, but the speedup will be on the
                                   order of the blocking size. Passing None
                                   here is equivalent to passing 1.
+        entropies (bool, optional): If true, `model` instead outputs the
+                                    entropy of its distribution at each
+                                    position, as an array of shape
+                                    (batch-size, seq-len), which is all
+                                    that is needed to find the order.
 
     Returns:
         A 2-tuple containing the padded batch of sequences to run the
-        model on, and the list of masking matrices. These parameters
-        should be passed directly to `compress_serialisation`.
+        model on, and the `RevealOrder`. These parameters should be
+        passed directly to `compress_serialisation`.
     """
     seqs, init_keep = padded_batch(seqs, pad_value, min_length=min_length)
     if keep_start_end:
         init_keep = _keep_start_end(seqs, init_keep)
 
-    n_mask_arrays = seqs.shape[1] + 1
+    n_steps = seqs.shape[1] + 1
     if keep_start_end:
-        n_mask_arrays -= 2
-
-    mask_arrays = np.repeat(init_keep[np.newaxis, :, :], n_mask_arrays, axis=0)
-    mask_arrays[-1, :, :] = 0  # final array must be all-zeroes
-
-    idxs = greedy_order(model, seqs, mask_value, blocking=blocking)
-
-    for i in range(seqs.shape[0]):
-        # remove start/end/padding
-        # (need to do this separately for each element in the batch,
-        # since they may be of different lengths)
-        i_idxs = idxs[i, init_keep[i, idxs[i, :]] == 1]
-        for j in range(i_idxs.shape[0]):
-            mask_arrays[j, i, i_idxs[:j]] = 0
-        # any leftover padding
-        # (aka accounting for any discrepancy between `n_mask_arrays`
-        # and len(i_idxs))
-        mask_arrays[i_idxs.shape[0]:, i, :] = 0
-
-    return seqs, _block_mask_arrays(mask_arrays, blocking)
-
-
-def compress_serialisation(model, seqs, mask_arrays, mask_value, d,
-                           chunking=1):
+        n_steps -= 2
+
+    idxs = greedy_order(model, seqs, mask_value, blocking=blocking, entropies=entropies)
+    # (the start/end/padding tokens in `idxs` are skipped, since
+    # they're never masked)
+    order = _ordered_reveal_order(idxs, init_keep, n_steps)
+    return seqs, _block_reveal_order(order, blocking)
+
+
+def _stacked_model_outputs(model, seqs, order, mask_value, chunking,
+                           log_probs, max_batch_tokens):
+    """The log-probabilities of the true tokens at each timestep of
+    `compress_serialisation` at which the model is run, in order. Since
+    the masked inputs of every timestep are known up front, those of as
+    many timesteps as fit into `max_batch_tokens` are stacked into one
+    model call.
+    """
+    # the model is run on the masked sequences of the previous timestep
+    # (the tokens still to be revealed after it)
+    inputs = [t - 1 for t in range(1, order.n_steps) if (t - 1) % chunking == 0]
+    per_call = 1
+    if max_batch_tokens is not None:
+        per_call = max(1, max_batch_tokens // seqs.size)
+
+    for i in range(0, len(inputs), per_call):
+        timesteps = inputs[i:i + per_call]
+        xs = np.concatenate([np.where(order.steps > t, mask_value, seqs) for t in timesteps])
+        targets = np.tile(seqs, (len(timesteps), 1))
+        if log_probs:
+            token_logps = model(xs, targets)
+        else:
+            ps = model(xs)
+            token_logps = np.log(np.take_along_axis(
+                ps, targets[..., np.newaxis], axis=-1)[..., 0])
+        yield from np.split(token_logps, len(timesteps))
+
+
+def compress_serialisation(model, seqs, order, mask_value, d,
+                           chunking=1, sizes_only=False, log_probs=False,
+                           max_batch_tokens=None):
     """Given a batch of sequences, and an order in which to compress them,
     perform that compression.
 
-    The key ingredient here is `mask_arrays`. The outer dimension corresponds
-    to "time" (revealing new tokens at each timestep). The inner dimension
-    corresponds to the batch and then the sequence length. The matrix is a
-    binary matrix where 1 denotes masking, 0 denotes no masking. The sequence
-    of matrices over the outer dimension must be well-ordered: once a position
-    is unmasked it can never be masked again. The first mask matrix should be
-    all ones, except possibly if there are any padding characters, which must
-    be unmasked from the beginning. The last mask matrix must be all-zero.
+    The key ingredient here is `order`, a `RevealOrder`. Its `steps` give,
+    for each token in the batch, the timestep at which it is revealed,
+    out of `n_steps` timesteps. So the mask at timestep t (where 1 denotes
+    masking, 0 denotes no masking) is `order.steps > t`, and once a
+    position is unmasked it can never be masked again (see `reveal_masks`).
+    The first mask should be all ones, except possibly if there are any
+    padding characters, which must be unmasked from the beginning (i.e.
+    revealed at timestep 0). Every token must be revealed by the last
+    timestep, n_steps - 1.
 
     Args:
         model (callable): A function which is run on integer matrices of shape
                           (batch-size, seq-len), and outputs the probability
-                          distribution at each cell.
+                          distribution at each cell (or see `log_probs`).
         seqs (np.ndarray): An integral numpy array of shape (batch-size, seq-len)
                            which does not contain the value `mask_value`.
-        mask_arrays (np.ndarray): A binary numpy array of shape
-                                  (num-timesteps, batch-size, seq-len), which
-                                  satisfies rules as explained above.
+        order (RevealOrder): The timesteps at which each token is revealed,
+                             which satisfy the rules explained above.
         mask_value (int): The index corresponding to the masking value.
         d (int): The arity of the output.
         chunking (int): Call the model once every `chunking`th token. Higher
                         values will result in less efficient codes, but the
                         speedup is of the order of the chunking value.
                         Warning: this operates ON TOP OF any chunking already
-                        done in the masks. In other words, it chunks the
-                        masks, rather than the tokens. Ignore this warning if
-                        your masks are unmodified return values from
+                        done in the order. In other words, it chunks the
+                        timesteps, rather than the tokens. Ignore this warning
+                        if your order is an unmodified return value from
                         any serialise method that returns an actual ordering.
+        sizes_only (bool): If true, only compute the lengths of the codes,
+                           rather than the codes themselves.
+        log_probs (bool): If true, `model` is instead called as
+                          `model(xs, seqs)`, and outputs the log-probability
+                          of each token of `seqs` under its distribution at
+                          that cell, as an array of shape (batch-size,
+                          seq-len). Only these are ever used, so this saves
+                          passing the whole distributions around.
+        max_batch_tokens (int, optional): If not None, stack the inputs of
+                                          as many timesteps as fit into this
+                                          many tokens (i.e. batch-size x
+                                          seq-len per timestep) into each
+                                          model call, rather than calling
+                                          the model once per timestep. The
+                                          model must accept any number of
+                                          rows.
 
     Returns:
         List of Lists of Ints: Returns the d-ary Huffman codes for each sequence
-                               in the batch.
+                               in the batch (or if `sizes_only`, a list of their
+                               lengths).
     """
-    assert(np.all(mask_arrays[-1] == 0))
-    assert(not np.all(mask_arrays[0] == 0))  # SOME may be 0, for padding/start/end tokens
-    codes = [[] for i in range(seqs.shape[0])]
-    last_seqs = None
-    last_masks = None
-    chunk = 0
+    assert(np.all(order.steps >= 0) and np.all(order.steps < order.n_steps))
+    assert(np.any(order.steps > 0))  # SOME may be 0, for padding/start/end tokens
+    if sizes_only:
+        codes = [0] * seqs.shape[0]
+    else:
+        codes = [[] for i in range(seqs.shape[0])]
+    joint_code = _compute_joint_code_length if sizes_only else _compute_joint_code
+    outputs = _stacked_model_outputs(model, seqs, order, mask_value,
+                                     chunking, log_probs, max_batch_tokens)
     logps = np.zeros((seqs.shape[0],))
-    for masks in mask_arrays:
-        if last_seqs is not None:
-            # compute which new tokens are being revealed at this
-            # timestep (possibly none):
-            new = last_masks - masks
-            assert(np.all(new >= 0))
-            # (note that the number of revealed tokens may be different
-            # for different sequences)
-
-            # only update the model every `chunking`th
-            # token (but obviously it is crucial to call
-            # this the first time `_compute_joint_code`
-            # is called, because this sets up `ps`.)
-            if chunk % chunking == 0:
-                # run the model to get its current belief over masked
-                # sequences:
-                ps = model(last_seqs)
-            chunk += 1
-
-            # now, for each sequence, compute the Huffman code of the
-            # joint distribution of the revealed tokens, and add it
-            # to the code for sequence `i`.
-            # (we do not need a comma character because Huffman codes
-            # form prefix codes.)
-            for i in range(len(codes)):
-                logps += np.log(ps[i, new[i] == 1, :][range(len(seqs[i][new[i] == 1])), seqs[i][new[i] == 1]])
-                codes[i] += _compute_joint_code(
-                    ps[i, new[i] == 1, :],
-                    seqs[i][new[i] == 1],
-                    d
-                )
-        last_seqs = np.where(masks == 1, mask_value, seqs)
-        last_masks = masks
+    for t in range(1, order.n_steps):
+        # compute which new tokens are being revealed at this
+        # timestep (possibly none):
+        new = order.steps == t
+        # (note that the number of revealed tokens may be different
+        # for different sequences)
+
+        # only update the model every `chunking`th
+        # token (but obviously it is crucial to call
+        # this the first time `_compute_joint_code`
+        # is called, because this sets up `token_logps`.)
+        if (t - 1) % chunking == 0:
+            # get the log-probabilities of the true tokens under
+            # the model's current belief over masked sequences:
+            token_logps = next(outputs)
+
+        # now, for each sequence, compute the Huffman code of the
+        # joint distribution of the revealed tokens, and add it
+        # to the code for sequence `i`.
+        # (we do not need a comma character because Huffman codes
+        # form prefix codes.)
+        for i in range(len(codes)):
+            logps[i] += np.sum(token_logps[i, new[i]])
+            codes[i] += joint_code(token_logps[i, new[i]], d)
 
     print("Log likelihood", logps)
 
     return codes
 
 
-def _compute_joint_code(indep_dists, seq, d):
+def _compute_joint_code_length(logps, d):
+    """The length of the code that `_compute_joint_code` would produce,
+    without generating it.
+
+    Args:
+        logps (np.ndarray): Array of shape (N,) of the log-probabilities
+                            of each variable's value.
+        d (int): The arity of the Huffman code.
+
+    Returns:
+        int: The length K of the code.
+    """
+    # the *length* of the Huffman code, K, is given by
+    # `ceil(-log_d(probability))` (see `_compute_joint_code`)
+    log_p = np.sum(logps)
+    return int(np.ceil(-(log_p / np.log(d))))
+
+
+def _compute_joint_code(logps, d):
     """Given a collection of integral variables which
     are independent and drawn from given distributions,
     what d-ary Huffman code would/could they produce
@@ -318,12 +397,9 @@ def _compute_joint_code(indep_dists, seq, d):
     input.
 
     Args:
-        indep_dists (np.ndarray): Array of shape (N, M)
-                                  where the last axis is
-                                  a probability distribution
-                                  for each N.
-        seq (np.ndarray): Array of shape (N,) with values in
-                          the range 0..M-1.
+        logps (np.ndarray): Array of shape (N,) of the log-probabilities
+                            of each variable's value, under its
+                            distribution.
         d (int): The arity of the Huffman code.
 
     Returns:
@@ -340,7 +416,5 @@ def _compute_joint_code(indep_dists, seq, d):
     # (we can only make this simplification because we don't
     # actually care about implementing a decoder, only the
     # fact that there exists a decoding algorithm.)
-    idxs = np.arange(0, len(seq), dtype=np.int32)
-    log_p = np.sum(np.log(indep_dists[idxs, seq]))
-    K = np.ceil(-(log_p / np.log(d))).astype(np.int32)
+    K = _compute_joint_code_length(logps, d)
     return list(np.random.randint(0, d, size=(K,)))
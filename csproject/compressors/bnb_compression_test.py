@@ -1,7 +1,8 @@
 import numpy as np
 from compressors.bnb_compression import (
     serialise_l2r, compress_serialisation,
-    serialise_cutting_sort, serialise_greedy
+    serialise_cutting_sort, serialise_greedy,
+    reveal_masks
 )
 
 
@@ -18,7 +19,8 @@ def test_l2r():
         np.array([1, 2, 3], dtype=np.int32),
         np.array([4, 5, 6, 7], dtype=np.int32)
     ]
-    seqs, mask_arrays = serialise_l2r(seqs, 0)
+    seqs, order = serialise_l2r(seqs, 0)
+    mask_arrays = reveal_masks(order)
     assert(np.all(mask_arrays == np.array([
         [[1, 1, 1, 0],
         [1, 1, 1, 1]],
@@ -35,7 +37,7 @@ def test_l2r():
        [[0, 0, 0, 0],
         [0, 0, 0, 0]]
         ], dtype=np.int32)))
-    codes = compress_serialisation(_model, seqs, mask_arrays, 257, 2)
+    codes = compress_serialisation(_model, seqs, order, 257, 2)
     assert(len(codes) == len(seqs))
     assert(len(codes[0]) == 3 * 8)
     assert(len(codes[1]) == 4 * 8)
@@ -46,7 +48,8 @@ def test_cutting_sort():
         np.array([1, 2, 3], dtype=np.int32),
         np.array([4, 5, 6, 7], dtype=np.int32)
     ]
-    seqs, mask_arrays = serialise_cutting_sort(_model, seqs, 257, 0)
+    seqs, order = serialise_cutting_sort(_model, seqs, 257, 0)
+    mask_arrays = reveal_masks(order)
     assert(np.all(mask_arrays[0, :, :] == np.array([
         [1, 1, 1, 0],
         [1, 1, 1, 1]
@@ -59,7 +62,7 @@ def test_cutting_sort():
         mask_arrays[:-1, :, :] - mask_arrays[1:, :, :] == 1,
         axis=-1
     ), axis=-1)))
-    codes = compress_serialisation(_model, seqs, mask_arrays, 257, 2)
+    codes = compress_serialisation(_model, seqs, order, 257, 2)
     assert(len(codes) == len(seqs))
     assert(len(codes[0]) == 3 * 8)
     assert(len(codes[1]) == 4 * 8)
@@ -70,7 +73,8 @@ def test_greedy():
         np.array([1, 2, 3], dtype=np.int32),
         np.array([4, 5, 6, 7], dtype=np.int32)
     ]
-    seqs, mask_arrays = serialise_greedy(_model, seqs, 257, 0)
+    seqs, order = serialise_greedy(_model, seqs, 257, 0)
+    mask_arrays = reveal_masks(order)
     assert(np.all(mask_arrays[0, :, :] == np.array([
         [1, 1, 1, 0],
         [1, 1, 1, 1]
@@ -83,7 +87,85 @@ def test_greedy():
         mask_arrays[:-1, :, :] - mask_arrays[1:, :, :] == 1,
         axis=-1
     ), axis=-1)))
-    codes = compress_serialisation(_model, seqs, mask_arrays, 257, 2)
+    codes = compress_serialisation(_model, seqs, order, 257, 2)
     assert(len(codes) == len(seqs))
     assert(len(codes[0]) == 3 * 8)
     assert(len(codes[1]) == 4 * 8)
+
+
+def _log_prob_model(seqs, targets):
+    ps = _model(seqs)
+    return np.log(np.take_along_axis(ps, targets[..., np.newaxis], axis=-1)[..., 0])
+
+
+def _entropy_model(seqs):
+    ps = _model(seqs)
+    return np.sum((-ps * np.ma.log(ps)).filled(0.0), axis=-1)
+
+
+def test_log_probs():
+    seqs = [
+        np.array([1, 2, 3], dtype=np.int32),
+        np.array([4, 5, 6, 7], dtype=np.int32)
+    ]
+    for serialise in [serialise_cutting_sort, serialise_greedy]:
+        padded, order = serialise(_model, seqs, 257, 0)
+        assert(np.all(serialise(_entropy_model, seqs, 257, 0, entropies=True)[1].steps == order.steps))
+        sizes = compress_serialisation(_model, padded, order, 257, 2, sizes_only=True)
+        assert(sizes == [3 * 8, 4 * 8])
+        assert(compress_serialisation(_log_prob_model, padded, order, 257, 2,
+                                      sizes_only=True, log_probs=True) == sizes)
+
+
+def test_stacked_timesteps():
+    seqs = [
+        np.array([1, 2, 3], dtype=np.int32),
+        np.array([4, 5, 6, 7], dtype=np.int32)
+    ]
+    seqs, order = serialise_l2r(seqs, 0)
+    calls = []
+    def model(xs, targets):
+        # a different distribution for each masked input
+        calls.append(xs.shape)
+        logps = -np.log(2.0) * (1 + np.sum(xs == 257, axis=-1, keepdims=True))
+        return np.where(targets == 0, 0.0, logps)
+
+    for chunking in [1, 2]:
+        expected = compress_serialisation(model, seqs, order, 257, 2, chunking=chunking,
+                                          sizes_only=True, log_probs=True)
+        n_calls = len(calls)
+        for max_batch_tokens in [8, 17, 1000]:
+            del calls[:]
+            assert(compress_serialisation(model, seqs, order, 257, 2, chunking=chunking,
+                                          sizes_only=True, log_probs=True,
+                                          max_batch_tokens=max_batch_tokens) == expected)
+            per_call = min(max_batch_tokens // 8, n_calls)
+            assert(calls[0] == (2 * per_call, 4))
+            assert(len(calls) == -(-n_calls // per_call))
+        del calls[:]
+
+
+def test_keep_start_end():
+    # the first sequence isn't the longest, so is padded
+    seqs = [
+        np.array([9, 1, 8], dtype=np.int32),
+        np.array([9, 4, 5, 8], dtype=np.int32)
+    ]
+    seqs, order = serialise_l2r(seqs, 0, keep_start_end=True)
+    mask_arrays = reveal_masks(order)
+    assert(np.all(mask_arrays[0] == np.array([
+        [0, 1, 0, 0],
+        [0, 1, 1, 0]
+    ])))
+
+
+def test_blocking():
+    seqs = [
+        np.array([1, 2, 3], dtype=np.int32),
+        np.array([4, 5, 6, 7, 8, 9], dtype=np.int32)
+    ]
+    for blocking, rng in [(2, [0, 2, 4, 6]), (4, [0, 4, 6])]:
+        _, order = serialise_l2r(seqs, 0)
+        _, blocked = serialise_l2r(seqs, 0, blocking=blocking)
+        # the same masks as every `blocking`th timestep, and the last
+        assert(np.all(reveal_masks(blocked) == reveal_masks(order)[rng]))
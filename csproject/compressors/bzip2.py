@@ -4,7 +4,7 @@ Performs bzip2 compression.
 
 
 import bz2
-from compressors.base import Compressor
+from compressors.base import Compressor, as_bytes
 
 
 class BZ2(Compressor):
@@ -20,8 +20,16 @@ class BZ2(Compressor):
 
 
     def compress(self, seq):
-        return list(map(int, bz2.compress(bytes(seq), compresslevel=self.compresslevel)))
+        return bz2.compress(as_bytes(seq), compresslevel=self.compresslevel)
 
 
     def compressmany(self, seqs):
         return super(BZ2, self).compressmany(seqs)
+
+
+    def compressed_size(self, seq):
+        return len(bz2.compress(as_bytes(seq), compresslevel=self.compresslevel))
+
+
+    def compressed_sizes(self, seqs):
+        return map(self.compressed_size, seqs)
@@ -1,43 +1,34 @@
 """
 This compressor trains and runs a chain of compressors.
-It uses an intermediate temporary file to store compression results.
+It uses an intermediate temporary (binary) file to store compression results.
 Because in order to train the 2nd compressor you need the 1st compressor
 to have trained over all of the data.
 """
 
 
-import os
+import mmap
+import queue
 import random
 import tempfile
-from compressors.base import Compressor
+import threading
+import numpy as np
+from compressors.base import Compressor, as_bytes
 
 
-def _shuffle_file_lines(file, buffer_sz=1024*8):
-    """(Approximately) shuffle the lines of a (potentially very large) file.
+# each spilled sequence is its length followed by its tokens
+_LENGTH_DTYPE = np.dtype(np.int64)
 
-    Args:
-        file (file handle): The file to shuffle.
-        buffer_sz (int): The max number of lines we are allowed to read in at a time.
-    """
-    end = False
-    while not end:
-        buffer = []
-        pos = file.tell()
-        for i in range(buffer_sz):
-            s = file.readline()
-            if s != '':
-                if s[-1] != '\n':
-                    s = s + '\n'
-                buffer.append(s)
-            else:  # eof
-                end = True
-                break
-        random.shuffle(buffer)
-        file.seek(pos)
-        file.write("".join(buffer))  # should be identical size in binary
-
-
-def _lazy_iterate(compressor, old_iter, shuffle):
+
+def _token_dtype(alphabet_size):
+    if alphabet_size <= 1 << 8:
+        return np.dtype(np.uint8)
+    elif alphabet_size <= 1 << 16:
+        return np.dtype(np.uint16)
+    else:
+        return np.dtype(np.int64)
+
+
+def _lazy_iterate(compressor, old_iter, shuffle, alphabet_size):
     """Create a new iterator from an old iterator by applying
     the given compressor to all elements. To save on computation
     the results are stored in a temporary file which is closed
@@ -45,6 +36,11 @@ def _lazy_iterate(compressor, old_iter, shuffle):
     But also, since this iterator may never be needed, we do it
     lazily to prevent excessive computation.
 
+    The file is binary, with each sequence stored as its length
+    followed by its tokens, and an index of where each sequence starts
+    is kept in memory, so that re-reading it (via a memory map) doesn't
+    parse anything, and shuffling is just a permutation of the index.
+
     Args:
         compressor (Compressor): The compressor to apply.
         old_iter (Nullary function): Calling this creates an iterator
@@ -52,6 +48,7 @@ def _lazy_iterate(compressor, old_iter, shuffle):
         shuffle (bool): If true, shuffle the data every time the
                         iterator is created, else preserve order of
                         the old iterator.
+        alphabet_size (int): The output alphabet size of `compressor`.
 
     Returns:
         A new iterator.
@@ -61,39 +58,178 @@ def _lazy_iterate(compressor, old_iter, shuffle):
     # `new_iter` to clean this temporary file up, because while
     # `new_iter` exists we could always receive another call
     # to it.
-    storage = tempfile.TemporaryFile(mode='w+', newline='\n')
+    storage = tempfile.TemporaryFile(mode='w+b')
+    dtype = _token_dtype(alphabet_size)
+    # (offset, length) of each sequence's tokens, and the memory map of
+    # `storage`, once the old iterator has been exhausted
+    index = []
+    spilled = None
 
-    def new_iter():
-        storage.seek(0, os.SEEK_END)
+    def from_buffer(buffer, offset, length):
+        tokens = np.frombuffer(buffer, dtype=dtype, count=length, offset=offset)
+        # bytes for byte-sized alphabets, like the byte-based compressors
+        # give, and lists otherwise
+        return tokens.tobytes() if dtype == np.uint8 else tokens.tolist()
 
-        if storage.tell() != 0:
-            # file is nonempty; don't need `old_iter`, just go
-            # through the lines of `storage`
-            storage.seek(0)
+    def new_iter():
+        nonlocal spilled
 
+        if spilled is not None:
+            # don't need `old_iter`, just go through `storage`
+            order = list(range(len(index)))
             if shuffle:
-                # over time, this approximate shuffle will get better
-                # and better, because it overwrites the file each time.
-                _shuffle_file_lines(storage)
-
-            for line in storage.readline():
-                yield list(map(int, line.split()))
+                random.shuffle(order)
+            for i in order:
+                yield from_buffer(spilled, *index[i])
 
         else:
-            # go through the old iterator only this once, writing
-            # the sequences as we see them, after compressing
+            # go through the old iterator, writing the sequences as we
+            # see them, after compressing. if this is stopped early, the
+            # next call starts again from scratch
+            storage.seek(0)
+            storage.truncate()
+            index.clear()
+            offset = 0
             for s in old_iter():
                 s = compressor.compress(s)
-                storage.write(" ".join(map(str, s)) + "\n")
+                tokens = as_bytes(s) if dtype == np.uint8 else np.asarray(s, dtype=dtype)
+                storage.write(np.array(len(s), dtype=_LENGTH_DTYPE).tobytes())
+                storage.write(tokens)
+                offset += _LENGTH_DTYPE.itemsize
+                index.append((offset, len(s)))
+                offset += len(s) * dtype.itemsize
                 yield s
 
+            storage.flush()
+            # (an empty file can't be memory mapped, but then there's
+            # nothing to read from it anyway)
+            spilled = (mmap.mmap(storage.fileno(), 0, access=mmap.ACCESS_READ)
+                       if offset > 0 else b'')
+
     return new_iter
 
 
+# sentinels passed along the queues of `_pipeline`
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def _pipeline(stages, seqs, batch_sz, queue_sz):
+    """Run each of a sequence of stages in its own thread, connected by
+    bounded queues of batches, so that the stages overlap (e.g. while a
+    C compressor like LZMA has released the GIL). Each stage handles its
+    batches in order, so the output order is that of `seqs`.
+
+    Args:
+        stages (list): Functions mapping a list of sequences to a list of
+                       (e.g. compressed) sequences.
+        seqs (Iterator over sequences): The input.
+        batch_sz (int): The number of sequences per batch.
+        queue_sz (int): The maximum number of batches waiting between
+                        any two stages.
+
+    Returns:
+        An iterator over the outputs of the last stage.
+    """
+    stop = threading.Event()
+    queues = [queue.Queue(queue_sz) for _ in range(len(stages) + 1)]
+
+    def put(q, item):
+        # give up if the consumer has gone away
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def feed():
+        try:
+            batch = []
+            for s in seqs:
+                batch.append(s)
+                if len(batch) == batch_sz:
+                    if not put(queues[0], batch):
+                        return
+                    batch = []
+            if len(batch) > 0:
+                put(queues[0], batch)
+            put(queues[0], _DONE)
+        except BaseException as e:
+            put(queues[0], _Failure(e))
+
+    def run(stage, q_in, q_out):
+        while True:
+            batch = get(q_in)
+            if batch is _DONE or isinstance(batch, _Failure):
+                put(q_out, batch)
+                return
+            try:
+                batch = stage(batch)
+            except BaseException as e:
+                put(q_out, _Failure(e))
+                return
+            if not put(q_out, batch):
+                return
+
+    threads = [threading.Thread(target=feed, daemon=True)] + [
+        threading.Thread(target=run, args=(stage, queues[i], queues[i + 1]), daemon=True)
+        for i, stage in enumerate(stages)
+    ]
+
+    def results():
+        # the threads are only started once the output is first needed
+        for t in threads:
+            t.start()
+        try:
+            while True:
+                batch = queues[-1].get()
+                if batch is _DONE:
+                    return
+                elif isinstance(batch, _Failure):
+                    raise batch.exc
+                yield from batch
+        finally:
+            # also stops the threads if this iterator is closed early
+            stop.set()
+
+    return results()
+
+
 class Chain(Compressor):
-    def __init__(self, compressors):
+    def __init__(self, compressors, pipeline=False, batch_sz=64, queue_sz=4):
+        """Create a chain of compressors, each of which compresses the
+        output of the previous one.
+
+        Args:
+            compressors (list of Compressor): The stages of the chain.
+            pipeline (bool, optional): If true, `compressmany` and
+                                       `compressed_sizes` run each stage in
+                                       its own thread (see `_pipeline`). The
+                                       outputs are unchanged.
+            batch_sz (int, optional): The number of sequences passed between
+                                      pipelined stages at a time.
+            queue_sz (int, optional): The maximum number of batches waiting
+                                      between any two pipelined stages.
+        """
         assert(all(map(lambda c: issubclass(type(c), Compressor), compressors)))
         self.compressors = compressors
+        self.pipeline = pipeline
+        self.batch_sz = batch_sz
+        self.queue_sz = queue_sz
 
 
     def train(self, alphabet_size, iter_train, iter_val):
@@ -107,8 +243,8 @@ class Chain(Compressor):
             # compressors even use `train`!
             # therefore we only want to put all of this data into a
             # file when it is called, not eagerly.
-            iter_train = _lazy_iterate(c, iter_train, True)
-            iter_val = _lazy_iterate(c, iter_val, False)
+            iter_train = _lazy_iterate(c, iter_train, True, alphabet_size)
+            iter_val = _lazy_iterate(c, iter_val, False, alphabet_size)
 
         return alphabet_size
 
@@ -120,6 +256,11 @@ class Chain(Compressor):
 
 
     def compressmany(self, seqs):
+        if self.pipeline and len(self.compressors) > 1:
+            return _pipeline([lambda batch, c=c: list(c.compressmany(batch))
+                              for c in self.compressors],
+                             seqs, self.batch_sz, self.queue_sz)
+
         # cool fact: this function will often not perform any work,
         # and will simply return an iterator over many composed compressors
         for c in self.compressors:
@@ -127,6 +268,90 @@ class Chain(Compressor):
         return seqs
 
 
+    def compressed_size(self, seq):
+        for c in self.compressors[:-1]:
+            seq = c.compress(seq)
+        return self.compressors[-1].compressed_size(seq)
+
+
+    def compressed_sizes(self, seqs):
+        if self.pipeline and len(self.compressors) > 1:
+            last = self.compressors[-1]
+            return _pipeline([lambda batch, c=c: list(c.compressmany(batch))
+                              for c in self.compressors[:-1]] +
+                             [lambda batch: list(last.compressed_sizes(batch))],
+                             seqs, self.batch_sz, self.queue_sz)
+
+        # only the last compressor needs to compute sizes
+        for c in self.compressors[:-1]:
+            seqs = c.compressmany(seqs)
+        return self.compressors[-1].compressed_sizes(seqs)
+
+
+    def _pass_through_concatenative(self, context, seqs):
+        """Pass a common context (e.g. a prefix) separately from the
+        sequences through the leading concatenative compressors, so that
+        the first other compressor can exploit it.
+
+        Returns:
+            A tuple `(i, context, seqs)`, where `i` is the index of the
+            first non-concatenative compressor (or the number of
+            compressors, if they are all concatenative).
+        """
+        for i, c in enumerate(self.compressors):
+            if not c.concatenative():
+                return i, context, seqs
+            context = c.compress(context)
+            seqs = c.compressmany(seqs)
+        return len(self.compressors), context, seqs
+
+
+    def compressmany_prefixed(self, prefix, suffixes):
+        i, prefix, suffixes = self._pass_through_concatenative(prefix, suffixes)
+        if i == len(self.compressors):
+            return map(lambda s: list(prefix) + list(s), suffixes)
+        seqs = self.compressors[i].compressmany_prefixed(prefix, suffixes)
+        for c in self.compressors[i + 1:]:
+            seqs = c.compressmany(seqs)
+        return seqs
+
+
+    def compressed_sizes_prefixed(self, prefix, suffixes):
+        i, prefix, suffixes = self._pass_through_concatenative(prefix, suffixes)
+        if i == len(self.compressors):
+            return map(lambda s: len(prefix) + len(s), suffixes)
+        elif i == len(self.compressors) - 1:
+            return self.compressors[i].compressed_sizes_prefixed(prefix, suffixes)
+        return Chain(self.compressors[i + 1:]).compressed_sizes(
+            self.compressors[i].compressmany_prefixed(prefix, suffixes))
+
+
+    def compressmany_conditional(self, context, seqs):
+        # if the compressors are all concatenative, then the context
+        # doesn't change the compression of the sequences
+        i, context, seqs = self._pass_through_concatenative(context, seqs)
+        if i == len(self.compressors):
+            return seqs
+        seqs = self.compressors[i].compressmany_conditional(context, seqs)
+        for c in self.compressors[i + 1:]:
+            seqs = c.compressmany(seqs)
+        return seqs
+
+
+    def compressed_sizes_conditional(self, context, seqs):
+        i, context, seqs = self._pass_through_concatenative(context, seqs)
+        if i == len(self.compressors):
+            return map(len, seqs)
+        elif i == len(self.compressors) - 1:
+            return self.compressors[i].compressed_sizes_conditional(context, seqs)
+        return Chain(self.compressors[i + 1:]).compressed_sizes(
+            self.compressors[i].compressmany_conditional(context, seqs))
+
+
+    def concatenative(self):
+        return all(c.concatenative() for c in self.compressors)
+
+
     def fine_tuning_method(self):
         # return first non-None return result from the children
         methods = [c.fine_tuning_method() for c in self.compressors]
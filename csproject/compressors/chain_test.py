@@ -1,25 +1,110 @@
-import tempfile
+import time
+import threading
+import pytest
 import numpy as np
-from compressors.chain import _shuffle_file_lines
-
-
-def test_shuffle_file_lines():
-    with tempfile.TemporaryFile(mode="w+") as f:
-        A = np.random.randint(0, 200, size=(100, 32))
-        f.write("\n".join([
-            " ".join(map(str, row)) for row in A
-        ]))
-        f.seek(0)
-        _shuffle_file_lines(f)
-        f.seek(0)
-        print(f.read())
-        f.seek(0)
-        B = np.zeros_like(A)
-        for i, line in enumerate(f.readlines()):
-            row = np.array(list(map(int, line.split())), dtype=np.int32)
-            assert(row.shape == (32,))
-            B[i, :] = row
-    vals_a, cnts_a = np.unique(A, return_counts=True)
-    vals_b, cnts_b = np.unique(B, return_counts=True)
-    assert(np.all(vals_a == vals_b))
-    assert(np.all(cnts_a == cnts_b))
+import compressors as comp
+from compressors.chain import _lazy_iterate
+
+
+class _Reverse(comp.Compressor):
+    # a stand-in compressor with a large output alphabet
+    def train(self, alphabet_size, iter_train, iter_val):
+        return alphabet_size
+
+    def compress(self, seq):
+        return list(seq)[::-1]
+
+    def compressmany(self, seqs):
+        return super(_Reverse, self).compressmany(seqs)
+
+
+def _counting_iter(seqs):
+    calls = []
+    def f():
+        calls.append(None)
+        return iter(seqs)
+    return f, calls
+
+
+def test_lazy_iterate():
+    A = np.random.randint(0, 70000, size=(100, 32))
+    seqs = [row[:np.random.randint(0, 33)].tolist() for row in A]
+    old_iter, calls = _counting_iter(seqs)
+    new_iter = _lazy_iterate(_Reverse(), old_iter, False, 70000)
+    expected = [s[::-1] for s in seqs]
+    assert(list(new_iter()) == expected)
+    # the second time round, the results are read back from the file
+    assert(list(new_iter()) == expected)
+    assert(len(calls) == 1)
+
+
+def test_lazy_iterate_shuffle():
+    seqs = [[i] * (i % 7) + [i] for i in range(200)]
+    old_iter, calls = _counting_iter(seqs)
+    new_iter = _lazy_iterate(comp.ZLib(), old_iter, True, 256)
+    expected = [comp.ZLib().compress(s) for s in seqs]
+    assert(list(new_iter()) == expected)
+    shuffled = list(new_iter())
+    assert(shuffled != expected)
+    assert(sorted(shuffled) == sorted(expected))
+    assert(len(calls) == 1)
+
+
+def test_lazy_iterate_interrupted():
+    seqs = [[1, 2, 3], [4, 5], [], [6]]
+    old_iter, calls = _counting_iter(seqs)
+    new_iter = _lazy_iterate(_Reverse(), old_iter, False, 7)
+    it = new_iter()
+    next(it)
+    # the first pass wasn't finished, so it is redone
+    assert(list(new_iter()) == [[3, 2, 1], [5, 4], [], [6]])
+    # (the tokens are bytes-sized, so they are read back as bytes)
+    assert(list(map(list, new_iter())) == [[3, 2, 1], [5, 4], [], [6]])
+    assert(len(calls) == 2)
+
+
+class _Failing(_Reverse):
+    def compress(self, seq):
+        if len(seq) == 13:
+            raise ValueError("unlucky")
+        return super(_Failing, self).compress(seq)
+
+
+def _pipeline_data():
+    rng = np.random.default_rng(0)
+    seqs = [rng.integers(0, 256, size=rng.integers(0, 300)).tolist() for _ in range(500)]
+    chain = comp.Chain([comp.Huffman(256), comp.BZ2()])
+    chain.train(256, lambda: iter(seqs), lambda: iter([]))
+    return chain, seqs
+
+
+def test_pipeline():
+    chain, seqs = _pipeline_data()
+    expected = list(chain.compressmany(seqs))
+    expected_sizes = list(chain.compressed_sizes(seqs))
+    for batch_sz in [1, 7, 1000]:
+        pipelined = comp.Chain(chain.compressors, pipeline=True, batch_sz=batch_sz, queue_sz=2)
+        assert(list(pipelined.compressmany(iter(seqs))) == expected)
+        assert(list(pipelined.compressed_sizes(iter(seqs))) == expected_sizes)
+
+
+def test_pipeline_failure():
+    chain = comp.Chain([_Reverse(), _Failing()], pipeline=True, batch_sz=4)
+    outputs = chain.compressmany([[1] * n for n in range(20)])
+    with pytest.raises(ValueError):
+        list(outputs)
+
+
+def test_pipeline_closed_early():
+    chain, seqs = _pipeline_data()
+    chain = comp.Chain(chain.compressors, pipeline=True, batch_sz=1, queue_sz=1)
+    n_threads = threading.active_count()
+    outputs = chain.compressmany(seqs)
+    next(outputs)
+    outputs.close()
+    # the stages are left waiting on full queues, and must give up
+    for _ in range(50):
+        if threading.active_count() == n_threads:
+            break
+        time.sleep(0.1)
+    assert(threading.active_count() == n_threads)
@@ -6,8 +6,179 @@ in the root of the repository directory.
 """
 
 
-import heapq
 import cython
+import numpy as np
+
+
+@cython.cfunc
+@cython.inline
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _less(w: cython.double[:], first: cython.longlong[:],
+          a: cython.longlong, b: cython.longlong) -> cython.bint:
+    # nodes are ordered by weight, and ties are broken by their first
+    # token, which is how the tuples of the original heapq-based
+    # implementation compared, so the codes are unchanged
+    return w[a] < w[b] or (w[a] == w[b] and first[a] < first[b])
+
+
+@cython.cfunc
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _sift_down(heap: cython.longlong[:], size: cython.Py_ssize_t, pos: cython.Py_ssize_t,
+               w: cython.double[:], first: cython.longlong[:]) -> cython.void:
+    child: cython.Py_ssize_t
+    node: cython.longlong = heap[pos]
+    while True:
+        child = 2 * pos + 1
+        if child >= size:
+            break
+        if child + 1 < size and _less(w, first, heap[child + 1], heap[child]):
+            child += 1
+        if not _less(w, first, heap[child], node):
+            break
+        heap[pos] = heap[child]
+        pos = child
+    heap[pos] = node
+
+
+@cython.cfunc
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _sift_up(heap: cython.longlong[:], pos: cython.Py_ssize_t,
+             w: cython.double[:], first: cython.longlong[:]) -> cython.void:
+    parent: cython.Py_ssize_t
+    node: cython.longlong = heap[pos]
+    while pos > 0:
+        parent = (pos - 1) // 2
+        if not _less(w, first, node, heap[parent]):
+            break
+        heap[pos] = heap[parent]
+        pos = parent
+    heap[pos] = node
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def huffman_code_table(d: cython.int, weights, canonical: cython.bint = False):
+    """Compute the Huffman code of output-alphabet-size `d` for the
+    tokens 0, ..., n-1 with probabilities/occurrences `weights`, as a
+    flat table. The tree is built over arrays of node weights and
+    parents, so no codes are constructed until the end.
+
+    Args:
+        d (int): The arity of the code. Use d=2 for binary.
+        weights (array-like): The probability or number of occurrences
+                              of each token (summed as doubles).
+        canonical (bool, optional): If true, give the canonical code with
+                                    the same code lengths (i.e. the codes
+                                    are in lexicographic order of length
+                                    then token), rather than the codes of
+                                    the tree.
+
+    Returns:
+        tuple: `(codes, lengths)`, where `codes` is an (n, max. length)
+               matrix whose row `t` is the code of token `t` padded with
+               zeros (of dtype `np.uint8` if d <= 256, else `np.int64`),
+               and `lengths` is the vector of code lengths.
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    n: cython.Py_ssize_t = weights.shape[0]
+    if n == 0:
+        raise ValueError("Cannot construct a Huffman code for no tokens.")
+    if d < 2:
+        raise ValueError("The arity of a Huffman code must be at least 2.")
+
+    # the leaves are nodes 0, ..., n-1, and every merge creates one more
+    # node (and there are at most n-1 merges), so parents come after
+    # their children
+    w_arr = np.zeros(2 * n, dtype=np.float64)
+    w_arr[:n] = weights
+    first_arr = np.arange(2 * n, dtype=np.int64)  # the first token under each node
+    parent_arr = np.full(2 * n, -1, dtype=np.int64)
+    digit_arr = np.zeros(2 * n, dtype=np.int64)  # the last code digit of each node
+    heap_arr = np.arange(n, dtype=np.int64)
+    w: cython.double[:] = w_arr
+    first: cython.longlong[:] = first_arr
+    parent: cython.longlong[:] = parent_arr
+    digit: cython.longlong[:] = digit_arr
+    heap: cython.longlong[:] = heap_arr
+
+    i: cython.Py_ssize_t
+    size: cython.Py_ssize_t = n
+    n_nodes: cython.Py_ssize_t = n
+    x: cython.longlong
+    total: cython.double
+    for i in range(n // 2 - 1, -1, -1):
+        _sift_down(heap, size, i, w, first)
+
+    while size > 1:
+        # pop up to `d` least-likely elements, and join them under a new
+        # node, whose weight is the sum of theirs
+        total = 0.0
+        i = 0
+        while i < d and size > 0:
+            x = heap[0]
+            size -= 1
+            heap[0] = heap[size]
+            _sift_down(heap, size, 0, w, first)
+            if i == 0:
+                first[n_nodes] = first[x]
+            total += w[x]
+            parent[x] = n_nodes
+            digit[x] = i
+            i += 1
+        w[n_nodes] = total
+        heap[size] = n_nodes
+        _sift_up(heap, size, w, first)
+        size += 1
+        n_nodes += 1
+
+    # the depth of a node is one more than its parent's
+    depth_arr = np.zeros(n_nodes, dtype=np.int64)
+    depth: cython.longlong[:] = depth_arr
+    for i in range(n_nodes - 1, -1, -1):
+        if parent[i] != -1:
+            depth[i] = depth[parent[i]] + 1
+    lengths = depth_arr[:n].copy()
+    max_len: cython.Py_ssize_t = lengths.max()
+
+    codes_arr = np.zeros((n, max_len), dtype=np.int64)
+    codes: cython.longlong[:, :] = codes_arr
+    pos: cython.Py_ssize_t
+    v: cython.longlong
+    if not canonical:
+        # read each code off the path from its leaf up to the root
+        for i in range(n):
+            v = i
+            pos = depth[i] - 1
+            while parent[v] != -1:
+                codes[i, pos] = digit[v]
+                v = parent[v]
+                pos -= 1
+    else:
+        # each code is the last one plus one, padded with zeros
+        # to its length (the Kraft inequality ensures this doesn't
+        # carry past the first digit)
+        order_arr = np.lexsort((np.arange(n), lengths))
+        order: cython.longlong[:] = order_arr.astype(np.int64)
+        current_arr = np.zeros(max_len, dtype=np.int64)
+        current: cython.longlong[:] = current_arr
+        j: cython.Py_ssize_t
+        for i in range(n):
+            if i > 0:
+                pos = depth[order[i - 1]] - 1
+                current[pos] += 1
+                while current[pos] == d:
+                    current[pos] = 0
+                    pos -= 1
+                    current[pos] += 1
+            for j in range(depth[order[i]]):
+                codes[order[i], j] = current[j]
+
+    if d <= 256:
+        codes_arr = codes_arr.astype(np.uint8)
+    return codes_arr, lengths
 
 
 def huffman_codebook(d: cython.int, tokens: dict):
@@ -23,22 +194,7 @@ def huffman_codebook(d: cython.int, tokens: dict):
         dict: A dictionary mapping tokens to prefix-free lists of
               integers between 0 and d-1.
     """
-    h = [(v, [(k, [])]) for k, v in tokens.items()]
-    heapq.heapify(h)
-
-    while len(h) > 1:
-        # pop up to `d` least-likely elements
-        xs = []
-        for i in range(d):
-            xs.append(heapq.heappop(h))
-            if len(h) == 0:
-                break
-
-        # the new probability is the sum of the old ones
-        new_p = sum(map(lambda t: t[0], xs))
-        # union all of the codebooks
-        new_code = [(k, [i] + code) for i, t in enumerate(xs) for k, code in t[1]]
-        # now join their codes together
-        heapq.heappush(h, (new_p, new_code))
-
-    return dict(h[0][1])
+    # ties are broken by the order of the tokens (see `huffman_code_table`)
+    keys = sorted(tokens.keys())
+    codes, lengths = huffman_code_table(d, [tokens[k] for k in keys])
+    return {k: codes[i, :lengths[i]].tolist() for i, k in enumerate(keys)}
@@ -4,7 +4,8 @@ Performs gzip compression.
 
 
 import gzip
-from compressors.base import Compressor
+import zlib
+from compressors.base import Compressor, as_bytes
 
 
 class GZip(Compressor):
@@ -20,8 +21,37 @@ class GZip(Compressor):
 
 
     def compress(self, seq):
-        return list(map(int, gzip.compress(bytes(seq), compresslevel=self.compresslevel)))
+        return gzip.compress(as_bytes(seq), compresslevel=self.compresslevel)
 
 
     def compressmany(self, seqs):
         return super(GZip, self).compressmany(seqs)
+
+
+    def compressed_size(self, seq):
+        return len(gzip.compress(as_bytes(seq), compresslevel=self.compresslevel))
+
+
+    def compressed_sizes(self, seqs):
+        return map(self.compressed_size, seqs)
+
+
+    def _prefixed(self, prefix, suffixes):
+        # compress the prefix once, and then resume from a copy of the
+        # compressor's state for each suffix.
+        # NOTE: zlib writes a gzip header with a zero mtime and its own OS
+        # field, so the output is only identical to `compress` up to these
+        # header bytes (and `compress` is time-dependent anyway)
+        head_comp = zlib.compressobj(level=self.compresslevel, wbits=31)
+        head = head_comp.compress(as_bytes(prefix))
+        for s in suffixes:
+            comp = head_comp.copy()
+            yield head + comp.compress(as_bytes(s)) + comp.flush()
+
+
+    def compressmany_prefixed(self, prefix, suffixes):
+        return self._prefixed(prefix, suffixes)
+
+
+    def compressed_sizes_prefixed(self, prefix, suffixes):
+        return map(len, self._prefixed(prefix, suffixes))
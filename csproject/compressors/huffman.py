@@ -5,15 +5,74 @@ More efficient if the input alphabet is large.
 """
 
 
-from compressors.coding import huffman_codebook
+from compressors.coding import huffman_code_table
 import itertools
+import numpy as np
 import progressbar as pgb
-from compressors.base import Compressor
+from compressors.base import Compressor, as_bytes
+
+
+# sequences are encoded (and counted) in batches of about this many
+# tokens, concatenated into one array
+_BATCH_TOKENS = 1 << 16
+
+
+def _batches(seqs):
+    """Group an iterator of sequences into lists of them with about
+    `_BATCH_TOKENS` tokens in total.
+    """
+    batch = []
+    n_tokens = 0
+    for seq in seqs:
+        batch.append(seq)
+        n_tokens += len(seq)
+        if n_tokens >= _BATCH_TOKENS:
+            yield batch
+            batch = []
+            n_tokens = 0
+    if len(batch) > 0:
+        yield batch
+
+
+def _concatenate(batch, alphabet_size):
+    """The tokens of a batch of sequences as one array, and the offsets
+    of each sequence in it (including the end), as a list.
+    """
+    offsets = [0]
+    for seq in batch:
+        offsets.append(offsets[-1] + len(seq))
+    if alphabet_size <= 256:
+        # going via `bytes` is much faster than constructing an array
+        # from lists directly, when the tokens fit
+        flat = np.frombuffer(b"".join(map(as_bytes, batch)), dtype=np.uint8)
+    elif all(isinstance(seq, np.ndarray) for seq in batch):
+        flat = np.concatenate(batch)
+    else:
+        flat = np.fromiter(itertools.chain.from_iterable(batch),
+                           dtype=np.int64, count=offsets[-1])
+    return flat, offsets
 
 
 class Huffman(Compressor):
-    def __init__(self, d):
+    def __init__(self, d, canonical=False):
+        """Create a Huffman coder.
+
+        Args:
+            d (int): The output alphabet size (i.e. arity) of the code.
+            canonical (bool, optional): Use the canonical code with the
+                                        Huffman code lengths, rather than
+                                        the codes of the tree itself.
+                                        The compressed sizes are the same.
+        """
         self.d = d
+        self.canonical = canonical
+        # the code table, set in `train`: row `t` of `codes` is the code
+        # of token `t`, padded to the longest code, and `lengths` are
+        # the lengths of the codes (see `huffman_code_table`)
+        self.alphabet_size = 0
+        self.codes = None
+        self.lengths = None
+        self._code_mask = None  # which entries of `codes` aren't padding
 
 
     def train(self, alphabet_size, iter_train, iter_val):
@@ -25,23 +84,69 @@ class Huffman(Compressor):
         # because the priority queue involved in the Huffman construction
         # is monotonic.
 
-        tok_occ = dict([(i, 1) for i in range(alphabet_size)])  # token occurrences
-        for seq in pgb.progressbar(iter_train()):
-            for t in seq:
-                tok_occ[t] += 1
-
-        # now compute the prefix-free codebook:
-        self.codebook = huffman_codebook(self.d, tok_occ)
+        tok_occ = np.ones(alphabet_size, dtype=np.int64)  # token occurrences
+        for batch in _batches(pgb.progressbar(iter_train())):
+            flat, _ = _concatenate(batch, alphabet_size)
+            tok_occ += np.bincount(flat, minlength=alphabet_size)
 
+        # now compute the prefix-free code
+        self.alphabet_size = alphabet_size
+        self.codes, self.lengths = huffman_code_table(self.d, tok_occ, self.canonical)
+        self._code_mask = np.arange(self.codes.shape[1]) < self.lengths[:, None]
         return self.d
 
 
+    def _encode(self, flat):
+        """The concatenated codes of an array of tokens, as `bytes` if
+        they are byte-sized (which is what the byte-based compressors
+        that typically follow this one in a `Chain` expect), else as a
+        list, and the lengths of each token's code.
+        """
+        if len(flat) == 0:
+            return b"" if self.d <= 256 else [], np.zeros(0, dtype=np.int64)
+        lengths = self.lengths.take(flat)
+        if self.codes.shape[1] == 1:
+            # every code is a single symbol (e.g. for d=256 and at most
+            # 256 tokens), so there's no padding to remove
+            codes = self.codes[:, 0].take(flat)
+        else:
+            codes = self.codes.take(flat, axis=0)[self._code_mask.take(flat, axis=0)]
+        if self.d <= 256:
+            return codes.tobytes(), lengths
+        return codes.tolist(), lengths
+
+
     def compress(self, seq):
-        result = []
-        for t in seq:
-            result += self.codebook[t]
-        return result
+        return self._encode(_concatenate([seq], self.alphabet_size)[0])[0]
 
 
     def compressmany(self, seqs):
-        return super(Huffman, self).compressmany(seqs)
+        for batch in _batches(seqs):
+            flat, offsets = _concatenate(batch, self.alphabet_size)
+            codes, lengths = self._encode(flat)
+            # the offsets of each sequence's codes
+            ends = np.concatenate([[0], np.cumsum(lengths)])[offsets].tolist()
+            for i in range(len(batch)):
+                yield codes[ends[i]:ends[i + 1]]
+
+
+    def compressed_size(self, seq):
+        flat, _ = _concatenate([seq], self.alphabet_size)
+        return int(self.lengths.take(flat).sum())
+
+
+    def compressed_sizes(self, seqs):
+        for batch in _batches(seqs):
+            flat, offsets = _concatenate(batch, self.alphabet_size)
+            ends = np.concatenate([[0], np.cumsum(self.lengths.take(flat))])[offsets]
+            yield from np.diff(ends).tolist()
+
+
+    def concatenative(self):
+        return True
+
+
+    def cache_key(self):
+        # the codebook only depends on the token counts of the training
+        # set, not the order it is iterated in
+        return f"Huffman(d={self.d}, canonical={self.canonical})"
@@ -0,0 +1,66 @@
+import heapq
+import numpy as np
+import pytest
+import compressors as comp
+from compressors.coding import huffman_codebook, huffman_code_table
+
+
+def _reference_codebook(d, tokens):
+    # the original heap-of-lists construction
+    h = [(v, [(k, [])]) for k, v in tokens.items()]
+    heapq.heapify(h)
+    while len(h) > 1:
+        xs = []
+        for i in range(d):
+            xs.append(heapq.heappop(h))
+            if len(h) == 0:
+                break
+        new_p = sum(map(lambda t: t[0], xs))
+        new_code = [(k, [i] + code) for i, t in enumerate(xs) for k, code in t[1]]
+        heapq.heappush(h, (new_p, new_code))
+    return dict(h[0][1])
+
+
+@pytest.mark.parametrize("d", [2, 3, 256, 300])
+def test_huffman_codebook(d):
+    rng = np.random.default_rng(d)
+    for n in [1, 2, 5, 100, 700]:
+        # (small integer weights, to test the tie-breaking)
+        weights = rng.integers(1, 4, size=n).tolist()
+        tokens = dict(zip(rng.permutation(n).tolist(), weights))
+        assert(huffman_codebook(d, tokens) == _reference_codebook(d, tokens))
+
+
+@pytest.mark.parametrize("d", [2, 3, 256])
+def test_canonical_code_table(d):
+    weights = np.random.default_rng(0).zipf(1.5, size=500)
+    codes, lengths = huffman_code_table(d, weights)
+    canonical, canonical_lengths = huffman_code_table(d, weights, canonical=True)
+    assert((lengths == canonical_lengths).all())
+    words = [tuple(canonical[t, :lengths[t]].tolist()) for t in range(len(weights))]
+    # the codes are in order of length then token, and prefix-free
+    order = sorted(range(len(weights)), key=lambda t: (lengths[t], t))
+    assert([words[t] for t in order] == sorted(words, key=lambda w: (len(w), w)))
+    assert(max(map(max, words)) < d)
+    prefixes = set(w[:i] for w in words for i in range(len(w)))
+    assert(prefixes.isdisjoint(words))
+
+
+@pytest.mark.parametrize("d,alphabet_size", [(256, 32), (2, 32), (256, 1000), (300, 1000)])
+def test_huffman_inputs(d, alphabet_size):
+    rng = np.random.default_rng(0)
+    seqs = [rng.integers(0, alphabet_size, size=rng.integers(0, 50)).tolist()
+            for _ in range(100)]
+    huffman = comp.Huffman(d)
+    huffman.train(alphabet_size, lambda: iter(seqs), lambda: iter([]))
+    codebook = {t: huffman.codes[t, :huffman.lengths[t]].tolist()
+                for t in range(alphabet_size)}
+    expected = [sum([codebook[t] for t in s], []) for s in seqs]
+    if d <= 256:
+        expected = list(map(bytes, expected))
+    inputs = [seqs, [np.array(s, dtype=np.int32) for s in seqs]]
+    if alphabet_size <= 256:
+        inputs.append(list(map(bytes, seqs)))
+    for seqs in inputs:
+        assert(list(huffman.compressmany(seqs)) == expected)
+        assert([huffman.compress(s) for s in seqs] == expected)
@@ -0,0 +1,48 @@
+import os
+import sys
+import subprocess
+import pytest
+import compressors
+
+
+# the time allowed for importing the package and constructing a
+# non-deep compressor, in seconds (this takes around 0.01s, whereas
+# importing TensorFlow takes several seconds)
+STARTUP_BUDGET = 1.0
+
+
+def _run(code):
+    # run in a fresh interpreter, so that nothing is already imported
+    proc = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return proc.stdout.split()
+
+
+def test_non_deep_import_is_lazy():
+    out = _run(
+        "import sys\n"
+        "import compressors as comp\n"
+        "comp.Chain([comp.Huffman(256), comp.GZip()])\n"
+        "comp.Chain([comp.Huffman(256), comp.ZLib(), comp.BZ2(), comp.LZMA()])\n"
+        "print('tensorflow' in sys.modules, 'transformers' in sys.modules)\n"
+    )
+    assert(out == ['False', 'False'])
+
+
+def test_non_deep_startup_time():
+    out = _run(
+        "import time\n"
+        "t = time.perf_counter()\n"
+        "import compressors as comp\n"
+        "comp.Chain([comp.Huffman(256), comp.GZip()])\n"
+        "print(time.perf_counter() - t)\n"
+    )
+    assert(float(out[0]) < STARTUP_BUDGET)
+
+
+def test_lazy_attributes():
+    assert(compressors.GZip is compressors.gzipc.GZip)
+    assert('BERT' in dir(compressors))
+    with pytest.raises(AttributeError):
+        compressors.NotACompressor
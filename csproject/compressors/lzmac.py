@@ -4,7 +4,7 @@ Performs LZMA compression.
 
 
 import lzma
-from compressors.base import Compressor
+from compressors.base import Compressor, as_bytes
 
 
 class LZMA(Compressor):
@@ -16,8 +16,16 @@ class LZMA(Compressor):
 
 
     def compress(self, seq):
-        return list(map(int, lzma.compress(bytes(seq))))
+        return lzma.compress(as_bytes(seq))
 
 
     def compressmany(self, seqs):
         return super(LZMA, self).compressmany(seqs)
+
+
+    def compressed_size(self, seq):
+        return len(lzma.compress(as_bytes(seq)))
+
+
+    def compressed_sizes(self, seqs):
+        return map(self.compressed_size, seqs)
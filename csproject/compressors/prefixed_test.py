@@ -0,0 +1,63 @@
+import zlib
+import pytest
+import compressors as comp
+from compressors.testutil import prefix_data, trained
+
+
+@pytest.mark.parametrize("make", [
+    lambda: comp.ZLib(),
+    lambda: comp.GZip(),
+    lambda: comp.BZ2(),
+    lambda: comp.Chain([comp.Huffman(256), comp.GZip()]),
+    lambda: comp.Chain([comp.Huffman(256), comp.ZLib()]),
+    lambda: comp.Chain([comp.Huffman(256), comp.LZMA()]),
+    lambda: comp.Huffman(256),
+])
+def test_compressmany_prefixed_sizes(make):
+    prefix, suffixes = prefix_data()
+    compressor = trained(make(), [prefix] + suffixes)
+    expected = [len(s) for s in compressor.compressmany([prefix + s for s in suffixes])]
+    actual = [len(s) for s in compressor.compressmany_prefixed(prefix, suffixes)]
+    assert(actual == expected)
+
+
+def test_compressmany_prefixed_zlib_identical():
+    prefix, suffixes = prefix_data()
+    compressor = trained(comp.ZLib(), [])
+    expected = list(compressor.compressmany([prefix + s for s in suffixes]))
+    assert(list(compressor.compressmany_prefixed(prefix, suffixes)) == expected)
+
+
+def test_concatenative():
+    assert(comp.Huffman(256).concatenative())
+    assert(not comp.ZLib().concatenative())
+    assert(not comp.Chain([comp.Huffman(256), comp.ZLib()]).concatenative())
+
+
+def test_compressmany_conditional_zlib_decompresses():
+    prefix, suffixes = prefix_data()
+    compressor = trained(comp.ZLib(), [])
+    for s, c in zip(suffixes, compressor.compressmany_conditional(prefix, suffixes)):
+        decomp = zlib.decompressobj(wbits=-15, zdict=bytes(prefix))
+        assert(list(decomp.decompress(bytes(c))) == s)
+
+
+def test_compressmany_conditional_uses_context():
+    prefix, suffixes = prefix_data()
+    compressor = trained(comp.Chain([comp.Huffman(256), comp.ZLib()]),
+                         [prefix] + suffixes)
+    given_prefix = [len(c) for c in compressor.compressmany_conditional(prefix, suffixes)]
+    given_nothing = [len(c) for c in compressor.compressmany_conditional([], suffixes)]
+    # the first suffix is a copy of the prefix
+    assert(given_prefix[0] < given_nothing[0] // 2)
+
+
+def test_compressmany_conditional_unsupported():
+    with pytest.raises(NotImplementedError):
+        comp.BZ2().compressmany_conditional([], [])
+    with pytest.raises(NotImplementedError):
+        comp.Chain([comp.Huffman(256), comp.GZip()]).compressmany_conditional([], [])
+    # concatenative compressors don't depend on the context
+    huffman = trained(comp.Huffman(256), [[1, 2, 3]])
+    assert(list(comp.Chain([huffman]).compressmany_conditional([1, 2], [[3, 1]]))
+           == [huffman.compress([3, 1])])
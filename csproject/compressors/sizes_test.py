@@ -0,0 +1,44 @@
+import pytest
+import compressors as comp
+from compressors.testutil import prefix_data, trained
+
+
+@pytest.mark.parametrize("make", [
+    lambda: comp.ZLib(),
+    lambda: comp.GZip(),
+    lambda: comp.BZ2(),
+    lambda: comp.LZMA(),
+    lambda: comp.Huffman(256),
+    lambda: comp.Huffman(2),
+    lambda: comp.Chain([comp.Huffman(256), comp.ZLib()]),
+    lambda: comp.Chain([comp.Huffman(256), comp.BZ2()]),
+    lambda: comp.Chain([comp.ZLib(), comp.Huffman(256)]),
+])
+def test_compressed_sizes(make):
+    prefix, seqs = prefix_data()
+    compressor = trained(make(), [prefix] + seqs)
+    expected = [len(c) for c in compressor.compressmany(seqs)]
+    assert(list(compressor.compressed_sizes(seqs)) == expected)
+    assert([compressor.compressed_size(s) for s in seqs] == expected)
+
+    expected = [len(c) for c in compressor.compressmany_prefixed(prefix, seqs)]
+    assert(list(compressor.compressed_sizes_prefixed(prefix, seqs)) == expected)
+
+
+@pytest.mark.parametrize("make", [
+    lambda: comp.ZLib(),
+    lambda: comp.Chain([comp.Huffman(256), comp.ZLib()]),
+    lambda: comp.Chain([comp.Huffman(256), comp.ZLib(), comp.Huffman(256)]),
+])
+def test_compressed_sizes_conditional(make):
+    context, seqs = prefix_data()
+    compressor = trained(make(), [context] + seqs)
+    expected = [len(c) for c in compressor.compressmany_conditional(context, seqs)]
+    assert(list(compressor.compressed_sizes_conditional(context, seqs)) == expected)
+
+
+def test_block_compressed_size():
+    block = comp.Block(3)
+    block.train(4, lambda: iter([]), lambda: iter([]))
+    for n in range(8):
+        assert(block.compressed_size([1] * n) == len(list(block.compress([1] * n))))
@@ -0,0 +1,30 @@
+"""
+Helpers shared by the compressor tests.
+"""
+
+
+import numpy as np
+
+
+def prefix_data(n_suffixes=20, alphabet_size=64):
+    """A random prefix and random suffixes, some of which repeat the
+    prefix (so they compress well given it).
+
+    Returns:
+        A tuple `(prefix, suffixes)` of a list and a list of lists.
+    """
+    rng = np.random.default_rng(0)
+    prefix = rng.integers(0, alphabet_size, size=300).tolist()
+    suffixes = [rng.integers(0, alphabet_size, size=rng.integers(0, 400)).tolist()
+                for _ in range(n_suffixes)]
+    suffixes[0] = list(prefix)
+    suffixes[1] = prefix[:100] + suffixes[1]
+    return prefix, suffixes
+
+
+def trained(compressor, seqs, alphabet_size=256):
+    """Train a compressor on `seqs` (with no validation set), and
+    return it.
+    """
+    compressor.train(alphabet_size, lambda: iter(seqs), lambda: iter([]))
+    return compressor
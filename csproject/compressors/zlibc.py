@@ -4,7 +4,7 @@ Performs zlib compression.
 
 
 import zlib
-from compressors.base import Compressor
+from compressors.base import Compressor, as_bytes
 
 
 class ZLib(Compressor):
@@ -20,8 +20,59 @@ class ZLib(Compressor):
 
 
     def compress(self, seq):
-        return list(map(int, zlib.compress(bytes(seq), level=self.level)))
+        return zlib.compress(as_bytes(seq), level=self.level)
 
 
     def compressmany(self, seqs):
         return super(ZLib, self).compressmany(seqs)
+
+
+    def compressed_size(self, seq):
+        return len(zlib.compress(as_bytes(seq), level=self.level))
+
+
+    def compressed_sizes(self, seqs):
+        return map(self.compressed_size, seqs)
+
+
+    def _prefixed(self, prefix, suffixes):
+        # compress the prefix once, and then resume from a copy of the
+        # compressor's state for each suffix
+        head_comp = zlib.compressobj(level=self.level)
+        head = head_comp.compress(as_bytes(prefix))
+        for s in suffixes:
+            comp = head_comp.copy()
+            yield head + comp.compress(as_bytes(s)) + comp.flush()
+
+
+    def compressmany_prefixed(self, prefix, suffixes):
+        return self._prefixed(prefix, suffixes)
+
+
+    def compressed_sizes_prefixed(self, prefix, suffixes):
+        return map(len, self._prefixed(prefix, suffixes))
+
+
+    def _conditional(self, context, seqs):
+        # use the context as a preset dictionary (only the last 32KB of
+        # it are within deflate's window); setting the dictionary costs
+        # about as much as compressing it, so it is only done once.
+        # the output is raw deflate data, without zlib's header, dictionary
+        # ID and checksum, so that C(context) + C(seq | context) only
+        # counts them once, like the compression of the concatenation
+        context = as_bytes(context)
+        if len(context) > 0:
+            head_comp = zlib.compressobj(level=self.level, wbits=-15, zdict=context)
+        else:
+            head_comp = zlib.compressobj(level=self.level, wbits=-15)
+        for s in seqs:
+            comp = head_comp.copy()
+            yield comp.compress(as_bytes(s)) + comp.flush()
+
+
+    def compressmany_conditional(self, context, seqs):
+        return self._conditional(context, seqs)
+
+
+    def compressed_sizes_conditional(self, context, seqs):
+        return map(len, self._conditional(context, seqs))
@@ -4,9 +4,9 @@ Compute all of the similarity distances (NCDs).
 
 
 import os
-import itertools
 import argparse as ap
 import sqlite3 as sql
+import numpy as np
 import progressbar as pgb
 
 
@@ -14,31 +14,122 @@ import progressbar as pgb
 # C(x|y) = C(x, y) - C(y)
 # since in practice it is hard to construct a general mechanism for C(x|y)
 # (see https://arxiv.org/pdf/cs/0111054.pdf; this is acceptable)
+# for compressors run with `compress.py --conditional`, this is reversed,
+# i.e. C(x, y) = C(x) + C(y|x) using the conditional sizes directly
+# each formula is applied to whole NumPy arrays of compression sizes at once
 NCD_FORMULAE = {
     # https://arxiv.org/pdf/1006.3520.pdf def 3.1
-    'inf-dist': lambda xy, x, y: xy - min([x, y]),
+    'inf-dist': lambda xy, x, y: xy - np.minimum(x, y),
     # https://arxiv.org/pdf/cs/0111054.pdf def V.1
     'norm-inf-dist-1': lambda xy, x, y: 2.0 - (x + y) / xy,
     # https://arxiv.org/pdf/cs/0312044.pdf def 3.1
-    'norm-inf-dist-2': lambda xy, x, y: (xy - min([x, y])) / max([x, y]),
+    'norm-inf-dist-2': lambda xy, x, y: (xy - np.minimum(x, y)) / np.maximum(x, y),
     # my own idea, but almost surely tried before?
     'mutual-inf-esque': lambda xy, x, y: x + y - xy
 }
 
 
-def apply_ncd(data):
-    # unpacking
-    comp_data, ncd_formula_data = data
-    xy, x, y, seqid, compid = comp_data
-    ncd_formula, ncd_function = ncd_formula_data
-
-    return seqid, compid, ncd_formula, ncd_function(xy, x, y)
+# queries giving the (xy_compsz, x_compsz, y_compsz, seqid, compid) rows of
+# the pairs of the target compressors, from either the sizes of the pairs
+# or the conditional sizes of their sequences (a compressor run only has
+# one or the other); in both cases C(x, y) is symmetrised
+NCD_INPUT_QUERIES = [
+    """
+    SELECT (XY.compsz + YX.compsz) / 2.0 AS xy_compsz, X.compsz AS x_compsz, Y.compsz AS y_compsz,
+    SP1.seqid_out AS seqid, XY.compid
+    FROM SequencePairings AS SP1 JOIN SequencePairings AS SP2
+    ON SP1.seqid_left = SP2.seqid_right AND SP1.seqid_right = SP2.seqid_left
+    JOIN CompressionSizes AS XY ON SP1.seqid_out = XY.seqid
+    JOIN CompressionSizes AS YX ON SP2.seqid_out = YX.seqid AND XY.compid = YX.compid
+    JOIN CompressionSizes AS X ON XY.compid = X.compid AND SP1.seqid_left = X.seqid
+    JOIN CompressionSizes AS Y ON XY.compid = Y.compid AND SP1.seqid_right = Y.seqid
+    WHERE XY.compid IN (SELECT compid FROM TargetCompressors)
+    """,
+    """
+    SELECT (X.compsz + YgX.compsz + Y.compsz + XgY.compsz) / 2.0 AS xy_compsz,
+    X.compsz AS x_compsz, Y.compsz AS y_compsz, SP.seqid_out AS seqid, YgX.compid
+    FROM SequencePairings AS SP
+    JOIN ConditionalCompressionSizes AS YgX
+    ON SP.seqid_right = YgX.seqid AND SP.seqid_left = YgX.seqid_context
+    JOIN ConditionalCompressionSizes AS XgY
+    ON YgX.compid = XgY.compid AND SP.seqid_left = XgY.seqid AND SP.seqid_right = XgY.seqid_context
+    JOIN CompressionSizes AS X ON YgX.compid = X.compid AND SP.seqid_left = X.seqid
+    JOIN CompressionSizes AS Y ON YgX.compid = Y.compid AND SP.seqid_right = Y.seqid
+    WHERE YgX.compid IN (SELECT compid FROM TargetCompressors)
+    """
+]
+
+
+def has_table(cur, name):
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+    return cur.fetchone() is not None
+
+
+def apply_ncd(rows):
+    """Apply every NCD formula to a chunk of rows.
+
+    Args:
+        rows (list of tuple): (xy_compsz, x_compsz, y_compsz, seqid, compid)
+                              tuples.
+
+    Returns:
+        An iterator over (seqid, compid, ncd_formula, ncd_value) tuples.
+    """
+    rows = np.array(rows, dtype=np.float64)
+    xy, x, y = rows[:, 0], rows[:, 1], rows[:, 2]
+    seqids = rows[:, 3].astype(np.int64).tolist()
+    compids = rows[:, 4].astype(np.int64).tolist()
+    for ncd_formula, ncd_function in NCD_FORMULAE.items():
+        yield from zip(seqids, compids, [ncd_formula] * len(seqids),
+                       ncd_function(xy, x, y).tolist())
+
+
+def select_compids(cur, compid=None, incremental=False):
+    """Fill the temporary table `TargetCompressors` with the IDs of the
+    compressors whose NCDs should be (re)computed.
+
+    Args:
+        cur (sqlite3.Cursor): A cursor on the DB.
+        compid (int): If not None, only consider this compressor.
+        incremental (bool): If True, only consider compressors which do
+                            not yet have any NCD values.
+
+    Returns:
+        The sorted list of target compressor IDs.
+    """
+    cur.execute("CREATE TEMP TABLE TargetCompressors(compid INTEGER PRIMARY KEY)")
+    conds, params = [], []
+    if compid is not None:
+        conds.append("compid = ?")
+        params.append(compid)
+    if incremental:
+        conds.append("NOT EXISTS (SELECT 1 FROM NCDValues "
+                     "WHERE NCDValues.compid = Compressors.compid)")
+    where = (" WHERE " + " AND ".join(conds)) if len(conds) > 0 else ""
+    cur.execute("INSERT INTO TargetCompressors(compid) "
+                "SELECT compid FROM Compressors" + where, params)
+    cur.execute("SELECT compid FROM TargetCompressors ORDER BY compid")
+    return [row[0] for row in cur.fetchall()]
+
+
+def iterate_chunks(cur, chunk_sz):
+    rows = cur.fetchmany(chunk_sz)
+    while len(rows) > 0:
+        yield rows
+        rows = cur.fetchmany(chunk_sz)
 
 
 if __name__ == "__main__":
     parser = ap.ArgumentParser()
     parser.add_argument("db", type=str,
                         help="Filename of the DB to load.")
+    parser.add_argument("--chunk-sz", type=int, default=1 << 16,
+                        help="The number of sequence pairs to process at a time.")
+    parser.add_argument("--compid", type=int, default=None,
+                        help="Only compute the NCDs of this compressor run.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only compute the NCDs of compressor runs which "
+                             "do not have any yet, leaving all others as-is.")
     args = parser.parse_args()
 
     if not os.path.isfile(args.db):
@@ -53,28 +144,38 @@ if __name__ == "__main__":
 
     cur1.execute("PRAGMA FOREIGN_KEYS = ON")
 
+    # NCDs (and their training pairings) are only (re)computed for the
+    # target compressors, so that adding a compressor run doesn't
+    # require recomputing all of the previous ones
+    compids = select_compids(cur1, args.compid, args.incremental)
+    if len(compids) == 0:
+        print("No compressors to compute the NCDs of.")
+        exit(0)
+    print("Computing NCDs for compressors:", ", ".join(map(str, compids)))
+
     cur1.execute("""
-    SELECT (XY.compsz + YX.compsz) / 2.0 AS xy_compsz, X.compsz AS x_compsz, Y.compsz AS y_compsz,
-    SP1.seqid_out AS seqid, XY.compid
-    FROM SequencePairings AS SP1 JOIN SequencePairings AS SP2
-    ON SP1.seqid_left = SP2.seqid_right AND SP1.seqid_right = SP2.seqid_left
-    JOIN CompressionSizes AS XY ON SP1.seqid_out = XY.seqid
-    JOIN CompressionSizes AS YX ON SP2.seqid_out = YX.seqid AND XY.compid = YX.compid
-    JOIN CompressionSizes AS X ON XY.compid = X.compid AND SP1.seqid_left = X.seqid
-    JOIN CompressionSizes AS Y ON XY.compid = Y.compid AND SP1.seqid_right = Y.seqid
+    DELETE FROM NCDValues WHERE compid IN (SELECT compid FROM TargetCompressors)
     """)
-
+    queries = NCD_INPUT_QUERIES
+    if not has_table(cur1, 'ConditionalCompressionSizes'):
+        # the DB predates conditional compression, so has no such sizes
+        queries = queries[:1]
     cur2 = db.cursor()
-    cur2.executemany(
-        "INSERT INTO NCDValues(seqid, compid, ncd_formula, ncd_value) VALUES (?, ?, ?, ?)",
-        pgb.progressbar(map(
-            apply_ncd,
-            itertools.product(
-                cur1.fetchall(),
-                NCD_FORMULAE.items())))
-    )
-
-    cur2.execute("DELETE FROM TrainingPairings")
+    for query in queries:
+        cur1.execute(query)
+        for rows in pgb.progressbar(iterate_chunks(cur1, args.chunk_sz)):
+            cur2.executemany(
+                "INSERT INTO NCDValues(seqid, compid, ncd_formula, ncd_value) VALUES (?, ?, ?, ?)",
+                apply_ncd(rows)
+            )
+
+    if args.compid is None and not args.incremental:
+        cur2.execute("DELETE FROM TrainingPairings")
+    else:
+        cur2.execute("""
+        DELETE FROM TrainingPairings
+        WHERE compid IN (SELECT compid FROM TargetCompressors)
+        """)
     cur2.execute("""
     INSERT INTO TrainingPairings(
         compid, ncd_formula, seqid_train, seqid_other, ncd_value
@@ -83,11 +184,13 @@ if __name__ == "__main__":
     FROM SequencePairings JOIN Sequences ON seqid_left = Sequences.seqid
     JOIN NCDValues ON seqid_out = NCDValues.seqid
     WHERE Sequences.seqpart = 0
+    AND compid IN (SELECT compid FROM TargetCompressors)
     UNION
     SELECT compid, ncd_formula, seqid_right AS seqid_train, seqid_left AS seqid_other, ncd_value
     FROM SequencePairings JOIN Sequences ON seqid_right = Sequences.seqid
     JOIN NCDValues ON seqid_out = NCDValues.seqid
     WHERE Sequences.seqpart = 0
+    AND compid IN (SELECT compid FROM TargetCompressors)
     """)
 
     db.commit()
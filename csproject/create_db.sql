@@ -87,6 +87,16 @@ CREATE TABLE SequencePairings(
 CREATE INDEX seq_pair_left ON SequencePairings(seqid_left, seqid_right, seqid_out);
 CREATE INDEX seq_pair_right ON SequencePairings(seqid_right, seqid_left, seqid_out);
 
+CREATE TABLE VirtualPairings(
+    -- pairings whose values are NOT stored in `SequenceValues`, and are
+    -- instead synthesised from the left and right sequences when read
+    -- (see `seqstore.make_pair`)
+    seqid_out INTEGER PRIMARY KEY REFERENCES SequencePairings(seqid_out) ON DELETE CASCADE,
+    comma_tokid INTEGER NOT NULL REFERENCES Alphabet(tokid) ON DELETE CASCADE,
+    squash_start_end INTEGER NOT NULL,
+    CHECK(squash_start_end IN (0, 1))
+);
+
 CREATE TABLE CompressorArchitecture(
     compname TEXT PRIMARY KEY,  -- the name of the compressor
 
@@ -135,6 +145,18 @@ CREATE TABLE CompressionSizes(
     PRIMARY KEY(compid, seqid)
 );
 
+CREATE TABLE ConditionalCompressionSizes(
+    -- the size of `seqid` compressed with `seqid_context` as a preset
+    -- dictionary, i.e. C(seqid | seqid_context), for compressors which
+    -- support it (see `compress.py --conditional`)
+    -- INVARIANT: `seqid.seq_is_pair = 0 AND seqid_context.seq_is_pair = 0`
+    seqid INTEGER NOT NULL REFERENCES Sequences(seqid) ON DELETE CASCADE,
+    seqid_context INTEGER NOT NULL REFERENCES Sequences(seqid) ON DELETE CASCADE,
+    compid INTEGER NOT NULL REFERENCES Compressors(compid) ON DELETE CASCADE,
+    compsz INTEGER NOT NULL,
+    PRIMARY KEY(compid, seqid, seqid_context)
+);
+
 CREATE TABLE NCDValues(
     -- INVARIANT: `seqid.seq_is_pair = 1`
     seqid INTEGER NOT NULL REFERENCES Sequences(seqid) ON DELETE CASCADE,
@@ -68,13 +68,15 @@ if __name__ == "__main__":
     cur.executemany("INSERT INTO LabelTypes(lbltype) VALUES (?)",
                     map(lambda i: (i,), range(args.n_lbl_types)))
 
+    # label type `i` has `i + 2` (zero indexed) labels
     cur.executemany("INSERT INTO LabelDictionary(lbltype, lbl) VALUES (?, ?)",
-                    zip(range(args.n_lbl_types), range(2, args.n_lbl_types + 2)))
+                    [(lbltype, lbl) for lbltype in range(args.n_lbl_types)
+                     for lbl in range(lbltype + 2)])
 
     def gen_lbls():
         for seq_id in seq_ids:
             for lbltype in range(args.n_lbl_types):
-                lbl = random.randint(2, lbltype + 1)
+                lbl = random.randint(0, lbltype + 1)
                 yield seq_id, lbltype, lbl
 
     cur.executemany("INSERT INTO Labels(seqid, lbltype, lbl) VALUES (?, ?, ?)",
@@ -0,0 +1,37 @@
+"""
+Export all of the sequences in a DB to a packed, memory-mapped
+token store (see `seqstore/packed.py`), which can then be read
+by `compress.py` (and kept up to date by `pair_up.py`) instead
+of the `SequenceValues` table.
+"""
+
+
+import os
+import argparse as ap
+import sqlite3 as sql
+from seqstore import write_packed_store
+
+
+if __name__ == "__main__":
+    parser = ap.ArgumentParser()
+    parser.add_argument("db", type=str,
+                        help="Filename of the DB to export.")
+    parser.add_argument("store", type=str,
+                        help="Directory to create the packed store in.")
+    parser.add_argument("--no-virtual-pairs", action='store_true',
+                        help="Store the values of paired sequences "
+                             "physically, rather than synthesising them "
+                             "from their left and right sequences.")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.db):
+        print("Error: cannot find ", args.db)
+        exit(-1)
+
+    if os.path.exists(args.store):
+        print("Error: ", args.store, "exists. This script creates a new store.")
+        exit(-1)
+
+    db = sql.connect(args.db)
+    write_packed_store(db, args.store, virtual_pairs=not args.no_virtual_pairs)
+    db.close()
@@ -9,83 +9,150 @@ import itertools
 import argparse as ap
 import sqlite3 as sql
 import progressbar as pgb
+from seqstore import PackedStore
 
 
-def add_sequences(db, comma_id, iter, squash_start_end):
+def _insert_candidates(db, pairs, batch_sz=1 << 14):
+    """Put the pairs to create into the temporary table `CandidatePairs`,
+    skipping any repeats, or pairs which already exist. The candidates'
+    IDs `candid` are contiguous and start at 1, in the order of `pairs`.
+    """
+    pairs = iter(pairs)  # (so that each batch continues from the last)
+    cur = db.cursor()
+    cur.execute("""
+        CREATE TEMP TABLE CandidatePairs(
+            candid INTEGER PRIMARY KEY,
+            seqid_left INTEGER NOT NULL,
+            seqid_right INTEGER NOT NULL,
+            seqpart INTEGER NOT NULL,
+            UNIQUE(seqid_left, seqid_right)
+        )
+    """)
+    # the pairs are inserted in batches so that the pairing generators
+    # (which run their own queries) never run in the middle of `executemany`
+    batch = list(itertools.islice(pairs, batch_sz))
+    while len(batch) > 0:
+        # (an ignored row does not use up a `candid`)
+        cur.executemany("""
+            INSERT OR IGNORE INTO CandidatePairs(seqid_left, seqid_right, seqpart)
+            SELECT ?1, ?2, ?3 WHERE NOT EXISTS (
+                SELECT 1 FROM SequencePairings
+                WHERE seqid_left = ?1 AND seqid_right = ?2
+            )
+        """, batch)
+        batch = list(itertools.islice(pairs, batch_sz))
+
+
+def _create_pairs(db, comma_id, iter, squash_start_end, virtual, batch_sz=1 << 12):
     cur = db.cursor()
     cur.execute("SELECT MAX(seqid) + 1 FROM Sequences")
     next_seq_id = cur.fetchone()[0]
-    for seq_left, seq_right, seqpart_out in iter:
-        # do not error on producing repeats
-        cur.execute("""
-            SELECT 1 FROM SequencePairings
-            WHERE seqid_left = ? AND seqid_right = ?
-        """, (seq_left, seq_right))
-        if cur.fetchone() is not None:
-            continue
 
-        # create a new sequence entry
-        cur.execute("""
-            INSERT INTO Sequences(seqid, seqpart, seq_is_pair)
-            VALUES (?, ?, 1)
-        """, (next_seq_id, seqpart_out))
+    _insert_candidates(db, iter)
 
-        # mark it as paired
-        cur.execute("""
-            INSERT INTO SequencePairings(seqid_left, seqid_right, seqid_out)
-            VALUES (?, ?, ?)
-        """, (seq_left, seq_right, next_seq_id))
+    # a candidate's output sequence ID is `next_seq_id + candid - 1`
+    cur.execute("""
+        INSERT INTO Sequences(seqid, seqpart, seq_is_pair)
+        SELECT ?1 + candid - 1, seqpart, 1 FROM CandidatePairs
+    """, (next_seq_id,))
+    cur.execute("""
+        INSERT INTO SequencePairings(seqid_out, seqid_left, seqid_right)
+        SELECT ?1 + candid - 1, seqid_left, seqid_right FROM CandidatePairs
+    """, (next_seq_id,))
 
-        # get leftmost sequence length
+    if virtual:
+        # DBs created before virtual pairs were added lack the table
+        # (see `create_db.sql`)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS VirtualPairings(
+                seqid_out INTEGER PRIMARY KEY REFERENCES SequencePairings(seqid_out) ON DELETE CASCADE,
+                comma_tokid INTEGER NOT NULL REFERENCES Alphabet(tokid) ON DELETE CASCADE,
+                squash_start_end INTEGER NOT NULL,
+                CHECK(squash_start_end IN (0, 1))
+            )
+        """)
         cur.execute("""
-            SELECT MAX(svidx) + 1 FROM SequenceValues WHERE seqid = ?
-        """, (seq_left,))
-        seq_left_sz = cur.fetchone()[0]
+            INSERT INTO VirtualPairings(seqid_out, comma_tokid, squash_start_end)
+            SELECT ?1 + candid - 1, ?2, ?3 FROM CandidatePairs
+        """, (next_seq_id, comma_id, 1 if squash_start_end else 0))
+    else:
+        # the lengths of all of the left sequences
+        cur.execute("""
+            CREATE TEMP TABLE LeftLengths(seqid INTEGER PRIMARY KEY, slen INTEGER NOT NULL)
+        """)
+        cur.execute("""
+            INSERT INTO LeftLengths(seqid, slen)
+            SELECT seqid, MAX(svidx) + 1 FROM SequenceValues
+            WHERE seqid IN (SELECT seqid_left FROM CandidatePairs)
+            GROUP BY seqid
+        """)
 
-        if squash_start_end:
-            # copy leftmost sequence
-            # don't copy end token
+        # when squashing, don't copy the end token of the left sequence,
+        # or the start token of the right sequence
+        squash = 1 if squash_start_end else 0
+
+        # copy the leftmost sequence, insert the comma, then copy the
+        # rightmost sequence, all at once (the rows are sorted so that
+        # they are appended to `SequenceValues` in primary key order,
+        # and this is done in batches to keep the sorts small)
+        cur.execute("SELECT COUNT(*) FROM CandidatePairs")
+        n_candidates = cur.fetchone()[0]
+        # it is much faster to rebuild the token index once at the end,
+        # than to update it for every row (see `create_db.sql`)
+        cur.execute("DROP INDEX IF EXISTS seq_vals_idx")
+        for first_candid in range(1, n_candidates + 1, batch_sz):
             cur.execute("""
                 INSERT INTO SequenceValues(seqid, svidx, tokid)
-                SELECT ?, svidx, tokid FROM SequenceValues
-                WHERE seqid = ? AND svidx + 1 < ?
-            """, (next_seq_id, seq_left, seq_left_sz))
+                SELECT ?1 + candid - 1, svidx, tokid FROM (
+                    SELECT candid, svidx, tokid
+                    FROM CandidatePairs JOIN LeftLengths ON seqid_left = LeftLengths.seqid
+                    JOIN SequenceValues ON seqid_left = SequenceValues.seqid
+                    WHERE candid BETWEEN ?4 AND ?5 AND svidx < slen - ?2
+                    UNION ALL
+                    SELECT candid, slen - ?2 AS svidx, ?3 AS tokid
+                    FROM CandidatePairs JOIN LeftLengths ON seqid_left = LeftLengths.seqid
+                    WHERE candid BETWEEN ?4 AND ?5
+                    UNION ALL
+                    SELECT candid, svidx + slen + 1 - 2 * ?2 AS svidx, tokid
+                    FROM CandidatePairs JOIN LeftLengths ON seqid_left = LeftLengths.seqid
+                    JOIN SequenceValues ON seqid_right = SequenceValues.seqid
+                    WHERE candid BETWEEN ?4 AND ?5 AND svidx >= ?2
+                )
+                ORDER BY candid ASC, svidx ASC
+            """, (next_seq_id, squash, comma_id,
+                  first_candid, first_candid + batch_sz - 1))
+        cur.execute("CREATE INDEX seq_vals_idx ON SequenceValues(tokid, seqid)")
+
+        cur.execute("DROP TABLE LeftLengths")
 
-            # insert comma
-            cur.execute("""
-                INSERT INTO SequenceValues(seqid, svidx, tokid)
-                VALUES (?, ?, ?)
-            """, (next_seq_id, seq_left_sz - 1, comma_id))
+    cur.execute("""
+        SELECT ?1 + candid - 1, seqid_left, seqid_right FROM CandidatePairs
+        ORDER BY candid ASC
+    """, (next_seq_id,))
+    added = cur.fetchall()
+    cur.execute("DROP TABLE CandidatePairs")
+    return added
 
-            # copy rightmost sequence
-            # don't copy first token
-            cur.execute("""
-                INSERT INTO SequenceValues(seqid, svidx, tokid)
-                SELECT ?, svidx + ? - 1, tokid FROM SequenceValues
-                WHERE seqid = ? AND svidx > 0
-            """, (next_seq_id, seq_left_sz, seq_right))
-        else:
-            # copy leftmost sequence
-            cur.execute("""
-                INSERT INTO SequenceValues(seqid, svidx, tokid)
-                SELECT ?, svidx, tokid FROM SequenceValues
-                WHERE seqid = ?
-            """, (next_seq_id, seq_left))
 
-            # insert comma
-            cur.execute("""
-                INSERT INTO SequenceValues(seqid, svidx, tokid)
-                VALUES (?, ?, ?)
-            """, (next_seq_id, seq_left_sz, comma_id))
+def add_sequences(db, comma_id, iter, squash_start_end):
+    """Create a new paired sequence for each (left, right, seqpart)
+    triple in `iter`, skipping pairs which already exist.
 
-            # copy rightmost sequence
-            cur.execute("""
-                INSERT INTO SequenceValues(seqid, svidx, tokid)
-                SELECT ?, svidx + ?, tokid FROM SequenceValues WHERE seqid = ?
-            """, (next_seq_id, seq_left_sz + 1, seq_right))
+    Returns:
+        list: The (seqid_out, seqid_left, seqid_right) of the new pairs.
+    """
+    return _create_pairs(db, comma_id, iter, squash_start_end, False)
+
+
+def add_virtual_sequences(db, comma_id, iter, squash_start_end):
+    """Like `add_sequences`, but the pairs are *virtual*: their
+    values are not copied into `SequenceValues`, and are instead
+    synthesised by `seqstore.SequenceReader` when read.
 
-        # advance output sequence ID
-        next_seq_id += 1
+    Returns:
+        list: The (seqid_out, seqid_left, seqid_right) of the new pairs.
+    """
+    return _create_pairs(db, comma_id, iter, squash_start_end, True)
 
 
 def get_reflexive_sequences(db):  # get all sequences matched in a pair with themselves
@@ -255,16 +322,36 @@ if __name__ == "__main__":
                              "to *only* retain these at the start of the "
                              "first sentence and the end of the last sentence. "
                              "Tldr: set this for BERT models.")
+    parser.add_argument("--virtual", action='store_true',
+                        help="Only record the pairings, and do not copy the "
+                             "sequence values; these are instead synthesised "
+                             "whenever the pairs are read.")
+    parser.add_argument("--packed-store", type=str, default=None,
+                        help="If set, also add the new pairs to this packed "
+                             "store (see `pack_db.py`).")
     args = parser.parse_args()
 
     if not os.path.isfile(args.db):
         print("Error: cannot find ", args.db)
         exit(-1)
 
+    if args.packed_store is not None and not os.path.isdir(args.packed_store):
+        print("Error:", args.packed_store, "is not a directory.")
+        exit(-1)
+
     db = sql.connect(args.db)
     cur = db.cursor()
     cur.execute("PRAGMA FOREIGN_KEYS = ON")
 
+    store = None
+    if args.packed_store is not None:
+        store = PackedStore(args.packed_store)
+        try:
+            store.check(db)
+        except ValueError as e:
+            print("Error:", e)
+            exit(-1)
+
     if args.lbltype == '*':
         cur.execute("SELECT lbltype_name FROM LabelTypes")
         args.lbltype = list(
@@ -298,7 +385,7 @@ if __name__ == "__main__":
         else:
             comma_id = comma_id[0]
 
-    add_sequences(
+    added = (add_virtual_sequences if args.virtual else add_sequences)(
         db, comma_id,
         pgb.progressbar(
             itertools.chain(
@@ -313,5 +400,10 @@ if __name__ == "__main__":
         args.squash_start_end
     )
 
+    if store is not None:
+        store.add_pairs(added, comma_id, args.squash_start_end)
+
     db.commit()
+    if store is not None:
+        store.mark_up_to_date(db)
     db.close()
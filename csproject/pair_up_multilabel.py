@@ -10,7 +10,10 @@ import itertools
 import argparse as ap
 import sqlite3 as sql
 import progressbar as pgb
-from pair_up import add_sequences, get_reflexive_sequences
+from pair_up import (
+    add_sequences, add_virtual_sequences, get_reflexive_sequences
+)
+from seqstore import PackedStore
 
 
 def get_pairs_all_lbltypes(db, n, m):
@@ -72,16 +75,36 @@ if __name__ == "__main__":
                              "to *only* retain these at the start of the "
                              "first sentence and the end of the last sentence. "
                              "Tldr: set this for BERT models.")
+    parser.add_argument("--virtual", action='store_true',
+                        help="Only record the pairings, and do not copy the "
+                             "sequence values; these are instead synthesised "
+                             "whenever the pairs are read.")
+    parser.add_argument("--packed-store", type=str, default=None,
+                        help="If set, also add the new pairs to this packed "
+                             "store (see `pack_db.py`).")
     args = parser.parse_args()
 
     if not os.path.isfile(args.db):
         print("Error: cannot find ", args.db)
         exit(-1)
 
+    if args.packed_store is not None and not os.path.isdir(args.packed_store):
+        print("Error:", args.packed_store, "is not a directory.")
+        exit(-1)
+
     db = sql.connect(args.db)
     cur = db.cursor()
     cur.execute("PRAGMA FOREIGN_KEYS = ON")
 
+    store = None
+    if args.packed_store is not None:
+        store = PackedStore(args.packed_store)
+        try:
+            store.check(db)
+        except ValueError as e:
+            print("Error:", e)
+            exit(-1)
+
     assert(args.n > 0)
     assert(args.m > 0)
     
@@ -102,7 +125,7 @@ if __name__ == "__main__":
         else:
             comma_id = comma_id[0]
 
-    add_sequences(
+    added = (add_virtual_sequences if args.virtual else add_sequences)(
         db, comma_id,
         pgb.progressbar(
             itertools.chain(
@@ -113,5 +136,10 @@ if __name__ == "__main__":
         args.squash_start_end
     )
 
+    if store is not None:
+        store.add_pairs(added, comma_id, args.squash_start_end)
+
     db.commit()
+    if store is not None:
+        store.mark_up_to_date(db)
     db.close()
@@ -0,0 +1,46 @@
+import os
+import sqlite3 as sql
+import testutil
+from pair_up import add_sequences, add_virtual_sequences, get_reflexive_sequences, _create_pairs
+from seqstore import SequenceReader, make_pair
+
+
+def test_virtual_pairs_baseline_db(tmp_path):
+    # virtual pairs on a DB created before they were added, which read
+    # back the same as pairs whose values are stored
+    fnames = [os.path.join(tmp_path, "stored.db"), os.path.join(tmp_path, "virtual.db")]
+    for fname, add in zip(fnames, [add_sequences, add_virtual_sequences]):
+        db = testutil.create_db(fname, baseline=True)
+        add(db, 16, get_reflexive_sequences(db), False)
+        db.commit()
+        db.close()
+
+    pairs = []
+    for fname in fnames:
+        db = sql.connect(fname)
+        ids = [row[0] for row in db.execute("SELECT seqid_out FROM SequencePairings "
+                                            "ORDER BY seqid_out")]
+        assert(len(ids) == 40)
+        pairs.append(list(SequenceReader(db, ids)))
+        db.close()
+    assert(pairs[0] == pairs[1])
+
+
+def test_pair_values(tmp_path):
+    for squash_start_end in [False, True]:
+        db = testutil.create_db(os.path.join(tmp_path, f"squash{int(squash_start_end)}.db"))
+        # every ordered pair of the first few sequences (as a list, rather
+        # than a generator), in small batches (see `_create_pairs`)
+        added = _create_pairs(db, 16, [(a, b, 0) for a in range(8) for b in range(8)],
+                              squash_start_end, False, batch_sz=10)
+        db.commit()
+        assert(len(added) == 64)
+
+        ids = [seqid_out for seqid_out, _, _ in added]
+        seqs = dict(zip(range(8), SequenceReader(db, list(range(8)))))
+        for (_, left, right), pair in zip(added, SequenceReader(db, ids)):
+            assert(pair == make_pair(seqs[left], seqs[right], 16, squash_start_end).tolist())
+        # the token index is rebuilt afterwards
+        assert(db.execute("SELECT 1 FROM sqlite_master "
+                          "WHERE type = 'index' AND name = 'seq_vals_idx'").fetchone() is not None)
+        db.close()
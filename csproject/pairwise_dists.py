@@ -0,0 +1,387 @@
+"""
+Once all of the similarity distances (NCDs) have been computed, this
+script computes the distance between every pair of non-training
+sequences (in the same partition), by aggregating over the training
+sequences, and saves them to the `PairwiseDistances` table.
+This replaces the C++ tool in `csproject_pairwise_dists/`.
+"""
+
+
+import os
+import itertools
+import argparse as ap
+import sqlite3 as sql
+import multiprocessing as mp
+import numpy as np
+import progressbar as pgb
+
+
+def get_groups(db):
+    cur = db.cursor()
+    cur.execute("SELECT DISTINCT compid, ncd_formula FROM TrainingPairings "
+                "ORDER BY compid, ncd_formula")
+    return cur.fetchall()
+
+
+def load_group(db, compid, ncd_formula, batch_sz=1 << 16):
+    """Load the NCDs between the non-training sequences and the training
+    sequences for a given compressor and NCD formula, as a dense matrix.
+
+    Args:
+        db (sqlite3.Connection): The DB to read from.
+        compid (int): The compressor.
+        ncd_formula (str): The NCD formula.
+        batch_sz (int, optional): The number of rows to fetch at a time.
+
+    Returns:
+        A tuple `(seqids_other, seqparts, seqids_train, ncds)`, where
+        `seqids_other` and `seqparts` are vectors of the (sorted) non-
+        training sequence IDs and their partitions, `seqids_train` is
+        the (sorted) vector of training sequence IDs, and `ncds` is the
+        (others x train) matrix of NCD values.
+    """
+    cur = db.cursor()
+    # the partitions are looked up separately, since joining each row
+    # with `Sequences` is much slower
+    cur.execute("""
+    SELECT seqid, seqpart FROM Sequences
+    WHERE seqpart > 0 AND seqid IN (
+        SELECT seqid_other FROM TrainingPairings
+        WHERE compid = ? AND ncd_formula = ?
+    )
+    ORDER BY seqid
+    """, (compid, ncd_formula))
+    parts = np.array(cur.fetchall(), dtype=np.int64).reshape(-1, 2)
+
+    # this is the order of the primary key of `TrainingPairings`
+    cur.execute("""
+    SELECT seqid_other, seqid_train, ncd_value FROM TrainingPairings
+    WHERE compid = ? AND ncd_formula = ?
+    ORDER BY seqid_other, seqid_train
+    """, (compid, ncd_formula))
+    rows = []
+    while True:
+        batch = np.array(cur.fetchmany(batch_sz), dtype=np.float64).reshape(-1, 3)
+        if len(batch) == 0:
+            break
+        # only keep the non-training sequences
+        rows.append(batch[np.isin(batch[:, 0], parts[:, 0])])
+    rows = np.concatenate(rows) if len(rows) > 0 else np.zeros((0, 3))
+    if len(rows) == 0:
+        return (np.zeros(0, np.int64), np.zeros(0, np.int64),
+                np.zeros(0, np.int64), np.zeros((0, 0)))
+    seqid_other = rows[:, 0].astype(np.int64)
+    seqid_train = rows[:, 1].astype(np.int64)
+
+    starts = np.flatnonzero(np.diff(seqid_other, prepend=-1))
+    seqids_other = seqid_other[starts]
+    seqparts = parts[:, 1]
+    n_train = len(rows) // max(1, len(starts))
+    seqids_train = seqid_train[:n_train]
+
+    # every non-training sequence must be paired with every training
+    # sequence, otherwise the aggregated distances aren't comparable
+    if len(rows) != len(starts) * n_train \
+            or np.any(seqid_train.reshape(-1, n_train) != seqids_train):
+        raise ValueError("Incomplete TrainingPairings for compressor "
+                         f"{compid} and NCD formula {ncd_formula}.")
+
+    ncds = rows[:, 2].reshape(len(starts), n_train)
+    return seqids_other, seqparts, seqids_train, ncds
+
+
+# Distance aggregators, which combine the distances between two
+# sequences `a` and `b` via each training sequence `t` (i.e.
+# `ncd(a, t) + ncd(b, t)`) into a single distance. Each entry maps a
+# name to a function which takes the aggregator's configuration and
+# returns a function of a (pairs x train) matrix of such distances and
+# the average NCD of the group, giving a vector of aggregated distances.
+def _min_plus():
+    return lambda dists, avg_dist: np.min(dists, axis=1)
+
+
+def _kernel_sim(bandwidth=None):
+    # NOTE: this is a similarity rather than a distance
+    def agg(dists, avg_dist):
+        h = avg_dist if bandwidth is None else bandwidth
+        sims = np.maximum(dists, 0.0)
+        sims *= -2.0
+        sims /= h
+        return np.sum(np.exp(sims, out=sims), axis=1)
+    return agg
+
+
+def _soft_min(temp=None):
+    # computed stably with the log-sum-exp trick
+    def agg(dists, avg_dist):
+        t = avg_dist if temp is None else temp
+        mins = np.min(dists, axis=1)
+        return mins - t * np.log(np.sum(np.exp((mins[:, None] - dists) / t), axis=1))
+    return agg
+
+
+def _mean():
+    return lambda dists, avg_dist: np.mean(dists, axis=1)
+
+
+def _top_k_mean(k=5):
+    def agg(dists, avg_dist):
+        kk = min(k, dists.shape[1])
+        return np.mean(np.partition(dists, kk - 1, axis=1)[:, :kk], axis=1)
+    return agg
+
+
+AGGREGATORS = {
+    'mp': _min_plus,
+    'sim': _kernel_sim,
+    'softmin': _soft_min,
+    'mean': _mean,
+    'topk': _top_k_mean
+}
+
+
+def parse_config(config_str):
+    for stmt in config_str.split(','):
+        stmt = stmt.split('=')
+        assert(len(stmt) == 2)
+        try:
+            yield stmt[0], int(stmt[1])
+        except ValueError:
+            yield stmt[0], float(stmt[1])
+
+
+def get_aggregator(spec):
+    """Construct an aggregator from its specification, which is its
+    name in `AGGREGATORS` optionally followed by a colon and a comma-
+    separated list of key=value pairs, e.g. `sim:bandwidth=0.5`.
+    The specification is also the name the results are saved under.
+    """
+    name, _, config_str = spec.partition(':')
+    if name not in AGGREGATORS:
+        raise ValueError(f"Unknown distance aggregator {name}.")
+    config = dict(parse_config(config_str)) if len(config_str) > 0 else {}
+    return AGGREGATORS[name](**config)
+
+
+def aggregate_block(ncds_a, ncds_b, avg_dist, aggregators):
+    """Compute the aggregated distances between every row `a` of
+    `ncds_a` and every row `b` of `ncds_b`, where the distance between
+    `a` and `b` via training sequence `t` is `ncds_a[a, t] + ncds_b[b, t]`.
+    These distances are computed once, and shared by all of the
+    aggregators.
+
+    Args:
+        ncds_a (np.ndarray): An (a x train) matrix of NCDs.
+        ncds_b (np.ndarray): A (b x train) matrix of NCDs.
+        avg_dist (float): The average NCD of the group.
+        aggregators (list): Functions constructed by `get_aggregator`.
+
+    Returns:
+        A tuple `(argmin, dists)`, where `argmin` is the vector of the
+        (first) indices of the training sequences giving the smallest
+        distances, and `dists` is a list of vectors of aggregated
+        distances, one for each aggregator. Both are flattened in
+        row-major order of `(a, b)`.
+    """
+    dists = (ncds_a[:, None, :] + ncds_b[None, :, :]).reshape(-1, ncds_a.shape[1])
+    return np.argmin(dists, axis=1), [agg(dists, avg_dist) for agg in aggregators]
+
+
+def compute_group(db, compid, ncd_formula, block_sz, agg_specs):
+    """Compute the pairwise distances of a given compressor and NCD
+    formula, under each of the given aggregator specifications, a block
+    of sequences `seqid_1` at a time. Each pair of sequences is saved
+    both ways round, so each block covers all of the pairs of its
+    sequences, and the blocks are in primary key order.
+
+    Args:
+        db (sqlite3.Connection): The DB to read from.
+        compid (int): The compressor.
+        ncd_formula (str): The NCD formula.
+        block_sz (int): The maximum number of intermediate distances
+                        to hold in memory at once.
+        agg_specs (list of str): The aggregator specifications (see
+                                 `get_aggregator`).
+
+    Returns:
+        An iterator over blocks, each of which is a list of
+        `(dist_aggregator, seqid_1, seqid_2, seqid_train, dist)` tuples,
+        where all but the first element are vectors sorted by
+        `(seqid_1, seqid_2)`.
+    """
+    aggregators = list(map(get_aggregator, agg_specs))
+    seqids_other, seqparts, seqids_train, ncds = load_group(db, compid, ncd_formula)
+    if ncds.size == 0:
+        return
+    avg_dist = np.mean(ncds)
+
+    # only sequences in the same partition are paired
+    members = {part: np.flatnonzero(seqparts == part) for part in np.unique(seqparts)}
+    largest = max(map(len, members.values()))
+    n_rows = max(1, block_sz // (largest * len(seqids_train)))
+    for a_0 in range(0, len(seqids_other), n_rows):
+        block = np.arange(a_0, min(a_0 + n_rows, len(seqids_other)))
+        a, b, argmin = [], [], []
+        dists = [[] for _ in aggregators]
+        for part in np.unique(seqparts[block]):
+            rows = block[seqparts[block] == part]
+            part_argmin, part_dists = aggregate_block(
+                ncds[rows], ncds[members[part]], avg_dist, aggregators)
+            a.append(np.repeat(rows, len(members[part])))
+            b.append(np.tile(members[part], len(rows)))
+            argmin.append(part_argmin)
+            for i, dist in enumerate(part_dists):
+                dists[i].append(dist)
+        a, b, argmin = map(np.concatenate, (a, b, argmin))
+
+        # the rows of each partition are sorted by `(a, b)`, so merging
+        # them by `a` gives primary key order (the IDs are sorted too)
+        order = np.argsort(a, kind='stable')
+        order = order[a[order] != b[order]]
+        seqid_1 = seqids_other[a[order]]
+        seqid_2 = seqids_other[b[order]]
+        seqid_train = seqids_train[argmin[order]]
+        yield [(spec, seqid_1, seqid_2, seqid_train, np.concatenate(dist)[order])
+               for spec, dist in zip(agg_specs, dists)]
+
+
+def iterate_rows(compid, ncd_formula, block):
+    """Iterate over the `PairwiseDistances` rows of a block output by
+    `compute_group`.
+    """
+    for dist_aggregator, seqid_1, seqid_2, seqid_train, dist in block:
+        yield from zip(itertools.repeat(compid), itertools.repeat(ncd_formula),
+                       itertools.repeat(dist_aggregator), seqid_1.tolist(),
+                       seqid_2.tolist(), seqid_train.tolist(), dist.tolist())
+
+
+def connect(db_fname):
+    """Connect to the DB, with a page cache large enough that reading
+    `TrainingPairings` and writing `PairwiseDistances` (whose indices
+    are updated in several places at once) don't thrash it.
+    """
+    db = sql.connect(db_fname)
+    db.execute("PRAGMA CACHE_SIZE = -65536")  # in KiB
+    return db
+
+
+# each worker process of the pool holds its own DB connection, and
+# passes the blocks it computes back over a shared, bounded queue
+_worker_db = None
+_worker_queue = None
+
+
+def _init_worker(db_fname, queue):
+    global _worker_db, _worker_queue
+    _worker_db = connect(db_fname)
+    _worker_queue = queue
+
+
+def _compute_group(args):
+    compid, ncd_formula, block_sz, agg_specs = args
+    try:
+        for block in compute_group(_worker_db, compid, ncd_formula, block_sz, agg_specs):
+            _worker_queue.put((compid, ncd_formula, block))
+    finally:
+        # marks the end of the group, even if it failed
+        _worker_queue.put((compid, ncd_formula, None))
+
+
+def compute_groups(db_fname, groups, block_sz, agg_specs, workers, queue_sz=16):
+    """Compute the pairwise distances of each of the given groups, using a
+    pool of worker processes, each of which handles a group at a time.
+    The blocks are passed back as they are computed, over a queue of at
+    most `queue_sz` blocks, so only a few blocks are in memory at once.
+
+    Args:
+        db_fname (str): The DB filename, which each worker opens itself.
+        groups (list): The `(compid, ncd_formula)` groups.
+        block_sz (int): Passed to `compute_group`.
+        agg_specs (list of str): Passed to `compute_group`.
+        workers (int): The number of worker processes.
+        queue_sz (int, optional): The maximum number of blocks waiting
+                                  to be returned.
+
+    Returns:
+        An iterator over `(compid, ncd_formula, block)` tuples, where
+        `block` is as output by `compute_group`. The blocks of each group
+        are in order, but may be interleaved with those of other groups.
+    """
+    queue = mp.Queue(queue_sz)
+    with mp.Pool(workers, initializer=_init_worker, initargs=(db_fname, queue)) as pool:
+        result = pool.map_async(_compute_group, [
+            (compid, ncd_formula, block_sz, agg_specs) for compid, ncd_formula in groups])
+        n_done = 0
+        while n_done < len(groups):
+            compid, ncd_formula, block = queue.get()
+            if block is None:
+                n_done += 1
+            else:
+                yield compid, ncd_formula, block
+        # raises any exception of the workers
+        result.get()
+
+
+if __name__ == "__main__":
+    parser = ap.ArgumentParser()
+    parser.add_argument("db", type=str,
+                        help="Filename of the DB to load.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes to compute distances with. "
+                             "Each process handles a single compressor and "
+                             "NCD formula at a time.")
+    parser.add_argument("--block-sz", type=int, default=1 << 24,
+                        help="The maximum number of intermediate distances "
+                             "to hold in memory at once, per process.")
+    parser.add_argument("--aggregators", type=str, nargs='+', default=['mp', 'sim'],
+                        help="The distance aggregators to compute. Each must "
+                             "be one of: " + ", ".join(AGGREGATORS.keys()) +
+                             ", optionally followed by a colon and a comma-"
+                             "separated list of key=value pairs to configure "
+                             "it, e.g. `sim:bandwidth=0.5` or `topk:k=3`.")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.db):
+        print("Error: cannot find ", args.db)
+        exit(-1)
+
+    if args.workers < 1 or args.block_sz < 1:
+        print("Error: --workers and --block-sz must be positive.")
+        exit(-1)
+
+    for spec in args.aggregators:
+        try:
+            get_aggregator(spec)
+        except (ValueError, TypeError, AssertionError):
+            print("Error:", spec, "is not a valid distance aggregator.")
+            print("Allowed values are:", ", ".join(AGGREGATORS.keys()))
+            exit(-1)
+
+    db = connect(args.db)
+    cur = db.cursor()
+    cur.execute("PRAGMA FOREIGN_KEYS = ON")
+
+    groups = get_groups(db)
+    # re-running replaces the existing distances
+    cur.executemany("DELETE FROM PairwiseDistances "
+                    "WHERE compid = ? AND ncd_formula = ? "
+                    "AND dist_aggregator = ?",
+                    [(compid, ncd_formula, spec)
+                     for compid, ncd_formula in groups for spec in args.aggregators])
+    if args.workers > 1:
+        blocks = compute_groups(args.db, groups, args.block_sz, args.aggregators,
+                                args.workers)
+    else:
+        blocks = ((compid, ncd_formula, block) for compid, ncd_formula in groups
+                  for block in compute_group(db, compid, ncd_formula,
+                                             args.block_sz, args.aggregators))
+    for compid, ncd_formula, block in pgb.progressbar(blocks):
+        cur.executemany("""
+        INSERT INTO PairwiseDistances(
+            compid, ncd_formula, dist_aggregator,
+            seqid_1, seqid_2, seqid_train, dist)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, iterate_rows(compid, ncd_formula, block))
+
+    db.commit()
+    db.close()
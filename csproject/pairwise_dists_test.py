@@ -0,0 +1,70 @@
+import numpy as np
+import testutil
+from pairwise_dists import compute_group, compute_groups, get_aggregator
+
+
+def _create_db(path):
+    # the non-training sequences of `testutil.create_db` are in
+    # partitions 1 and 2, which are interleaved
+    db = testutil.create_db(path)
+    rng = np.random.default_rng(0)
+    train = [row[0] for row in db.execute("SELECT seqid FROM Sequences WHERE seqpart = 0")]
+    other = [row[0] for row in db.execute("SELECT seqid FROM Sequences WHERE seqpart > 0")]
+    db.executemany("INSERT INTO TrainingPairings(compid, ncd_formula, seqid_train, "
+                   "seqid_other, ncd_value) VALUES (?, ?, ?, ?, ?)",
+                   [(compid, f, t, o, rng.random())
+                    for compid in [0, 1] for f in ['a', 'b'] for t in train for o in other])
+    db.commit()
+    return db
+
+
+def _reference(db, compid, ncd_formula, agg_spec):
+    # every ordered pair in the same partition, one at a time
+    ncds = {}
+    for o, t, v in db.execute("SELECT seqid_other, seqid_train, ncd_value "
+                              "FROM TrainingPairings WHERE compid = ? AND ncd_formula = ?",
+                              (compid, ncd_formula)):
+        ncds.setdefault(o, {})[t] = v
+    parts = dict(db.execute("SELECT seqid, seqpart FROM Sequences"))
+    train = sorted(next(iter(ncds.values())))
+    avg_dist = np.mean([v for row in ncds.values() for v in row.values()])
+    agg = get_aggregator(agg_spec)
+    rows = []
+    for a in sorted(ncds):
+        for b in sorted(ncds):
+            if a != b and parts[a] == parts[b]:
+                dists = np.array([[ncds[a][t] + ncds[b][t] for t in train]])
+                rows.append((a, b, train[np.argmin(dists)], agg(dists, avg_dist)[0]))
+    return rows
+
+
+def test_compute_group(tmp_path):
+    db = _create_db(str(tmp_path / "test.db"))
+    specs = ['mp', 'sim', 'topk:k=3']
+    for compid, ncd_formula in [(0, 'a'), (1, 'b')]:
+        # small blocks, so blocks span both partitions
+        blocks = list(compute_group(db, compid, ncd_formula, 2000, specs))
+        assert(len(blocks) > 1)
+        for i, spec in enumerate(specs):
+            rows = [row for block in blocks
+                    for row in zip(*[x.tolist() for x in block[i][1:]])]
+            assert([block[i][0] for block in blocks] == [spec] * len(blocks))
+            expected = _reference(db, compid, ncd_formula, spec)
+            assert([row[:3] for row in rows] == [row[:3] for row in expected])
+            assert(np.allclose([row[3] for row in rows], [row[3] for row in expected]))
+
+
+def test_compute_groups(tmp_path):
+    fname = str(tmp_path / "test.db")
+    db = _create_db(fname)
+    groups = [(0, 'a'), (0, 'b'), (1, 'a'), (1, 'b')]
+    expected = {(compid, f): list(compute_group(db, compid, f, 2000, ['mp']))
+                for compid, f in groups}
+    actual = {}
+    for compid, f, block in compute_groups(fname, groups, 2000, ['mp'], 2):
+        actual.setdefault((compid, f), []).append(block)
+    assert(actual.keys() == expected.keys())
+    for group in groups:
+        assert(len(actual[group]) == len(expected[group]))
+        for block, expected_block in zip(actual[group], expected[group]):
+            assert(all(np.all(x == y) for x, y in zip(block[0][1:], expected_block[0][1:])))
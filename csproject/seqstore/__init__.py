@@ -0,0 +1,5 @@
+from seqstore.pairs import make_pair, infer_pair_format
+from seqstore.reader import SequenceReader, db_fingerprint
+from seqstore.packed import (
+    PackedStore, PackedSequenceReader, write_packed_store, write_packed_seqs
+)
@@ -0,0 +1,273 @@
+"""
+A packed, memory-mapped alternative to the `SequenceValues` table.
+All sequence values are stored contiguously in a single token buffer,
+with an array of (start, length) offsets indexed by `seqid`. Paired
+sequences can be stored *virtually*, as a (left, right, comma, squash)
+record, and their values are synthesised on the fly when read.
+
+A store is a directory containing:
+- `store.json`, the store's metadata: the token dtype, and the
+  fingerprint (see `db_fingerprint`) and maximum `seqid` of the DB it
+  was built from, so that a store which is stale is never read,
+- `tokens.bin`, the raw token buffer,
+- `offsets.npy`, an int64 array of shape (num-seqids, 2),
+- `pairs.npy`, an int64 array of shape (num-virtual-pairs, 5), whose
+  rows are (seqid_out, seqid_left, seqid_right, comma_id, squash).
+"""
+
+
+import os
+import json
+import numpy as np
+import progressbar as pgb
+from seqstore.reader import SequenceReader, db_fingerprint
+from seqstore.pairs import make_pair, infer_pair_format
+
+
+def _token_dtype(alphabet_size):
+    if alphabet_size <= np.iinfo(np.uint8).max + 1:
+        return np.uint8
+    elif alphabet_size <= np.iinfo(np.uint16).max + 1:
+        return np.uint16
+    else:
+        return np.int32
+
+
+def _max_seqid(db):
+    cur = db.cursor()
+    cur.execute("SELECT MAX(seqid) FROM Sequences")
+    return cur.fetchone()[0]
+
+
+def _write_meta(path, meta):
+    with open(os.path.join(path, "store.json"), "w") as f:
+        json.dump(meta, f)
+
+
+class PackedSequenceReader:
+    """Equivalent to `SequenceReader`, but reading from a `PackedStore`."""
+    def __init__(self, store, ids, as_numpy=False):
+        self.store = store
+        self.ids = ids
+        self.as_numpy = as_numpy
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        seqs = map(self.store.__getitem__, self.ids)
+        if self.as_numpy:
+            return seqs
+        else:
+            return map(lambda s: s.tolist(), seqs)
+
+
+class PackedStore:
+    def __init__(self, path):
+        with open(os.path.join(path, "store.json"), "r") as f:
+            meta = json.load(f)
+        self.path = path
+        self.meta = meta
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode='r')
+        self.pairs = np.load(os.path.join(path, "pairs.npy"))
+        if os.path.getsize(os.path.join(path, "tokens.bin")) > 0:
+            self.tokens = np.memmap(os.path.join(path, "tokens.bin"),
+                                    dtype=np.dtype(meta["dtype"]), mode='r')
+        else:  # cannot memory-map an empty file
+            self.tokens = np.zeros((0,), dtype=np.dtype(meta["dtype"]))
+        self._index_pairs()
+
+    def check(self, db, fingerprint=None):
+        """Check that the store is up to date with a DB, i.e. that the
+        DB's sequences (and their values) are those the store was built
+        from.
+
+        Args:
+            db (sqlite3.Connection): The DB.
+            fingerprint (str, optional): The DB's fingerprint (see
+                                         `db_fingerprint`), if it has
+                                         already been computed.
+
+        Raises:
+            ValueError: If the store is stale.
+        """
+        # (a change in the maximum `seqid` is cheaper to spot)
+        if (self.meta.get("max_seqid") != _max_seqid(db) or
+                self.meta.get("fingerprint") != (fingerprint or db_fingerprint(db))):
+            raise ValueError(f"the packed store {self.path} is stale (the sequences "
+                             "of the DB have changed since it was built), re-run "
+                             "pack_db.py.")
+
+    def mark_up_to_date(self, db):
+        """Record that the store is up to date with a DB, after the same
+        sequences have been added to both (e.g. with `add_pairs`).
+        """
+        self.meta["fingerprint"] = db_fingerprint(db)
+        self.meta["max_seqid"] = _max_seqid(db)
+        _write_meta(self.path, self.meta)
+
+    def _index_pairs(self):
+        # map each seqid to its row in `pairs`, or -1 if not a virtual pair
+        self.pair_idx = -np.ones((self.offsets.shape[0],), dtype=np.int64)
+        self.pair_idx[self.pairs[:, 0]] = np.arange(self.pairs.shape[0])
+
+    def __getitem__(self, seqid):
+        """Get the values of the sequence `seqid`, as an np.int32 array."""
+        i = self.pair_idx[seqid]
+        if i >= 0:
+            _, left, right, comma_id, squash = self.pairs[i]
+            return make_pair(self[left], self[right], comma_id, squash == 1)
+        start, length = self.offsets[seqid]
+        return self.tokens[start:start + length].astype(np.int32)
+
+    def length(self, seqid):
+        i = self.pair_idx[seqid]
+        if i >= 0:
+            _, left, right, _, squash = self.pairs[i]
+            return self.length(left) + self.length(right) + 1 - 2 * squash
+        return int(self.offsets[seqid, 1])
+
+    def reader(self, ids, as_numpy=False):
+        """Create a reader over the given sequence IDs, which behaves
+        like `SequenceReader`.
+        """
+        return PackedSequenceReader(self, ids, as_numpy=as_numpy)
+
+    def add_pairs(self, pairs, comma_id, squash_start_end):
+        """Add new virtual pairs to the store. These must also be added to
+        the DB, after which the store should be marked as up to date
+        with it (see `mark_up_to_date`).
+
+        Args:
+            pairs (list of tuple): List of (seqid_out, seqid_left, seqid_right)
+                                   tuples, where the new `seqid_out`s are not
+                                   already in the store.
+            comma_id (int): The comma token.
+            squash_start_end (bool): See `make_pair`.
+        """
+        new_pairs = np.array([
+            (seqid_out, left, right, comma_id, 1 if squash_start_end else 0)
+            for seqid_out, left, right in pairs
+        ], dtype=np.int64).reshape((-1, 5))
+        if new_pairs.shape[0] == 0:
+            return
+
+        n_seqids = int(max(self.offsets.shape[0], new_pairs[:, 0].max() + 1))
+        if n_seqids > self.offsets.shape[0]:
+            # virtual pairs have no physical values
+            offsets = np.zeros((n_seqids, 2), dtype=np.int64)
+            offsets[:self.offsets.shape[0]] = self.offsets
+            self.offsets = None  # close the memory map before overwriting
+            np.save(os.path.join(self.path, "offsets.npy"), offsets)
+            self.offsets = np.load(os.path.join(self.path, "offsets.npy"), mmap_mode='r')
+
+        self.pairs = np.concatenate((self.pairs, new_pairs), axis=0)
+        np.save(os.path.join(self.path, "pairs.npy"), self.pairs)
+        self._index_pairs()
+
+
+def write_packed_store(db, path, virtual_pairs=True):
+    """Export all of the sequences in a DB to a new packed store.
+
+    Args:
+        db (sqlite3.Connection): The DB to export.
+        path (str): The directory to create the store in. Must not exist.
+        virtual_pairs (bool, optional): If true, paired sequences which can
+                                        be synthesised from their left and
+                                        right sequences are not stored
+                                        physically.
+    """
+    cur = db.cursor()
+    cur.execute("SELECT MAX(tokid) + 1 FROM Alphabet")
+    dtype = _token_dtype(cur.fetchone()[0])
+    cur.execute("SELECT MAX(seqid) + 1 FROM Sequences")
+    n_seqids = cur.fetchone()[0] or 0
+
+    os.mkdir(path)
+    _write_meta(path, {"dtype": np.dtype(dtype).name, "fingerprint": db_fingerprint(db),
+                       "max_seqid": _max_seqid(db)})
+
+    offsets = np.zeros((n_seqids, 2), dtype=np.int64)
+    pairs = []
+    start = 0
+
+    with open(os.path.join(path, "tokens.bin"), "wb") as f:
+        def write(seqid, seq):
+            nonlocal start
+            seq.astype(dtype).tofile(f)
+            offsets[seqid] = (start, len(seq))
+            start += len(seq)
+
+        # write all singleton sequences first, so that they are
+        # available when deciding how to store the pairs
+        cur.execute("SELECT seqid FROM Sequences WHERE seq_is_pair = 0 "
+                    "ORDER BY seqid ASC")
+        ids = list(map(lambda t: t[0], cur.fetchall()))
+        for seqid, seq in zip(ids, pgb.progressbar(SequenceReader(db, ids, as_numpy=True))):
+            write(seqid, seq)
+        f.flush()
+
+        cur.execute("""
+            SELECT seqid, seqid_left, seqid_right
+            FROM Sequences LEFT JOIN SequencePairings ON seqid = seqid_out
+            WHERE seq_is_pair = 1
+            ORDER BY seqid ASC
+        """)
+        rows = cur.fetchall()
+        ids = list(map(lambda t: t[0], rows))
+        singletons = (np.memmap(f.name, dtype=dtype, mode='r')
+                      if start > 0 else np.zeros((0,), dtype=dtype))
+        for row, seq in zip(rows, pgb.progressbar(SequenceReader(db, ids, as_numpy=True))):
+            seqid, left, right = row
+            fmt = None
+            if virtual_pairs and left is not None:
+                fmt = infer_pair_format(
+                    seq,
+                    singletons[offsets[left, 0]:offsets[left].sum()],
+                    singletons[offsets[right, 0]:offsets[right].sum()])
+            if fmt is not None:
+                pairs.append((seqid, left, right, fmt[0], 1 if fmt[1] else 0))
+            else:
+                write(seqid, seq)
+
+    np.save(os.path.join(path, "offsets.npy"), offsets)
+    np.save(os.path.join(path, "pairs.npy"),
+            np.array(pairs, dtype=np.int64).reshape((-1, 5)))
+
+
+def write_packed_seqs(path, ids, seqs, alphabet_size, fingerprint=None):
+    """Write arbitrary sequences (e.g. the outputs of a compressor) to a
+    new packed store, physically.
+
+    Args:
+        path (str): The directory to create the store in. Must not exist.
+        ids (list of int): The sequence IDs to store the sequences under.
+        seqs (iterator): The sequences, in the same order as `ids`. These
+                         may be lists, NumPy arrays or bytes-like objects.
+        alphabet_size (int): The alphabet size of the sequences.
+        fingerprint (str, optional): The fingerprint (see `db_fingerprint`)
+                                     of the DB the sequences were derived
+                                     from, where `ids` are all of its
+                                     sequence IDs, if the store should
+                                     be read in its place.
+    """
+    dtype = _token_dtype(alphabet_size)
+    n_seqids = max(ids) + 1 if len(ids) > 0 else 0
+
+    os.mkdir(path)
+    _write_meta(path, {"dtype": np.dtype(dtype).name, "fingerprint": fingerprint,
+                       "max_seqid": max(ids) if len(ids) > 0 else None})
+
+    offsets = np.zeros((n_seqids, 2), dtype=np.int64)
+    start = 0
+    with open(os.path.join(path, "tokens.bin"), "wb") as f:
+        for seqid, seq in zip(ids, seqs):
+            if isinstance(seq, (bytes, bytearray, memoryview)):
+                seq = np.frombuffer(seq, dtype=np.uint8)
+            seq = np.asarray(seq, dtype=dtype)
+            seq.tofile(f)
+            offsets[seqid] = (start, len(seq))
+            start += len(seq)
+
+    np.save(os.path.join(path, "offsets.npy"), offsets)
+    np.save(os.path.join(path, "pairs.npy"), np.zeros((0, 5), dtype=np.int64))
@@ -0,0 +1,110 @@
+import os
+import pytest
+import tempfile
+import sqlite3 as sql
+import numpy as np
+from seqstore import (
+    PackedStore, SequenceReader, write_packed_store, write_packed_seqs, make_pair
+)
+
+
+def _create_db():
+    db = sql.connect(":memory:")
+    with open(os.path.join(os.path.dirname(__file__), "..", "create_db.sql"), "r") as f:
+        db.executescript(f.read())
+    db.executemany("INSERT INTO Alphabet(tokid) VALUES (?)",
+                   [(t,) for t in range(10)])
+    seqs = [np.random.randint(0, 9, size=(np.random.randint(2, 10),)) for _ in range(6)]
+    db.executemany("INSERT INTO Sequences(seqid, seqpart) VALUES (?, 0)",
+                   [(seqid,) for seqid in range(len(seqs))])
+    # pairs: one without squashing, one with squashing, one which isn't
+    # a valid pairing of its left and right sequences
+    pairs = [
+        (len(seqs), 0, 1, make_pair(seqs[0], seqs[1], 9, False)),
+        (len(seqs) + 1, 2, 3, make_pair(seqs[2], seqs[3], 9, True)),
+        (len(seqs) + 2, 4, 5, np.array([1, 2, 3])),
+    ]
+    for seqid, left, right, pair in pairs:
+        db.execute("INSERT INTO Sequences(seqid, seqpart, seq_is_pair) VALUES (?, 0, 1)",
+                   (seqid,))
+        db.execute("INSERT INTO SequencePairings(seqid_out, seqid_left, seqid_right) "
+                   "VALUES (?, ?, ?)", (seqid, left, right))
+        seqs.append(pair)
+    db.executemany(
+        "INSERT INTO SequenceValues(seqid, svidx, tokid) VALUES (?, ?, ?)",
+        [(seqid, i, int(t)) for seqid, s in enumerate(seqs) for i, t in enumerate(s)])
+    return db, seqs
+
+
+def test_packed_store():
+    db, seqs = _create_db()
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "store")
+        write_packed_store(db, path)
+        store = PackedStore(path)
+
+        # the first two pairs are virtual, the last is stored physically
+        assert(sorted(store.pairs[:, 0].tolist()) == [6, 7])
+        assert(store.tokens.shape[0] == sum(map(len, seqs[:6])) + 3)
+
+        ids = list(range(len(seqs)))
+        assert(list(store.reader(ids)) == list(SequenceReader(db, ids)))
+        for seqid, s in enumerate(seqs):
+            assert(store.length(seqid) == len(s))
+
+        # add another virtual pair
+        store.add_pairs([(len(seqs), 5, 0)], 9, False)
+        store = PackedStore(path)
+        assert(np.all(store[len(seqs)] == make_pair(seqs[5], seqs[0], 9, False)))
+
+
+def test_write_packed_seqs():
+    seqs = [[1, 2, 3], b'\x04\x05', np.array([], dtype=np.int64), np.array([255, 0])]
+    ids = [3, 0, 5, 1]
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "store")
+        write_packed_seqs(path, ids, iter(seqs), 256)
+        store = PackedStore(path)
+        assert(store.tokens.dtype == np.uint8)
+        assert(list(store.reader(ids)) == [[1, 2, 3], [4, 5], [], [255, 0]])
+
+
+def test_stale_store():
+    db, seqs = _create_db()
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "store")
+        write_packed_store(db, path)
+        store = PackedStore(path)
+        store.check(db)
+
+        # values rewritten in place (e.g. by `unkify.py`)
+        db.execute("UPDATE SequenceValues SET tokid = 9 WHERE seqid = 0 AND svidx = 0")
+        with pytest.raises(ValueError, match="stale"):
+            PackedStore(path).check(db)
+        db.execute("UPDATE SequenceValues SET tokid = ? WHERE seqid = 0 AND svidx = 0",
+                   (int(seqs[0][0]),))
+        PackedStore(path).check(db)
+
+        # a pair added to the DB only
+        seqid = len(seqs)
+        db.execute("INSERT INTO Sequences(seqid, seqpart, seq_is_pair) VALUES (?, 0, 1)",
+                   (seqid,))
+        db.execute("INSERT INTO SequencePairings(seqid_out, seqid_left, seqid_right) "
+                   "VALUES (?, 5, 0)", (seqid,))
+        db.executemany(
+            "INSERT INTO SequenceValues(seqid, svidx, tokid) VALUES (?, ?, ?)",
+            [(seqid, i, int(t)) for i, t in enumerate(make_pair(seqs[5], seqs[0], 9, False))])
+        with pytest.raises(ValueError, match="stale"):
+            PackedStore(path).check(db)
+
+        # ...and then to the store
+        store = PackedStore(path)
+        store.add_pairs([(seqid, 5, 0)], 9, False)
+        store.mark_up_to_date(db)
+        PackedStore(path).check(db)
+
+        # stores written before the DB's fingerprint was recorded
+        store = PackedStore(path)
+        del store.meta["fingerprint"]
+        with pytest.raises(ValueError, match="stale"):
+            store.check(db)
@@ -0,0 +1,53 @@
+"""
+Paired sequences are the concatenation of a left and a right
+sequence, separated by a comma token (see `pair_up.py`). These
+helpers construct them without going through `SequenceValues`,
+so that pairs can be stored virtually.
+"""
+
+
+import numpy as np
+
+
+def make_pair(left, right, comma_id, squash_start_end):
+    """Construct a paired sequence in the same way as `pair_up.py`.
+
+    Args:
+        left (np.ndarray): The left sequence.
+        right (np.ndarray): The right sequence.
+        comma_id (int): The token separating the two sequences.
+        squash_start_end (bool): If true, drop the end token of the left
+                                 sequence and the start token of the
+                                 right sequence.
+
+    Returns:
+        np.ndarray: The paired sequence, as an np.int32 array.
+    """
+    if squash_start_end:
+        left = left[:-1]
+        right = right[1:]
+    return np.concatenate((
+        np.asarray(left, dtype=np.int32),
+        np.array([comma_id], dtype=np.int32),
+        np.asarray(right, dtype=np.int32)
+    ))
+
+
+def infer_pair_format(pair, left, right):
+    """Given a paired sequence, and the sequences it was constructed from,
+    work out how it was constructed, so that it can be synthesised from
+    `left` and `right` with `make_pair`.
+
+    Returns:
+        A 2-tuple (comma_id, squash_start_end), or None if `pair` cannot
+        be represented this way.
+    """
+    for squash in (False, True):
+        comma_idx = len(left) - 1 if squash else len(left)
+        if comma_idx < 0 or comma_idx >= len(pair):
+            continue
+        comma_id = int(pair[comma_idx])
+        candidate = make_pair(left, right, comma_id, squash)
+        if len(candidate) == len(pair) and np.all(candidate == pair):
+            return comma_id, squash
+    return None
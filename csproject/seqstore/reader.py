@@ -0,0 +1,210 @@
+"""
+Bulk reading of sequences out of the `SequenceValues` table.
+Reading one sequence at a time costs one SQLite round trip per
+sequence, which dominates the running time of the cheaper
+compressors, so instead we read many sequences per query and
+split the rows back up into sequences in NumPy.
+"""
+
+
+import hashlib
+import itertools
+import numpy as np
+from seqstore.pairs import make_pair
+
+
+def _has_virtual_pairs(db):
+    cur = db.cursor()
+    cur.execute("SELECT 1 FROM sqlite_master "
+                "WHERE type = 'table' AND name = 'VirtualPairings'")
+    if cur.fetchone() is None:  # DB predates virtual pairs
+        return False
+    cur.execute("SELECT 1 FROM VirtualPairings LIMIT 1")
+    return cur.fetchone() is not None
+
+
+def db_fingerprint(db):
+    """A fingerprint of the sequences of a DB, which changes whenever
+    they do (e.g. when `pair_up.py` adds pairs, or `unkify.py` rewrites
+    their values), so that anything derived from them (packed stores,
+    and `compress.py --stage-cache`) is never reused for different
+    sequences.
+    """
+    cur = db.cursor()
+    queries = [
+        "SELECT MAX(tokid) FROM Alphabet",
+        "SELECT seqid, seqpart, seq_is_pair FROM Sequences ORDER BY seqid",
+        # a checksum of the values, rather than the values themselves
+        "SELECT COUNT(*), TOTAL(tokid), TOTAL(tokid * (svidx + 1)), "
+        "TOTAL(tokid * (seqid + 1)) FROM SequenceValues"
+    ]
+    if _has_virtual_pairs(db):
+        queries.append("SELECT * FROM VirtualPairings ORDER BY seqid_out")
+    fingerprint = hashlib.sha1()
+    for query in queries:
+        cur.execute(query)
+        for row in cur:
+            fingerprint.update(repr(row).encode())
+    return fingerprint.hexdigest()
+
+
+def _group_rows(cur, block_sz):
+    """Group the rows of a cursor over `(seqid, tokid)` rows, which
+    are sorted by `seqid` (and then `svidx`), into sequences.
+
+    Args:
+        cur (sqlite3.Cursor): A cursor which has just executed the query.
+        block_sz (int): The number of rows to fetch at a time.
+
+    Returns:
+        An iterator over (seqid, tokens) tuples, where `tokens` is
+        an np.int32 array.
+    """
+    last_seqid = None
+    last_toks = []
+    while True:
+        rows = cur.fetchmany(block_sz)
+        if len(rows) == 0:
+            break
+
+        rows = np.array(rows, dtype=np.int64)
+        seqids = rows[:, 0]
+        toks = rows[:, 1].astype(np.int32)
+        # the boundaries of each group of rows with equal `seqid`:
+        bounds = [0] + (np.flatnonzero(np.diff(seqids)) + 1).tolist() + [len(rows)]
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            seqid = int(seqids[start])
+            # the first group may be the continuation of the last
+            # group of the previous block
+            if seqid != last_seqid:
+                if last_seqid is not None:
+                    yield last_seqid, np.concatenate(last_toks)
+                last_seqid = seqid
+                last_toks = []
+            last_toks.append(toks[start:end])
+
+    if last_seqid is not None:
+        yield last_seqid, np.concatenate(last_toks)
+
+
+class SequenceReader:
+    """Given a list of sequence IDs, generate the actual sequences, in
+    the same order as the IDs. The main point of using this class
+    rather than a Python generator is for length calculation.
+
+    If the IDs are sorted and reasonably dense (e.g. when iterating over
+    the whole dataset) then the whole range is streamed with a single
+    query in primary key order. Otherwise (e.g. for shuffled IDs) the
+    IDs are read in chunks, with one query per chunk.
+
+    Virtual pairs (see `pair_up.py --virtual`) have no rows in
+    `SequenceValues`, and are synthesised from their left and right
+    sequences.
+    """
+    def __init__(self, db, ids, as_numpy=False, chunk_sz=512, block_sz=1 << 16):
+        """
+        Args:
+            db (sqlite3.Connection): The DB to read from.
+            ids (list of int): The sequence IDs to read.
+            as_numpy (bool, optional): If true, yield np.int32 arrays
+                                       rather than lists of ints.
+            chunk_sz (int, optional): The number of IDs to read per query
+                                      when the IDs are not sorted. This
+                                      must not exceed SQLite's limit on
+                                      the number of query parameters.
+            block_sz (int, optional): The number of rows to fetch from
+                                      the DB at a time.
+        """
+        self.db = db
+        self.ids = ids
+        self.as_numpy = as_numpy
+        self.chunk_sz = chunk_sz
+        self.block_sz = block_sz
+        self.virtual_pairs = _has_virtual_pairs(db)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        # a fresh generator each time, so that it is safe to call `iter`
+        # on this object more than once
+        if self.as_numpy:
+            return self._iter_arrays()
+        else:
+            return map(lambda s: s.tolist(), self._iter_arrays())
+
+    def _iter_arrays(self):
+        if not self.virtual_pairs:
+            yield from self._iter_physical()
+            return
+
+        # the physical values of virtual pairs are empty, so replace
+        # them (a chunk at a time) with their synthesised values
+        seqs = self._iter_physical()
+        for i in range(0, len(self.ids), self.chunk_sz):
+            chunk = list(self.ids[i:i + self.chunk_sz])
+            pairs = self._read_virtual_pairs(chunk)
+            parts = self._read_dict(sorted(set(
+                [left for left, _, _, _ in pairs.values()]
+                + [right for _, right, _, _ in pairs.values()])))
+            for seqid, seq in zip(chunk, itertools.islice(seqs, len(chunk))):
+                if seqid in pairs:
+                    left, right, comma_id, squash = pairs[seqid]
+                    yield make_pair(parts[left], parts[right], comma_id, squash == 1)
+                else:
+                    yield seq
+
+    def _read_virtual_pairs(self, ids):
+        cur = self.db.cursor()
+        cur.execute("SELECT seqid_out, seqid_left, seqid_right, "
+                    "comma_tokid, squash_start_end "
+                    "FROM VirtualPairings NATURAL JOIN SequencePairings "
+                    "WHERE seqid_out IN (" + ", ".join(["?"] * len(ids)) + ")",
+                    ids)
+        return dict([(t[0], t[1:]) for t in cur.fetchall()])
+
+    def _read_dict(self, ids):
+        seqs = {}
+        for i in range(0, len(ids), self.chunk_sz):
+            chunk = ids[i:i + self.chunk_sz]
+            seqs.update(zip(chunk, self._iter_chunk(chunk)))
+        return seqs
+
+    def _iter_physical(self):
+        if len(self.ids) == 0:
+            return
+
+        ids = np.asarray(self.ids, dtype=np.int64)
+        span = int(ids[-1] - ids[0]) + 1
+        if np.all(ids[1:] > ids[:-1]) and 2 * len(ids) >= span:
+            yield from self._iter_range(ids)
+        else:
+            for i in range(0, len(ids), self.chunk_sz):
+                yield from self._iter_chunk(ids[i:i + self.chunk_sz].tolist())
+
+    def _iter_range(self, ids):
+        # merge the (sorted) `ids` with the (sorted) stream of sequences
+        # in the range, skipping over any sequences which weren't asked for
+        cur = self.db.cursor()
+        cur.execute("SELECT seqid, tokid FROM SequenceValues "
+                    "WHERE seqid BETWEEN ? AND ? "
+                    "ORDER BY seqid ASC, svidx ASC",
+                    (int(ids[0]), int(ids[-1])))
+        groups = _group_rows(cur, self.block_sz)
+        group = next(groups, None)
+        for seqid in ids.tolist():
+            while group is not None and group[0] < seqid:
+                group = next(groups, None)
+            if group is not None and group[0] == seqid:
+                yield group[1]
+            else:  # sequence has no values
+                yield np.zeros((0,), dtype=np.int32)
+
+    def _iter_chunk(self, ids):
+        cur = self.db.cursor()
+        cur.execute("SELECT seqid, tokid FROM SequenceValues "
+                    "WHERE seqid IN (" + ", ".join(["?"] * len(ids)) + ") "
+                    "ORDER BY seqid ASC, svidx ASC", ids)
+        seqs = dict(_group_rows(cur, self.block_sz))
+        for seqid in ids:
+            yield seqs.get(seqid, np.zeros((0,), dtype=np.int32))
@@ -0,0 +1,42 @@
+import sqlite3 as sql
+import numpy as np
+from seqstore import SequenceReader
+
+
+def _create_db(seqs):
+    db = sql.connect(":memory:")
+    db.execute("""
+        CREATE TABLE SequenceValues(
+            seqid INTEGER NOT NULL,
+            svidx INTEGER NOT NULL,
+            tokid INTEGER NOT NULL,
+            PRIMARY KEY(seqid, svidx)
+        )""")
+    db.executemany(
+        "INSERT INTO SequenceValues(seqid, svidx, tokid) VALUES (?, ?, ?)",
+        [(seqid, i, t) for seqid, s in seqs.items() for i, t in enumerate(s)])
+    return db
+
+
+def test_sequence_reader():
+    seqs = dict([
+        (seqid, np.random.randint(0, 100, size=(np.random.randint(1, 20),)).tolist())
+        for seqid in range(50) if seqid != 7
+    ])
+    seqs[7] = []  # a sequence with no values
+    db = _create_db(seqs)
+
+    # sorted and dense, sorted and sparse, and shuffled
+    for ids in [list(range(50)), [3, 7, 40], np.random.permutation(50).tolist()]:
+        # small block/chunk sizes to exercise the boundary cases
+        reader = SequenceReader(db, ids, chunk_sz=7, block_sz=5)
+        assert(len(reader) == len(ids))
+        # repeat to check the reader can be iterated over more than once
+        for _ in range(2):
+            results = list(reader)
+            assert(results == [seqs[seqid] for seqid in ids])
+
+        reader = SequenceReader(db, ids, as_numpy=True)
+        for seqid, s in zip(ids, reader):
+            assert(s.dtype == np.int32)
+            assert(np.all(s == np.array(seqs[seqid], dtype=np.int32)))
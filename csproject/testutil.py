@@ -0,0 +1,66 @@
+"""
+Helpers shared by the tests of the scripts, which run them on small,
+randomly generated DBs.
+"""
+
+
+import os
+import sys
+import random
+import subprocess
+import sqlite3 as sql
+
+
+_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# the tables added to `create_db.sql` since DBs were first created with
+# it, which DBs created before then lack
+_NEW_TABLES = ['VirtualPairings', 'ConditionalCompressionSizes']
+
+
+def create_db(path, n_seqs=40, alphabet_sz=16, baseline=False, seed=0):
+    """Create a DB at `path` from `create_db.sql`, holding random
+    sequences (split between the train, val and test sets) with one
+    label type, and `[MASK]` and `[PAD]` tokens.
+
+    Args:
+        baseline (bool, optional): If true, leave out the tables which
+                                   DBs created with the original schema
+                                   do not have.
+    """
+    rng = random.Random(seed)
+    db = sql.connect(path)
+    with open(os.path.join(_DIR, "create_db.sql"), "r") as f:
+        db.executescript(f.read())
+    if baseline:
+        for table in _NEW_TABLES:
+            db.execute("DROP TABLE " + table)
+
+    db.executemany("INSERT INTO Alphabet(tokid, tokval) VALUES (?, ?)",
+                   [(t, str(t)) for t in range(alphabet_sz)] +
+                   [(alphabet_sz, '[MASK]'), (alphabet_sz + 1, '[PAD]')])
+    db.execute("INSERT INTO LabelTypes(lbltype, lbltype_name) VALUES (0, 'lbl')")
+    db.executemany("INSERT INTO LabelDictionary(lbltype, lbl) VALUES (0, ?)", [(0,), (1,)])
+    for seqid in range(n_seqs):
+        db.execute("INSERT INTO Sequences(seqid, seqpart) VALUES (?, ?)",
+                   (seqid, [0, 0, 1, 2][seqid % 4]))
+        db.executemany("INSERT INTO SequenceValues(seqid, svidx, tokid) VALUES (?, ?, ?)",
+                       [(seqid, i, rng.randrange(alphabet_sz))
+                        for i in range(rng.randint(5, 60))])
+        db.execute("INSERT INTO Labels(seqid, lbltype, lbl) VALUES (?, 0, ?)",
+                   (seqid, rng.randrange(2)))
+    db.commit()
+    return db
+
+
+def run_script(script, *args, fail=False):
+    """Run one of the scripts with the given arguments, and check that
+    it succeeds (or, if `fail` is true, that it fails).
+
+    Returns:
+        str: Its output.
+    """
+    result = subprocess.run([sys.executable, os.path.join(_DIR, script)] + list(args),
+                            cwd=_DIR, capture_output=True, text=True)
+    assert((result.returncode != 0) == fail), result.stdout + result.stderr
+    return result.stdout